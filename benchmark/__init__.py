@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+pvstats benchmarks, run from the top of the source tree with
+
+    python -m benchmark.<name> --help
+"""
+
+# vim: set expandtab ts=2 sw=2:
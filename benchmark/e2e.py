@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End to end benchmark of the sampling and publishing pipeline
+
+Inverters and reports are created through PVInverterFactory and
+PVReportFactory against the local stand-ins in benchmark.servers, then each
+inverter is polled back to back for a number of cycles. The latency of each
+stage is reported as percentiles, along with the sample throughput, for
+every combination of inverter and report counts.
+
+    python -m benchmark.e2e --inverters 1,4,16 --reports 1,3 --cycles 200 \\
+                            --delay 0.02 --failure-rate 0.01
+"""
+
+import argparse
+import threading
+import time
+
+from pvstats.pvinverter.factory import PVInverterFactory
+from pvstats.report import PVReportFactory
+from pvstats.scheduler import PVScheduler
+from pvstats.worker import PVReportWorker
+
+from benchmark import servers
+
+MODELS  = ('sungrow-sg5ktl', 'fronius', 'solax')
+REPORTS = ('pvoutput', 'influxdb', 'mqtt')
+
+def percentile(values, pct):
+  if not values:
+    return float('nan')
+  values = sorted(values)
+  return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+class Stage(object):
+  """Latency samples of one pipeline stage"""
+
+  def __init__(self, name):
+    self.name    = name
+    self.samples = []
+    self.errors  = 0
+    self._lock   = threading.Lock()
+
+  def add(self, seconds):
+    with self._lock:
+      self.samples.append(seconds)
+
+  def row(self):
+    return "{:<24} {:>7d} {:>6d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+           self.name, len(self.samples), self.errors,
+           percentile(self.samples, 50) * 1e3, percentile(self.samples, 90) * 1e3,
+           percentile(self.samples, 99) * 1e3, max(self.samples or [0]) * 1e3)
+
+class TimedReport(object):
+  """Times the publish calls of a report"""
+
+  def __init__(self, report, stage):
+    self.report = report
+    self.stage  = stage
+
+  def publish(self, data):
+    tstart = time.time()
+    try:
+      self.report.publish(data)
+    except Exception:
+      self.stage.errors += 1
+      raise
+    finally:
+      self.stage.add(time.time() - tstart)
+
+class Environment(object):
+  """The stand-in servers for one benchmark run"""
+
+  def __init__(self, delay, failure_rate):
+    faults = lambda: servers.Faults(delay, failure_rate)
+    self.inverters = {'sungrow-sg5ktl': servers.SungrowModbusServer(faults()).start(),
+                      'fronius':        servers.FroniusServer(faults()).start(),
+                      'solax':          servers.SolaxServer(faults()).start()}
+    self.reports   = {'pvoutput':       servers.PVOutputServer(faults()).start(),
+                      'influxdb':       servers.InfluxDBServer(faults()).start(),
+                      'mqtt':           servers.MQTTServer(faults()).start()}
+
+  def inverter_cfg(self, model, numeric):
+    return {'model': model, 'mode': 'tcp', 'host': '127.0.0.1',
+            'port': self.inverters[model].port, 'numeric': numeric}
+
+  def report_cfg(self, rtype, idx):
+    port = self.reports[rtype].port
+    name = "{}-{}".format(rtype, idx)
+    if rtype == 'pvoutput':
+      return {'type': rtype, 'name': name, 'host': '127.0.0.1:{}'.format(port),
+              'key': 'key', 'system_id': '1', 'rate_limit': 1, 'batch_size': 1}
+    elif rtype == 'influxdb':
+      return {'type': rtype, 'name': name, 'host': '127.0.0.1', 'port': port,
+              'user': '', 'password': '', 'db': 'pvstats', 'ssl': False,
+              'verify_ssl': False, 'batch_size': 10}
+    else:
+      return {'type': rtype, 'name': name, 'host': '127.0.0.1', 'port': port,
+              'user': '', 'password': '', 'tls': False,
+              'topic': 'pvstats/{}'.format(name), 'qos': 1}
+
+  def stop(self):
+    for server in self.inverters.values() + self.reports.values():
+      server.stop()
+
+def run(env, n_inverters, n_reports, cycles, numeric):
+  stages = dict((name, Stage(name)) for name in ('connect', 'read', 'enqueue', 'cycle'))
+
+  scheduler = PVScheduler()
+  workers   = []
+  for idx in range(n_reports):
+    cfg   = env.report_cfg(REPORTS[idx % len(REPORTS)], idx)
+    stage = stages.setdefault(cfg['name'], Stage("publish " + cfg['name']))
+    workers.append(PVReportWorker(TimedReport(PVReportFactory(cfg), stage),
+                                  dict(cfg, queue_size=cycles * n_inverters)))
+    scheduler.add_report(workers[-1])
+
+  inverters = []
+  for idx in range(n_inverters):
+    model = MODELS[idx % len(MODELS)]
+    inverters.append(("{}-{}".format(model, idx),
+                      PVInverterFactory(model, env.inverter_cfg(model, numeric))))
+
+  def poll(name, inverter):
+    for _ in range(cycles):
+      t0 = time.time()
+      failed = False
+      try:
+        inverter.acquire()
+        t1 = time.time()
+        stages['connect'].add(t1 - t0)
+        inverter.read()
+        t2 = time.time()
+        stages['read'].add(t2 - t1)
+        scheduler.publish(name, inverter.registers)
+        stages['enqueue'].add(time.time() - t2)
+      except Exception:
+        failed = True
+        stages['read'].errors += 1
+      finally:
+        inverter.release(failed)
+      stages['cycle'].add(time.time() - t0)
+
+  threads = [threading.Thread(target=poll, args=inv) for inv in inverters]
+  tstart  = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  sampled = time.time() - tstart
+
+  for w in workers:
+    w.stop()
+  drained = time.time() - tstart
+
+  return stages, sampled, drained
+
+def main():
+  parser = argparse.ArgumentParser(description="End to end pvstats benchmark")
+  parser.add_argument("--inverters", default="1,4,16", help="Comma separated inverter counts")
+  parser.add_argument("--reports", default="3", help="Comma separated report counts")
+  parser.add_argument("--cycles", type=int, default=100, help="Reads per inverter")
+  parser.add_argument("--delay", type=float, default=0.0, help="Injected delay per request in seconds")
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests failing")
+  parser.add_argument("--numeric", default="decimal", choices=("decimal", "float"))
+  args = parser.parse_args()
+
+  env = Environment(args.delay, args.failure_rate)
+  try:
+    for n_inverters in [int(n) for n in args.inverters.split(',')]:
+      for n_reports in [int(n) for n in args.reports.split(',')]:
+        stages, sampled, drained = run(env, n_inverters, n_reports, args.cycles, args.numeric)
+        total = n_inverters * args.cycles
+
+        print
+        print "{} inverters, {} reports: {:.1f} samples/s sampled, {:.1f} samples/s published".format(
+              n_inverters, n_reports, total / sampled, total / drained)
+        print "{:<24} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+              "stage", "count", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms")
+        for name in sorted(stages):
+          print stages[name].row()
+  finally:
+    env.stop()
+
+
+if __name__ == "__main__":
+  main()
+
+# vim: set expandtab ts=2 sw=2:
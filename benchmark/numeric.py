@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the per-cycle decode and publish cost of the numeric modes
+
+The Sungrow decoder runs against an in-memory Modbus client, then the
+decoded registers go through the same steps a sample takes on its way to
+the reports: the worker snapshot, the InfluxDB line formatting, the
+PVOutput averaging, JSON encoding and the spool encoding.
+
+    python -m benchmark.numeric --cycles 20000
+"""
+
+import argparse
+import json
+import timeit
+
+from pvstats.pvinverter.sungrow_sg5ktl import PVInverter_SunGrow
+from pvstats.report import PVReport_influxdb, PVReport_pvoutput
+from pvstats.codec import encode_sample
+
+class _Response(object):
+  def __init__(self, registers):
+    self.registers = registers
+
+class MemoryModbusClient(object):
+  """Answers register reads from memory, without any I/O"""
+
+  def __init__(self):
+    self.input   = [1200 + x for x in range(125)]
+    self.holding = [2019, 2, 10, 17, 23, 28] + [0]*119
+    self.answers = {}
+
+  def connect(self): return True
+  def close(self): pass
+
+  def _answer(self, func, values, count):
+    # Prepared once per read so the benchmark only times the decoding
+    key = (func, count)
+    if key not in self.answers:
+      self.answers[key] = _Response(values[:count])
+    return self.answers[key]
+
+  def read_input_registers(self, start, count, unit=1):
+    return self._answer('input', self.input, count)
+
+  def read_holding_registers(self, start, count, unit=1):
+    return self._answer('holding', self.holding, count)
+
+def _setup(numeric):
+  inverter = PVInverter_SunGrow({'host': 'localhost', 'port': 502, 'numeric': numeric})
+  inverter.client = MemoryModbusClient()
+  inverter.read()
+
+  influxdb = PVReport_influxdb({'host': 'localhost', 'port': 8086, 'user': '', 'password': '',
+                                'db': 'pvstats', 'ssl': False, 'verify_ssl': False})
+  pvoutput = PVReport_pvoutput({'host': 'localhost', 'key': '', 'system_id': '',
+                                'rate_limit': 300})
+  return inverter, influxdb, pvoutput
+
+def bench(numeric, cycles):
+  inverter, influxdb, pvoutput = _setup(numeric)
+
+  def publish():
+    data = dict(inverter.registers)
+    influxdb._line(data)
+    pvoutput.publish(data)
+    json.dumps(data, separators=(',', ':'), default=str)
+    encode_sample(data)
+
+  decode  = min(timeit.repeat(inverter.read, number=cycles, repeat=3)) / cycles
+  publish = min(timeit.repeat(publish,       number=cycles, repeat=3)) / cycles
+  return decode, publish
+
+def main():
+  parser = argparse.ArgumentParser(description="Numeric mode microbenchmark")
+  parser.add_argument("--cycles", type=int, default=10000, help="Cycles per measurement")
+  args = parser.parse_args()
+
+  print "{:<8} {:>12} {:>12} {:>12}".format("mode", "decode us", "publish us", "total us")
+  for numeric in ('decimal', 'float'):
+    decode, publish = bench(numeric, args.cycles)
+    print "{:<8} {:>12.1f} {:>12.1f} {:>12.1f}".format(numeric, decode * 1e6, publish * 1e6,
+                                                         (decode + publish) * 1e6)
+
+
+if __name__ == "__main__":
+  main()
+
+# vim: set expandtab ts=2 sw=2:
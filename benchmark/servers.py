@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local stand-ins for the inverters and report services
+
+Every server listens on an ephemeral port on localhost, runs on its own
+thread, and can inject a fixed delay and a random failure rate into each
+request.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+from pymodbus.server.sync import ModbusTcpServer
+from pymodbus.datastore import ModbusSequentialDataBlock
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+
+from pvstats.pvinverter.sungrow_sg5ktl import _register_map
+
+class Faults(object):
+  """Delay and failure injection shared by the stand-ins"""
+
+  def __init__(self, delay=0.0, failure_rate=0.0):
+    self.delay        = delay
+    self.failure_rate = failure_rate
+    self.requests     = 0
+    self.failures     = 0
+
+  def inject(self):
+    """Sleeps for the delay, returns True if this request should fail"""
+    self.requests += 1
+    if self.delay:
+      time.sleep(self.delay)
+    if self.failure_rate and random.random() < self.failure_rate:
+      self.failures += 1
+      return True
+    return False
+
+class _Server(object):
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  @property
+  def port(self):
+    return self.server.socket.getsockname()[1]
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+#--------
+# Modbus
+#--------
+class _FaultyDataBlock(ModbusSequentialDataBlock):
+  def __init__(self, address, values, faults):
+    ModbusSequentialDataBlock.__init__(self, address, values)
+    self.faults = faults
+
+  def getValues(self, address, count=1):
+    if self.faults.inject():
+      # Answered with a Modbus slave device failure exception
+      raise ValueError("Injected failure")
+    return ModbusSequentialDataBlock.getValues(self, address, count)
+
+class SungrowModbusServer(_Server):
+  """Serves the Sungrow input and holding registers over Modbus TCP"""
+
+  def __init__(self, faults=None):
+    self.faults = faults or Faults()
+
+    # The slave context adds one to the wire address, matching the 1 based
+    # addresses of the register map
+    now     = time.localtime()
+    input   = [0] * 125
+    holding = [0] * 125
+    for key, reg in _register_map['input'].iteritems():
+      input[int(key) - 5000] = random.randint(100, 4000)
+    holding[:6] = [now.tm_year, now.tm_mon, now.tm_mday, now.tm_hour, now.tm_min, now.tm_sec]
+
+    store = ModbusSlaveContext(ir=_FaultyDataBlock(5000, input,   self.faults),
+                               hr=_FaultyDataBlock(5000, holding, self.faults))
+    self.server = ModbusTcpServer(ModbusServerContext(slaves=store, single=True),
+                                  address=('127.0.0.1', 0))
+
+#------
+# HTTP
+#------
+FRONIUS_DEVICE = {
+  "Body": {"Data": {
+    "DAY_ENERGY": {"Unit": "Wh", "Value": 55550},
+    "PAC":        {"Unit": "W",  "Value": 4051},
+    "UDC":        {"Unit": "V",  "Value": 407.8}}},
+  "Head": {"Status": {"Code": 0, "Reason": "", "UserMessage": ""},
+           "Timestamp": "2019-02-10T17:23:28+11:00"}}
+
+FRONIUS_SYSTEM = {
+  "Body": {"Data": {
+    "DAY_ENERGY": {"Unit": "Wh", "Values": {"1": 55550, "2": 41200}},
+    "PAC":        {"Unit": "W",  "Values": {"1": 4051,  "2": 3120}}}},
+  "Head": {"Status": {"Code": 0, "Reason": "", "UserMessage": ""},
+           "Timestamp": "2019-02-10T17:23:28+11:00"}}
+
+# Solax leaves missing values empty, which is not valid JSON
+SOLAX_BODY = ('{"method":"uploadsn","version":"Solax_SI_CH_2nd_20160912_DE02","type":"AL_SE",'
+              '"SN":"XXXXXXXXXX","Data":[2.2,2.0,240.6,138.2,,,482,32,7.5,5071.3,,,,,,,,,0.08,'
+              '1.00,,,,,,,,0],"Status":"2"}')
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  # Send each response in one write, otherwise Nagle's algorithm and delayed
+  # acknowledgements add tens of milliseconds to every keep-alive request
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def _reply(self, code, body='', content_type='text/plain'):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _handle(self):
+    length = int(self.headers.get('Content-Length', 0))
+    body   = self.rfile.read(length) if length else ''
+    self.server.received += 1
+    self.server.bytes    += len(body)
+
+    if self.server.faults.inject():
+      self._reply(503, 'Injected failure')
+      return
+
+    route = self.server.routes.get(self.path.split('?')[0])
+    if route is None:
+      self._reply(404, 'Not found')
+    else:
+      self._reply(*route(self))
+
+  do_GET  = _handle
+  do_POST = _handle
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class StubHTTPServer(_Server):
+  """An HTTP server answering a fixed set of paths"""
+
+  def __init__(self, routes, faults=None):
+    self.faults = faults or Faults()
+    self.server = _HTTPServer(('127.0.0.1', 0), _Handler)
+    self.server.routes   = routes
+    self.server.faults   = self.faults
+    self.server.received = 0
+    self.server.bytes    = 0
+
+  @property
+  def received(self):
+    return self.server.received
+
+def _fronius(handler):
+  if 'Scope=System' in handler.path:
+    return 200, json.dumps(FRONIUS_SYSTEM), 'application/json'
+  return 200, json.dumps(FRONIUS_DEVICE), 'application/json'
+
+def FroniusServer(faults=None):
+  return StubHTTPServer({'/solar_api/v1/GetInverterRealtimeData.cgi': _fronius}, faults)
+
+def SolaxServer(faults=None):
+  return StubHTTPServer({'/api/realTimeData.htm': lambda h: (200, SOLAX_BODY)}, faults)
+
+def PVOutputServer(faults=None):
+  ok = lambda h: (200, 'OK 200: Added Status')
+  return StubHTTPServer({'/service/r2/addstatus.jsp':      ok,
+                         '/service/r2/addbatchstatus.jsp': ok}, faults)
+
+def InfluxDBServer(faults=None):
+  return StubHTTPServer({'/write': lambda h: (204, ''),
+                         '/ping':  lambda h: (204, '')}, faults)
+
+#------
+# MQTT
+#------
+class _MQTTHandler(SocketServer.BaseRequestHandler):
+  """Just enough of an MQTT 3.1.1 broker to accept publishes"""
+
+  def _read(self, n):
+    data = ''
+    while len(data) < n:
+      chunk = self.request.recv(n - len(data))
+      if not chunk:
+        raise EOFError()
+      data += chunk
+    return data
+
+  def handle(self):
+    try:
+      while True:
+        header    = ord(self._read(1))
+        length    = 0
+        shift     = 0
+        while True:
+          byte    = ord(self._read(1))
+          length |= (byte & 0x7f) << shift
+          shift  += 7
+          if not byte & 0x80:
+            break
+        body   = self._read(length)
+        packet = header >> 4
+
+        if packet == 1:    # CONNECT
+          self.request.sendall('\x20\x02\x00\x00')
+        elif packet == 3:  # PUBLISH
+          self.server.received += 1
+          self.server.bytes    += len(body)
+          qos = (header >> 1) & 3
+          if qos:
+            (topic_len,) = struct.unpack('>H', body[:2])
+            msg_id = body[2 + topic_len:4 + topic_len]
+            if self.server.faults.inject():
+              # Drop the acknowledgement, the client will retry
+              continue
+            self.request.sendall(('\x40\x02' if qos == 1 else '\x50\x02') + msg_id)
+        elif packet == 6:  # PUBREL
+          self.request.sendall('\x70\x02' + body[:2])
+        elif packet == 12: # PINGREQ
+          self.request.sendall('\xd0\x00')
+        elif packet == 14: # DISCONNECT
+          break
+    except (EOFError, socket.error):
+      pass
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads      = True
+  allow_reuse_address = True
+
+class MQTTServer(_Server):
+  def __init__(self, faults=None):
+    self.faults = faults or Faults()
+    self.server = _TCPServer(('127.0.0.1', 0), _MQTTHandler)
+    self.server.faults   = self.faults
+    self.server.received = 0
+    self.server.bytes    = 0
+
+  @property
+  def received(self):
+    return self.server.received
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "Faults", "SungrowModbusServer", "StubHTTPServer", "FroniusServer", "SolaxServer",
+  "PVOutputServer", "InfluxDBServer", "MQTTServer"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming aggregation of register samples over fixed time windows
+
+Each window keeps running accumulators for its fields, so memory and the
+cost per sample stay constant however many samples fall in the window.
+"""
+
+import time
+
+def sample_time(data):
+  """The sample timestamp in seconds since the epoch"""
+  return time.mktime(data['timestamp'].timetuple())
+
+class RunningStats(object):
+  """Running count, mean, min, max and last value of a single field"""
+  __slots__ = ('count', 'total', 'min', 'max', 'last')
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.count = 0
+    self.total = 0.0
+    self.min   = None
+    self.max   = None
+    self.last  = None
+
+  def add(self, value):
+    value = float(value)
+    self.count += 1
+    self.total += value
+    self.last   = value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  @property
+  def mean(self):
+    if self.count == 0:
+      return None
+    return self.total / self.count
+
+  def summary(self):
+    return {'mean': self.mean, 'min': self.min, 'max': self.max,
+            'last': self.last, 'count': self.count}
+
+class PVWindow(object):
+  """Aggregates samples over consecutive windows of period seconds
+
+  Windows are aligned to multiples of the period, so a five minute window
+  closes on 10:00, 10:05 and so on. The energy of energy_field, a power in
+  watts, is integrated over the window with the trapezoidal rule and
+  reported in watt hours. A gap between samples longer than max_gap discards
+  the partial window rather than averaging across the gap.
+  """
+
+  def __init__(self, period, fields, energy_field='total_pv_power', max_gap=None):
+    self.period       = float(period)
+    self.fields       = tuple(fields)
+    self.energy_field = energy_field
+    self.max_gap      = max_gap
+
+    self.stats  = dict((f, RunningStats()) for f in self.fields)
+    self.start  = None
+    self.energy = 0.0
+    self.last   = None
+
+    # The time of the last sample, and of the last one with a power
+    self._prev_ts    = None
+    self._power_ts   = None
+    self._prev_power = 0.0
+
+  def reset(self):
+    for s in self.stats.itervalues():
+      s.reset()
+    self.start  = None
+    self.energy = 0.0
+    self.last   = None
+
+  def add(self, ts, data):
+    """Adds a sample taken at ts, returns the summary of a completed window"""
+    result = None
+    start  = ts - ts % self.period
+
+    if (self._prev_ts is not None and self.max_gap is not None and
+        ts - self._prev_ts > self.max_gap):
+      self.reset()
+      self._power_ts = None
+    elif self.start is not None and start != self.start:
+      result = self.summary()
+      self.reset()
+
+    self.start    = start
+    self.last     = data
+    self._prev_ts = ts
+    for f in self.fields:
+      if f in data:
+        self.stats[f].add(data[f])
+
+    if self.energy_field in data:
+      power = float(data[self.energy_field])
+      if self._power_ts is not None:
+        self.energy += (power + self._prev_power) / 2 * (ts - self._power_ts) / 3600
+      self._power_ts   = ts
+      self._prev_power = power
+
+    return result
+
+  def summary(self):
+    """Summarises the current window"""
+    result = dict((f, s.summary()) for f, s in self.stats.iteritems())
+    result['start']  = self.start
+    result['end']    = self.start + self.period
+    result['energy'] = self.energy
+    result['last']   = self.last
+    return result
+
+class PVAggregator(object):
+  """Feeds every sample to several windows, calling back as each completes"""
+
+  def __init__(self):
+    self.windows = []
+
+  def add_window(self, window, callback):
+    self.windows.append((window, callback))
+    return window
+
+  def add(self, data):
+    ts = sample_time(data)
+    for window, callback in self.windows:
+      result = window.add(ts, data)
+      if result is not None:
+        callback(result)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "RunningStats", "PVWindow", "PVAggregator", "sample_time"
+]
+
+# vim: set expandtab ts=2 sw=2:
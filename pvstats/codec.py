@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact binary encoding of a register sample
+
+A sample is encoded as a field count followed by each field's name, a one
+byte type code and the value. Decimal and datetime values survive the round
+trip unchanged, so a decoded sample can be published like a fresh one.
+"""
+
+from datetime import datetime
+from decimal import Decimal
+import struct
+
+_COUNT    = struct.Struct('<B')
+_NAME     = struct.Struct('<B')
+_FLOAT    = struct.Struct('<d')
+_INT      = struct.Struct('<q')
+_STR      = struct.Struct('<H')
+_DATETIME = struct.Struct('<HBBBBBI')
+
+def _pack_str(value):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return value
+
+def encode_sample(data):
+  """Encodes a register dict into a compact byte string"""
+  out = [_COUNT.pack(len(data))]
+  for name, value in data.iteritems():
+    name = _pack_str(name)
+    out.append(_NAME.pack(len(name)))
+    out.append(name)
+
+    if value is None:
+      out.append('n')
+    elif isinstance(value, bool):
+      out.append('T' if value else 'F')
+    elif isinstance(value, (int, long)):
+      out.append('i')
+      out.append(_INT.pack(value))
+    elif isinstance(value, float):
+      out.append('f')
+      out.append(_FLOAT.pack(value))
+    elif isinstance(value, Decimal):
+      value = str(value)
+      out.append('D')
+      out.append(_NAME.pack(len(value)))
+      out.append(value)
+    elif isinstance(value, datetime):
+      out.append('t')
+      out.append(_DATETIME.pack(value.year, value.month,  value.day,
+                                value.hour, value.minute, value.second,
+                                value.microsecond))
+    elif isinstance(value, basestring):
+      value = _pack_str(value)
+      out.append('s')
+      out.append(_STR.pack(len(value)))
+      out.append(value)
+    else:
+      raise TypeError("Unable to encode {} of type {}".format(name, type(value)))
+
+  return ''.join(out)
+
+def decode_sample(buf, offset=0):
+  """Decodes a byte string created by encode_sample back into a dict"""
+  data = {}
+  (count,) = _COUNT.unpack_from(buf, offset)
+  offset += _COUNT.size
+
+  for _ in range(count):
+    (n,) = _NAME.unpack_from(buf, offset)
+    offset += _NAME.size
+    name    = buf[offset:offset + n]
+    offset += n
+
+    code    = buf[offset]
+    offset += 1
+
+    if code == 'n':
+      value = None
+    elif code == 'T':
+      value = True
+    elif code == 'F':
+      value = False
+    elif code == 'i':
+      (value,) = _INT.unpack_from(buf, offset)
+      offset  += _INT.size
+    elif code == 'f':
+      (value,) = _FLOAT.unpack_from(buf, offset)
+      offset  += _FLOAT.size
+    elif code == 'D':
+      (n,)    = _NAME.unpack_from(buf, offset)
+      offset += _NAME.size
+      value   = Decimal(buf[offset:offset + n])
+      offset += n
+    elif code == 't':
+      value   = datetime(*_DATETIME.unpack_from(buf, offset))
+      offset += _DATETIME.size
+    elif code == 's':
+      (n,)    = _STR.unpack_from(buf, offset)
+      offset += _STR.size
+      value   = buf[offset:offset + n].decode('utf-8')
+      offset += n
+    else:
+      raise ValueError("Unknown type code {!r} for {}".format(code, name))
+
+    data[name] = value
+
+  return data
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "encode_sample", "decode_sample"
+]
+
+# vim: set expandtab ts=2 sw=2:
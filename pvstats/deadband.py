@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+class PVDeadbandFilter(object):
+  """Report by exception, only passing on samples which have changed
+
+  A sample is passed on when any register moved beyond its deadband since
+  the last sample passed on, or when nothing has been passed on for the
+  heartbeat period. A sample with the same timestamp as the previous one is
+  a duplicate and always dropped. Each inverter and device is tracked
+  separately.
+
+  The configuration gives each register's deadband as an absolute change,
+  a percentage of the last value, or both
+
+    {"deadbands": {"total_pv_power": {"abs": 20}, "internal_temp": {"pct": 2}},
+     "default":   {"abs": 0},
+     "heartbeat": 300}
+
+  Registers without a deadband use the default, or are not compared at all
+  if there is no default.
+  """
+
+  def __init__(self, cfg):
+    self.deadbands = {}
+    for name, band in cfg.get('deadbands', {}).iteritems():
+      self.deadbands[name] = (band.get('abs'), band.get('pct'))
+
+    default = cfg.get('default')
+    self.default   = (default.get('abs'), default.get('pct')) if default is not None else None
+    self.heartbeat = float(cfg.get('heartbeat', 300))
+
+    self.passed     = 0
+    self.suppressed = 0
+
+    self._last = {}
+    self._lock = threading.Lock()
+
+  def _changed(self, name, value, last):
+    band = self.deadbands.get(name, self.default)
+    if band is None or name == 'timestamp':
+      return False
+    if last is None:
+      return True
+
+    try:
+      delta = abs(value - last)
+    except TypeError:
+      # Not numeric, any change counts
+      return value != last
+
+    # Decimal registers do not mix with the float thresholds
+    absolute, percent = band
+    if absolute is not None and float(delta) > absolute:
+      return True
+    if percent is not None and float(delta) > abs(float(last)) * percent / 100.0:
+      return True
+    return absolute is None and percent is None and delta != 0
+
+  def accept(self, data):
+    """Returns True if the sample should be passed on"""
+    source = (data.get('inverter'), data.get('device_id'))
+    now    = time.time()
+
+    with self._lock:
+      last = self._last.get(source)
+
+      if last is not None and data.get('timestamp') == last['timestamp']:
+        self.suppressed += 1
+        return False
+
+      send = (last is None or now - last['sent'] >= self.heartbeat or
+              any(self._changed(k, v, last['values'].get(k)) for k, v in data.iteritems()))
+
+      if not send:
+        last['timestamp'] = data.get('timestamp')
+        self.suppressed  += 1
+        return False
+
+      self._last[source] = {'sent':      now,
+                            'timestamp': data.get('timestamp'),
+                            'values':    dict(data)}
+      self.passed += 1
+      return True
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVDeadbandFilter"
+]
+
+# vim: set expandtab ts=2 sw=2:
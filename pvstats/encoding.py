@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Payload encodings for publishing register samples
+
+Each encoding is compiled once per register schema, the sorted register
+names of a sample, so the per-sample work is only formatting the values.
+
+* json-pretty - the original indented JSON, Decimals as strings, the default
+* json        - compact JSON, numbers as JSON numbers
+* msgpack     - MessagePack, needs the msgpack package
+* binary      - a little endian float64 per numeric register, with datetimes
+                as seconds since the epoch, prefixed by a 32 bit schema id.
+                The layout is described by schema()
+"""
+
+from datetime import datetime
+from decimal import Decimal
+import json
+import struct
+import time
+import zlib
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+ENCODINGS = ('json-pretty', 'json', 'msgpack', 'binary')
+
+_NUMBERS = (int, long, float, Decimal)
+_NAN     = float('nan')
+
+def _json_value(value):
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  elif isinstance(value, float):
+    return repr(value)
+  elif isinstance(value, _NUMBERS):
+    return str(value)
+  elif value is None:
+    return 'null'
+  elif isinstance(value, datetime):
+    return '"' + value.isoformat() + '"'
+  return json.dumps(value)
+
+def _float(value):
+  return _NAN if value is None else float(value)
+
+def _epoch(value):
+  return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+def _plain_value(value):
+  """Converts a value to a type every encoder understands"""
+  if isinstance(value, Decimal):
+    return float(value)
+  elif isinstance(value, datetime):
+    return value.isoformat()
+  return value
+
+def text_value(value):
+  """Formats a single value as plain text, as for a per-register topic"""
+  if isinstance(value, float):
+    return repr(value)
+  elif isinstance(value, datetime):
+    return value.isoformat()
+  return unicode(value)
+
+class PVEncoder(object):
+  """An encoder compiled for one register schema"""
+
+  def __init__(self, encoding, names):
+    self.encoding = encoding
+    self.names    = names
+
+    if encoding == 'json':
+      # Everything but the values is formatted up front
+      self._prefixes = ['{' + json.dumps(names[0]) + ':'] + \
+                       [',' + json.dumps(n) + ':' for n in names[1:]]
+    elif encoding == 'binary':
+      self.fields = None
+    elif encoding == 'msgpack':
+      if msgpack is None:
+        raise ValueError("The msgpack encoding needs the msgpack package")
+    elif encoding != 'json-pretty':
+      raise ValueError("Unknown encoding {}".format(encoding))
+
+  def encode(self, data):
+    if self.encoding == 'json':
+      return ''.join(p + _json_value(data[n]) for p, n in zip(self._prefixes, self.names)) + '}'
+
+    elif self.encoding == 'json-pretty':
+      return json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '), default=str)
+
+    elif self.encoding == 'msgpack':
+      return msgpack.packb(dict((n, _plain_value(data[n])) for n in self.names))
+
+    elif self.encoding == 'binary':
+      if self.fields is None:
+        self._compile_binary(data)
+      return self._struct.pack(self.schema_id,
+                               *[f(data[n]) for f, n in zip(self._convert, self.fields)])
+
+  def _compile_binary(self, data):
+    # The numeric and datetime registers of the first sample fix the layout
+    self.fields   = []
+    self._convert = []
+    for n in self.names:
+      if isinstance(data[n], datetime):
+        self.fields.append(n)
+        self._convert.append(_epoch)
+      elif isinstance(data[n], _NUMBERS) and not isinstance(data[n], bool):
+        self.fields.append(n)
+        self._convert.append(_float)
+    self._struct   = struct.Struct('<I' + 'd' * len(self.fields))
+    self.schema_id = zlib.crc32(','.join(self.fields)) & 0xffffffff
+
+  def schema(self):
+    """Describes the binary layout, so consumers can decode the payload"""
+    if self.encoding != 'binary' or self.fields is None:
+      return None
+    return json.dumps({'id':     self.schema_id,
+                       'format': self._struct.format,
+                       'fields': ['schema_id'] + self.fields})
+
+class PVEncoderCache(object):
+  """Compiles an encoder the first time each register schema is seen"""
+
+  def __init__(self, encoding):
+    if encoding not in ENCODINGS:
+      raise ValueError("Unknown encoding {}".format(encoding))
+    if encoding == 'msgpack' and msgpack is None:
+      raise ValueError("The msgpack encoding needs the msgpack package")
+
+    self.encoding = encoding
+    self.encoders = {}
+
+  def get(self, data):
+    """Returns the encoder for the sample"""
+    names   = tuple(sorted(data))
+    encoder = self.encoders.get(names)
+    if encoder is None:
+      encoder = self.encoders[names] = PVEncoder(self.encoding, names)
+    return encoder
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVEncoder", "PVEncoderCache", "ENCODINGS", "text_value"
+]
+
+# vim: set expandtab ts=2 sw=2:
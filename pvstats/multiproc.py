@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Polling the inverters from several processes
+
+The inverters are split across worker processes, each running its own
+scheduler. The samples are encoded with pvstats.codec into a ring buffer in
+shared memory, and the main process drains the ring and publishes them to
+the reports, so every report connection exists only once.
+"""
+
+from pvstats.codec import encode_sample, decode_sample
+from pvstats.scheduler import PVScheduler
+
+import ctypes
+import multiprocessing
+import signal
+import struct
+import time
+
+import logging
+_log = logging.getLogger(__name__)
+
+# The worker and payload length at the start of every record
+_HEADER = struct.Struct('<HI')
+
+# The per worker counters in the shared stats array
+_SAMPLES = 0
+_BYTES   = 1
+_DROPPED = 2
+_STATS   = 3
+
+class PVSharedRing(object):
+  """A byte ring buffer in shared memory written by many processes
+
+  head and tail count every byte ever written and read, so the used space
+  is their difference and the buffer offset is the count modulo the size.
+  A writer finding the ring full waits up to its timeout for the reader,
+  then drops the sample.
+  """
+
+  def __init__(self, size, workers):
+    self.size  = int(size)
+    self.buf   = multiprocessing.RawArray('c', self.size)
+    self.head  = multiprocessing.RawValue(ctypes.c_uint64, 0)
+    self.tail  = multiprocessing.RawValue(ctypes.c_uint64, 0)
+    self.peak  = multiprocessing.RawValue(ctypes.c_uint64, 0)
+    self.stats = multiprocessing.RawArray('d', workers * _STATS)
+    self.cond  = multiprocessing.Condition()
+
+  def _write(self, pos, data):
+    pos   = pos % self.size
+    first = min(len(data), self.size - pos)
+    self.buf[pos:pos + first] = data[:first]
+    if first < len(data):
+      self.buf[0:len(data) - first] = data[first:]
+
+  def _read(self, pos, length):
+    pos   = pos % self.size
+    first = min(length, self.size - pos)
+    data  = self.buf[pos:pos + first]
+    if first < length:
+      data += self.buf[0:length - first]
+    return data
+
+  def put(self, worker, payload, timeout=1.0):
+    """Appends a record, returning False if it was dropped"""
+    record = _HEADER.pack(worker, len(payload)) + payload
+    if len(record) > self.size:
+      raise ValueError("A {} byte sample does not fit the ring".format(len(record)))
+
+    stats    = worker * _STATS
+    deadline = time.time() + timeout
+    with self.cond:
+      while self.size - (self.head.value - self.tail.value) < len(record):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          self.stats[stats + _DROPPED] += 1
+          return False
+        self.cond.wait(remaining)
+
+      self._write(self.head.value, record)
+      self.head.value += len(record)
+      self.peak.value  = max(self.peak.value, self.head.value - self.tail.value)
+      self.stats[stats + _SAMPLES] += 1
+      self.stats[stats + _BYTES]   += len(record)
+      self.cond.notify_all()
+    return True
+
+  def get(self, timeout=1.0):
+    """Takes every record in the ring, as a list of (worker, payload)"""
+    with self.cond:
+      if self.head.value == self.tail.value:
+        self.cond.wait(timeout)
+      length = self.head.value - self.tail.value
+      data   = self._read(self.tail.value, length)
+      self.tail.value += length
+      self.cond.notify_all()
+
+    records = []
+    offset  = 0
+    while offset < len(data):
+      worker, n = _HEADER.unpack_from(data, offset)
+      offset   += _HEADER.size
+      records.append((worker, data[offset:offset + n]))
+      offset   += n
+    return records
+
+  def used(self):
+    return self.head.value - self.tail.value
+
+  def worker_stats(self, worker):
+    base = worker * _STATS
+    return {'samples': int(self.stats[base + _SAMPLES]),
+            'bytes':   int(self.stats[base + _BYTES]),
+            'dropped': int(self.stats[base + _DROPPED])}
+
+class PVRingReport(object):
+  """The report of a worker process, writing the samples into the ring"""
+
+  def __init__(self, ring, worker, timeout=1.0):
+    self.ring    = ring
+    self.worker  = worker
+    self.timeout = timeout
+
+  def publish(self, data):
+    self.ring.put(self.worker, encode_sample(data), self.timeout)
+
+def shard_entries(entries, processes):
+  """Splits the inverter entries across at most processes shards
+
+  The inverters on one RS485 device stay together, so the bus is only opened
+  by one process and its PVRS485Bus arbitrates all their transactions. The
+  groups are dealt out largest first to the shard with the fewest inverters.
+  """
+  groups = []
+  buses  = {}
+  for entry in entries:
+    inv = entry[1]
+    if inv.get('mode') == 'rtu' and inv.get('dev'):
+      group = buses.get(inv['dev'])
+      if group is None:
+        group = buses[inv['dev']] = []
+        groups.append(group)
+      group.append(entry)
+    else:
+      groups.append([entry])
+
+  shards = [[] for _ in range(max(1, min(int(processes), len(groups))))]
+  for group in sorted(groups, key=len, reverse=True):
+    min(shards, key=len).extend(group)
+
+  # Poll each shard's inverters in the configured order
+  order = dict((id(entry), idx) for idx, entry in enumerate(entries))
+  return [sorted(shard, key=lambda e: order[id(e)]) for shard in shards]
+
+class PVWorkerPool(object):
+  """Polls the inverters from several processes
+
+  build(scheduler, entries) adds the inverters of the entries to a worker's
+  scheduler, and is called in the worker process, so the inverter
+  connections are only ever opened there.
+  """
+
+  def __init__(self, entries, processes, build, ring_bytes=4<<20, stats_interval=0):
+    self.shards = shard_entries(entries, processes)
+    processes   = len(self.shards)
+    self.build  = build
+
+    # How often each worker logs the stats of its inverters
+    self.stats_interval = float(stats_interval)
+    self.ring   = PVSharedRing(ring_bytes, processes)
+    self.procs  = []
+
+    # Set to stop the workers once their current reads are done
+    self.stopping = multiprocessing.Event()
+
+    self.published = 0
+    self._last     = (time.time(), [0] * processes)
+
+  def start(self):
+    for idx, shard in enumerate(self.shards):
+      proc = multiprocessing.Process(target=self._worker, args=(idx, shard),
+                                     name="pvstats-worker-{}".format(idx))
+      proc.daemon = True
+      proc.start()
+      self.procs.append(proc)
+
+  def _worker(self, idx, shard):
+    # The main process handles interrupts and stops the workers. systemd
+    # sends SIGTERM to every process of the service, which stops the worker
+    # between reads, and a second one terminates it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    terminated = []
+    def terminate(signum, frame):
+      terminated.append(signum)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, terminate)
+
+    scheduler = PVScheduler(stats_interval=self.stats_interval)
+    self.build(scheduler, shard)
+    scheduler.add_report(PVRingReport(self.ring, idx))
+
+    # Stopping the tasks rather than terminating the process, which could
+    # leave the ring locked
+    scheduler.start()
+    last_stats = time.time()
+    try:
+      while (not self.stopping.wait(1) and not terminated and
+             any(task.is_alive() for task in scheduler.tasks)):
+        if self.stats_interval > 0 and time.time() - last_stats >= self.stats_interval:
+          scheduler.log_stats()
+          last_stats = time.time()
+    finally:
+      scheduler.stop()
+      for task in scheduler.tasks:
+        task.join(10)
+
+  def drain(self, publish, timeout=1.0):
+    """Publishes the samples in the ring with publish(name, data)"""
+    for worker, payload in self.ring.get(timeout):
+      data = decode_sample(payload)
+      publish(data.get('inverter', ''), data)
+      self.published += 1
+
+  def stats(self):
+    """The samples per second of each worker since the last call, and the
+    ring occupancy
+    """
+    now, last = time.time(), self._last
+    elapsed   = max(now - last[0], 1e-9)
+    workers   = []
+    for idx in range(len(self.shards)):
+      stats = self.ring.worker_stats(idx)
+      stats['rate']  = (stats['samples'] - last[1][idx]) / elapsed
+      stats['alive'] = idx < len(self.procs) and self.procs[idx].is_alive()
+      workers.append(stats)
+    self._last = (now, [w['samples'] for w in workers])
+
+    return {'workers':   workers,
+            'published': self.published,
+            'ring_used': self.ring.used() / float(self.ring.size),
+            'ring_peak': self.ring.peak.value / float(self.ring.size)}
+
+  def log_stats(self):
+    stats = self.stats()
+    _log.info("Ring {:.1%} used, {:.1%} peak; ".format(stats['ring_used'], stats['ring_peak']) +
+              ", ".join("worker {} {:.1f} samples/s {} dropped{}".format(
+                        idx, w['rate'], w['dropped'], "" if w['alive'] else " (exited)")
+                        for idx, w in enumerate(stats['workers'])))
+
+  def run(self, publish, stats_interval=60, log_stats=None):
+    """Publishes the samples until every worker has exited
+
+    log_stats() is called along with the ring stats, to log those of the
+    reports.
+    """
+    last_stats = time.time()
+    while any(proc.is_alive() for proc in self.procs) or self.ring.used():
+      self.drain(publish)
+      if stats_interval and time.time() - last_stats >= stats_interval:
+        self.log_stats()
+        if log_stats is not None:
+          log_stats()
+        last_stats = time.time()
+
+  def stop(self, publish=None):
+    """Stops the workers, publishing what they left in the ring"""
+    self.stopping.set()
+    for proc in self.procs:
+      proc.join(15)
+      if proc.is_alive():
+        _log.warning("Terminating {}".format(proc.name))
+        proc.terminate()
+    if publish is not None:
+      self.drain(publish, timeout=0)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVSharedRing", "PVRingReport", "PVWorkerPool", "shard_entries"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prometheus exporter serving the latest sample of every inverter
+
+Each sample is formatted into exposition lines when it is published, and the
+whole response body is rebuilt from the lines of every inverter and swapped
+in as a single string. A scrape only writes out the current body, so it
+never waits on the sampling or formats anything itself.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import re
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+from pvstats.aggregate import sample_time
+
+import logging
+_log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metric name suffixes for the register units
+UNIT_SUFFIXES = {
+  'W':  'watts',
+  'kW': 'kilowatts',
+  'C':  'celsius',
+  'V':  'volts',
+  'A':  'amperes',
+  'Hz': 'hertz',
+}
+
+_NUMBERS = (int, long, float, Decimal)
+
+def metric_name(namespace, name, units=None):
+  """Builds a metric name from a register name and its units"""
+  name   = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+  suffix = UNIT_SUFFIXES.get(units)
+  if suffix and not name.endswith('_' + suffix):
+    name += '_' + suffix
+  return '{}_{}'.format(namespace, name) if namespace else name
+
+def _label_value(value):
+  return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+
+    body = self.server.exporter.body
+    self.send_response(200)
+    self.send_header('Content-Type', CONTENT_TYPE)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads      = True
+  allow_reuse_address = True
+
+class PVPrometheusExporter(object):
+  """Serves the latest registers of each inverter on /metrics"""
+
+  def __init__(self, host='', port=9520, namespace='pvstats', units=None, exclude=()):
+    self.namespace = namespace
+    self.units     = units or {}
+    self.exclude   = set(exclude)
+
+    # The exposition lines of each (inverter, device_id), by metric
+    self.sources = {}
+    self.body    = ''
+    self._names  = {}
+    self._lock   = threading.Lock()
+
+    self.server = _HTTPServer((host, port), _Handler)
+    self.server.exporter = self
+    self.thread = threading.Thread(target=self.server.serve_forever, name="pvstats-prometheus")
+    self.thread.daemon = True
+    self.thread.start()
+    _log.debug("Serving metrics on port {}".format(self.server.server_address[1]))
+
+  @property
+  def port(self):
+    return self.server.server_address[1]
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def _metric(self, name):
+    metric = self._names.get(name)
+    if metric is None:
+      metric = self._names[name] = metric_name(self.namespace, name, self.units.get(name))
+    return metric
+
+  def update(self, data):
+    """Replaces the metrics of the sample's inverter"""
+    source = (data.get('inverter', ''), data.get('device_id'))
+    labels = u'inverter="{}"'.format(_label_value(source[0]))
+    if source[1] is not None:
+      labels += u',device_id="{}"'.format(_label_value(source[1]))
+
+    lines = {}
+    for k, v in data.iteritems():
+      if k in self.exclude or k in ('inverter', 'device_id') or isinstance(v, bool):
+        continue
+      if isinstance(v, _NUMBERS):
+        lines[self._metric(k)] = u'{}{{{}}} {!r}\n'.format(self._metric(k), labels, float(v))
+      elif isinstance(v, datetime) and k == 'timestamp':
+        metric = self._metric('sample_timestamp_seconds')
+        lines[metric] = u'{}{{{}}} {!r}\n'.format(metric, labels, sample_time(data))
+
+    with self._lock:
+      self.sources[source] = lines
+
+      # Every series of a metric has to be listed together
+      body = []
+      for metric in sorted(set().union(*self.sources.values())):
+        body.append(u'# TYPE {} gauge\n'.format(metric))
+        body.extend(self.sources[s][metric] for s in sorted(self.sources) if metric in self.sources[s])
+      self.body = u''.join(body).encode('utf-8')
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVPrometheusExporter", "metric_name", "UNIT_SUFFIXES"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -16,23 +16,154 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from pvstats.pvinverter.record import PVRecord, PVSchema
+
+from datetime import datetime
+from decimal import Decimal
+import time
+
 from pymodbus.constants import Defaults
 from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.transaction import ModbusSocketFramer
 
+class PVReconnectPending(IOError):
+  """Raised by acquire while a persistent connection waits out its backoff"""
+  pass
+
 class BasePVInverter(object):
-  def __init__(self):
-    self.registers = {}
+  def __init__(self, cfg=None):
+    if cfg is None:
+      cfg = {}
+
+    # In the default decimal mode registers are Decimals held in a dict. The
+    # float mode trades the exact decimal scaling for plain floats held in a
+    # PVRecord, which is much cheaper to decode into and publish.
+    self.numeric = cfg.get('numeric', 'decimal')
+    if self.numeric not in ('float', 'decimal'):
+      raise ValueError("Unknown numeric mode {}".format(self.numeric))
+    self._schema   = PVSchema()
+    self.registers = self.new_registers()
+
+    # Connection lifecycle. By default the connection is opened and closed
+    # around every read, in persistent mode it is kept open across reads and
+    # only reopened, with an exponential backoff, after a failure.
+    self.persistent    = bool(cfg.get('persistent', False))
+    self.reconnect_min = float(cfg.get('reconnect_min', 1))
+    self.reconnect_max = float(cfg.get('reconnect_max', 300))
+
+    self.connects      = 0
+    self.reconnects    = 0
+    self.connected_at  = None
+    self._backoff      = 0
+    self._retry_at     = 0
+    self._pending      = False
+
+    # Records the raw frames of every read when set
+    self.recorder = None
 
   def connect(self): pass
   def read(self): pass
   def close(self): pass
 
+  def new_registers(self):
+    """Returns an empty register set for the numeric mode"""
+    if self.numeric == 'float':
+      return PVRecord(self._schema)
+    return {}
+
+  def samples(self):
+    """The register sets produced by the last read
+
+    Most inverters produce a single set, but an inverter reading several
+    devices at once produces one per device, tagged with its device_id.
+    """
+    return [self.registers]
+
+  def number(self, value, places=None):
+    """Converts a value to the numeric mode, optionally rounding it"""
+    if self.numeric == 'float':
+      value = float(value)
+      return value if places is None else round(value, places)
+
+    # Go through repr so 407.8 becomes Decimal('407.8') rather than its
+    # exact binary expansion
+    if isinstance(value, float):
+      value = repr(value)
+    value = Decimal(value)
+    return value if places is None else value.quantize(Decimal(1).scaleb(-places))
+
+  def now(self):
+    """The time of the read, for the inverters without a clock of their own"""
+    return datetime.now()
+
+  def next_due(self):
+    """When an inverter pacing its own reads is next due, otherwise None"""
+    return None
+
+  def set_recorder(self, recorder):
+    self.recorder = recorder
+
+  def is_connected(self):
+    return self.connected_at is not None
+
+  def connection_age(self):
+    """Seconds since the current connection was opened, None if closed"""
+    if self.connected_at is None:
+      return None
+    return time.time() - self.connected_at
+
+  def acquire(self):
+    """Makes sure the inverter is connected before a read"""
+    if not (self.persistent and self.is_connected()):
+      self._connect()
+
+    if self.recorder is not None:
+      self.recorder.cycle()
+
+  def _connect(self):
+    now = time.time()
+    if now < self._retry_at:
+      # Not a failed attempt, so release leaves the backoff alone
+      self._pending = True
+      raise PVReconnectPending("Waiting {:.1f}s before reconnecting".format(self._retry_at - now))
+
+    if self.connects > 0 and self.persistent:
+      self.reconnects += 1
+
+    self.connected_at = now
+    self.connects    += 1
+    self.connect()
+
+  def release(self, failed=False):
+    """Releases the connection after a read, keeping it open if persistent"""
+    if self._pending:
+      # No connect was attempted, the first poll at or after the retry time
+      # gets to try
+      self._pending = False
+      return
+
+    if not failed:
+      self._backoff = 0
+      if self.persistent:
+        return
+
+    self.connected_at = None
+    self.close()
+
+    if failed and self.persistent:
+      self._backoff  = min(max(self._backoff * 2, self.reconnect_min), self.reconnect_max)
+      self._retry_at = time.time() + self._backoff
+
+  def stats(self):
+    return {'connects':       self.connects,
+            'reconnects':     self.reconnects,
+            'connection_age': self.connection_age()}
+
 #-----------------
 # Exported symbols
 #-----------------
 __all__ = [
-  "BasePVInverter"
+  "BasePVInverter", "PVReconnectPending"
 ]
 
 # vim: set expandtab ts=2 sw=2:
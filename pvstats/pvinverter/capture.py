@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Recording the raw frames read from an inverter
+
+A frame file starts with a magic line and a JSON line holding the model and
+configuration of the recorded inverter, followed by binary frames
+
+    time (double), kind (byte), payload length (uint32), payload
+
+all little endian. The kinds are
+
+    CYCLE   the start of a read cycle, with no payload
+    MODBUS  a register read, the function (0 input, 1 holding), the 0 based
+            start address and the registers as 16 bit words
+    HTTP    a web request, the path length, the path and the response body
+    ERROR   a failed read, the error message
+
+Files ending in .gz are compressed. Recording appends to an existing file
+under its original header, and a file cut short by a crash reads back up to
+its last whole frame.
+"""
+
+import atexit
+import gzip
+import json
+import os
+import struct
+import threading
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+MAGIC = 'PVFRAMES 1\n'
+
+CYCLE  = 0
+MODBUS = 1
+HTTP   = 2
+ERROR  = 3
+
+FUNCS = ('input', 'holding')
+
+_FRAME  = struct.Struct('<dBI')
+_MODBUS = struct.Struct('<BH')
+_HTTP   = struct.Struct('<H')
+
+def _open(path, mode):
+  if path.endswith('.gz'):
+    return gzip.open(path, mode)
+  return open(path, mode)
+
+class PVFrameRecorder(object):
+  """Appends the raw frames of one inverter to a file"""
+
+  def __init__(self, path, model, cfg=None, flush_interval=10):
+    self.path           = path
+    self.flush_interval = float(flush_interval)
+    self.frames         = 0
+
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    self._file       = _open(path, 'ab')
+    self._lock       = threading.Lock()
+    self._flushed_at = time.time()
+
+    if new:
+      cfg = dict((k, v) for k, v in (cfg or {}).iteritems() if k != 'record')
+      self._file.write(MAGIC)
+      self._file.write(json.dumps({'model': model, 'cfg': cfg, 'created': time.time()},
+                                  sort_keys=True, default=str) + '\n')
+
+    # Make sure the buffered frames and the gzip trailer are written out
+    atexit.register(self.close)
+
+  def _write(self, kind, payload=''):
+    with self._lock:
+      if self._file is None:
+        return
+      self._file.write(_FRAME.pack(time.time(), kind, len(payload)))
+      self._file.write(payload)
+      self.frames += 1
+
+  def cycle(self):
+    """Marks the start of a read cycle, flushing the file now and then"""
+    self._write(CYCLE)
+    if time.time() - self._flushed_at >= self.flush_interval:
+      self.flush()
+
+  def modbus(self, func, start, registers):
+    self._write(MODBUS, _MODBUS.pack(FUNCS.index(func), start) +
+                        struct.pack('<{}H'.format(len(registers)), *registers))
+
+  def http(self, path, body):
+    self._write(HTTP, _HTTP.pack(len(path)) + path + body)
+
+  def error(self, err):
+    self._write(ERROR, unicode(err).encode('utf-8'))
+
+  def flush(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.flush()
+      self._flushed_at = time.time()
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+class PVFrameReader(object):
+  """Reads back a frame file, one frame at a time
+
+  Each frame is returned as (time, kind, value), where the value is
+  (func, start, registers) for MODBUS, (path, body) for HTTP, the message
+  for ERROR and None for CYCLE.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      compressed = f.read(2) == '\x1f\x8b'
+    self._file = gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+    if self._file.readline() != MAGIC:
+      raise ValueError("{} is not a pvstats frame file".format(path))
+    header     = json.loads(self._file.readline())
+    self.model = str(header['model'])
+    self.cfg   = header['cfg']
+
+    self._next = None
+
+  def close(self):
+    self._file.close()
+
+  def _read(self):
+    try:
+      head = self._file.read(_FRAME.size)
+      if len(head) < _FRAME.size:
+        return None
+      when, kind, length = _FRAME.unpack(head)
+      payload = self._file.read(length)
+    except (IOError, EOFError) as err:
+      # A compressed file which was not closed cleanly
+      _logger.warning("{}: {}".format(self.path, err))
+      return None
+    if len(payload) < length:
+      return None
+
+    if kind == MODBUS:
+      func, start = _MODBUS.unpack_from(payload)
+      count       = (length - _MODBUS.size) // 2
+      value = (FUNCS[func], start, struct.unpack_from('<{}H'.format(count), payload, _MODBUS.size))
+    elif kind == HTTP:
+      n,    = _HTTP.unpack_from(payload)
+      value = (payload[_HTTP.size:_HTTP.size + n], payload[_HTTP.size + n:])
+    elif kind == ERROR:
+      value = payload.decode('utf-8')
+    else:
+      value = None
+    return when, kind, value
+
+  def peek(self):
+    """The next frame without consuming it, None at the end of the file"""
+    if self._next is None:
+      self._next = self._read()
+    return self._next
+
+  def next(self):
+    frame      = self.peek()
+    self._next = None
+    if frame is None:
+      raise EOFError("End of {}".format(self.path))
+    return frame
+
+  def __iter__(self):
+    while self.peek() is not None:
+      yield self.next()
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVFrameRecorder", "PVFrameReader", "CYCLE", "MODBUS", "HTTP", "ERROR"
+]
+
+# vim: set expandtab ts=2 sw=2:
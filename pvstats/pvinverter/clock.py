@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tracking an inverter's clock without reading it every cycle
+
+The inverter clock is read now and then, and its offset from the host's
+monotonic clock is kept, so the samples in between are stamped in inverter
+time locally. Each read compares the inverter clock with where it was
+expected to be. The difference is the drift since the last read, which
+also refines the estimated drift rate, and a drift past max_drift shortens
+the time until the next read.
+"""
+
+from datetime import datetime
+import ctypes
+import os
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+class _timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime():
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    func = libc.clock_gettime
+  except (OSError, AttributeError):
+    return None
+  func.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+  CLOCK_MONOTONIC = 1
+  def monotonic():
+    ts = _timespec()
+    if func(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+  return monotonic
+
+# Seconds from an arbitrary start, which never step with the wall clock
+monotonic = getattr(time, 'monotonic', None) or _clock_gettime() or time.time
+
+class PVInverterClock(object):
+  """The offset and drift of an inverter's clock from the host's
+
+  The time is seconds since the epoch, in the inverter's local time as the
+  date registers hold it. source is the steady clock it is kept against.
+  """
+
+  # The drift rate is only estimated over long enough spans for the whole
+  # second resolution of the inverter clock not to swamp it
+  RATE_SPAN = 1800
+
+  def __init__(self, interval=3600, max_drift=2, min_interval=60, step=60, source=monotonic):
+    self.source       = source
+    self.interval     = float(interval)
+    self.max_drift    = float(max_drift)
+    self.min_interval = float(min_interval)
+    self.step         = float(step)
+
+    self.offset    = None
+    self.rate      = 0.0
+    self.synced_at = None
+    self.check     = self.interval
+
+    self.syncs = 0
+    self.steps = 0
+    self.drift = 0.0
+
+  def due(self, now=None):
+    """True once the inverter clock should be read again"""
+    if self.synced_at is None:
+      return True
+    now = self.source() if now is None else now
+    return now - self.synced_at >= self.check
+
+  def time(self, now=None):
+    now = self.source() if now is None else now
+    return now + self.offset + self.rate * (now - self.synced_at)
+
+  def now(self):
+    return datetime.fromtimestamp(self.time())
+
+  def offset_from_host(self):
+    """Seconds the inverter clock is ahead of the host's wall clock"""
+    return self.time() - time.time()
+
+  def sync(self, inverter_time, sent, received):
+    """Takes an inverter clock reading, read between the monotonic times
+    sent and received
+    """
+    # The reading is taken halfway through the round trip, and the clock
+    # registers hold whole seconds, so it is half a second on on average
+    now      = (sent + received) / 2
+    measured = inverter_time + 0.5
+
+    if self.synced_at is not None:
+      elapsed = now - self.synced_at
+      drift   = measured - self.time(now)
+      if abs(drift) >= self.step:
+        # The inverter clock was set, start over
+        _logger.warning("The inverter clock stepped by {:.0f}s".format(drift))
+        self.steps += 1
+        self.rate   = 0.0
+        self.check  = self.interval
+      else:
+        self.drift = drift
+        if elapsed >= self.RATE_SPAN:
+          self.rate += 0.5 * drift / elapsed
+        if abs(drift) > self.max_drift:
+          _logger.warning("The inverter clock drifted {:.1f}s in {:.0f}s".format(drift, elapsed))
+          self.check = max(self.check / 2, self.min_interval)
+        else:
+          self.check = min(self.check * 2, self.interval)
+
+    self.offset    = measured - now
+    self.synced_at = now
+    self.syncs    += 1
+    _logger.debug("Inverter clock synced, drift {:.2f}s, rate {:.1f}ppm, next in {:.0f}s".format(
+                  self.drift, self.rate * 1e6, self.check))
+
+  def stats(self):
+    return {'clock_syncs':     self.syncs,
+            'clock_steps':     self.steps,
+            'clock_drift':     self.drift,
+            'clock_drift_ppm': self.rate * 1e6,
+            'clock_offset':    self.offset_from_host() if self.synced_at is not None else None}
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVInverterClock", "monotonic"
+]
+
+# vim: set expandtab ts=2 sw=2:
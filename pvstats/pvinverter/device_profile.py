@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Modbus device profiles and the read plans compiled from them
+
+A profile is a JSON file describing the registers of one inverter model
+
+    {"model": "sungrow-sg5ktl", "word_order": "big",
+     "registers": {"input": [{"address": 5017, "name": "total_pv_power",
+                              "type": "U16", "scale": "1", "units": "W"}, ...],
+                   "holding": [...]}}
+
+Addresses are 1 based, as in the manufacturers' documents. The types are
+U16, S16, U32 and S32, with the 32 bit types spanning two registers in the
+profile's word order, "big" for the high word first or "little" for the
+low word first. A register with a "scale" is multiplied by it, as a Decimal
+or a float depending on the numeric mode, otherwise it stays an integer. A
+register with an "enum" maps its raw values to names.
+
+The profiles shipped with pvstats are in the profiles directory next to
+this module, and any other file can be given by its path.
+"""
+
+from decimal import Decimal
+import json
+import operator
+import os
+import struct
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+# Modbus limits a single register read to 125 registers
+MODBUS_MAX_COUNT = 125
+
+# The struct code and width in registers of each type
+TYPES = {
+  'U16': ('H', 1),
+  'S16': ('h', 1),
+  'U32': ('I', 2),
+  'S32': ('i', 2),
+}
+
+def profile_path(name):
+  """The file of a profile given by name or path, None if there is none"""
+  if os.path.isfile(name):
+    return name
+  path = os.path.join(PROFILE_DIR, name + '.json')
+  return path if os.path.isfile(path) else None
+
+def load_profile(name):
+  path = profile_path(name)
+  if path is None:
+    raise ValueError("Unable to find the device profile {}".format(name))
+  with open(path) as f:
+    return json.load(f)
+
+def register_map(profile):
+  """Converts a profile to a register map keyed by the 1 based address"""
+  regmap = {}
+  for func, regs in profile['registers'].iteritems():
+    regmap[func] = {}
+    for reg in regs:
+      rtype = reg.get('type', 'U16')
+      if rtype not in TYPES:
+        raise ValueError("Unknown register type {} of {}".format(rtype, reg['name']))
+
+      entry = {'name': str(reg['name']), 'type': rtype, 'units': str(reg.get('units', ''))}
+      entry['scale'] = Decimal(str(reg['scale'])) if 'scale' in reg else 1
+      if 'enum' in reg:
+        entry['enum'] = dict((int(k), v) for k, v in reg['enum'].iteritems())
+      regmap[func][str(reg['address'])] = entry
+  return regmap
+
+class ModbusReadSpan(object):
+  """A single contiguous register read and the decoder of its fields
+
+  The registers are packed back into bytes and every field is unpacked by
+  one precompiled struct, skipping the unused registers, then the scales
+  are applied in a single pass. The cost is per field rather than per
+  register read.
+  """
+  __slots__ = ('func', 'start', 'count', 'fields', 'names', 'scales', 'enums',
+               '_pack', '_unpack')
+
+  def __init__(self, func, start, count, fields, word_order='big'):
+    self.func   = func
+    self.start  = start
+    self.count  = count
+    self.fields = fields
+
+    # Each field is (offset, name, scale, type, enum), in offset order
+    endian = '>' if word_order == 'big' else '<'
+    fmt    = endian
+    pos    = 0
+    for offset, name, scale, rtype, enum in fields:
+      if offset < pos:
+        raise ValueError("Register {} overlaps the one before it".format(name))
+      code, width = TYPES[rtype]
+      if offset > pos:
+        fmt += '{}x'.format((offset - pos) * 2)
+      fmt += code
+      pos  = offset + width
+    if pos > count:
+      raise ValueError("Register {} runs past the end of the read".format(fields[-1][1]))
+    if count > pos:
+      fmt += '{}x'.format((count - pos) * 2)
+
+    self.names   = tuple(f[1] for f in fields)
+    self.scales  = tuple(f[2] for f in fields)
+    self.enums   = tuple((i, f[4]) for i, f in enumerate(fields) if f[4])
+    self._pack   = struct.Struct('{}{}H'.format(endian, count)).pack
+    self._unpack = struct.Struct(fmt).unpack
+
+  def decode(self, registers):
+    """Returns the (name, value) pairs of the read registers"""
+    raw    = self._unpack(self._pack(*registers))
+    values = map(operator.mul, raw, self.scales)
+    for idx, enum in self.enums:
+      values[idx] = enum.get(raw[idx], raw[idx])
+    return zip(self.names, values)
+
+  def __repr__(self):
+    return "ModbusReadSpan({}, {}, {})".format(self.func, self.start, self.count)
+
+def plan_reads(register_map, max_gap=10, max_count=MODBUS_MAX_COUNT, numeric='decimal',
+               word_order='big'):
+  """Plans the fewest register reads covering every register in the map
+
+  Registers closer together than max_gap are merged into a single read, as
+  long as the read stays within max_count registers. In the float numeric
+  mode the Decimal scales are converted to floats up front.
+  """
+  plan = []
+  for func in sorted(register_map):
+    # The register map uses 1 based addresses, the wire protocol 0 based
+    regs = sorted((int(k) - 1, reg) for k, reg in register_map[func].iteritems())
+
+    spans = []
+    for addr, reg in regs:
+      end = addr + TYPES[reg.get('type', 'U16')][1]
+      if (spans and addr - spans[-1][1] <= max_gap and
+          end - spans[-1][0] <= max_count):
+        spans[-1][1] = max(spans[-1][1], end)
+        spans[-1][2].append((addr, reg))
+      else:
+        spans.append([addr, end, [(addr, reg)]])
+
+    for start, end, members in spans:
+      fields = []
+      for addr, reg in members:
+        scale = reg['scale']
+        if numeric == 'float' and isinstance(scale, Decimal):
+          scale = float(scale)
+        fields.append((addr - start, reg['name'], scale, reg.get('type', 'U16'), reg.get('enum')))
+      plan.append(ModbusReadSpan(func, start, end - start, tuple(fields), word_order))
+
+  return plan
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "load_profile", "profile_path", "register_map", "plan_reads", "ModbusReadSpan",
+  "MODBUS_MAX_COUNT", "TYPES", "PROFILE_DIR"
+]
+
+# vim: set expandtab ts=2 sw=2:
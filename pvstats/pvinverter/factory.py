@@ -16,9 +16,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime
-from decimal import *
-
 from pymodbus.constants import Defaults
 from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.transaction import ModbusSocketFramer
@@ -27,26 +24,40 @@ from pvstats.pvinverter.fronius import PVInverter_Fronius
 from pvstats.pvinverter.solax import PVInverter_Solax
 from pvstats.pvinverter.sungrow_sg5ktl import PVInverter_SunGrow, PVInverter_SunGrowRTU
 from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.capture import PVFrameRecorder
+from pvstats.pvinverter.replay import PVInverter_Replay
+from pvstats.pvinverter.device_profile import profile_path
 
 from random import randint
 
 class PVInverter_Test(BasePVInverter):
-  def __init__(self): pass
+  def __init__(self, cfg):
+    super(PVInverter_Test, self).__init__(cfg)
+
   def connect(self): pass
   def read(self):
-    self.registers = {'timestamp':datetime.now(),
-                      'daily_pv_power':Decimal('2300') + randint(0,1000),
-                      'total_pv_power':Decimal('2100') + randint(0,1000),
-                      'internal_temp': Decimal('41.2') + randint(0,10),
-                      'pv1_voltage':   Decimal('213')  + randint(0,30),
-                      'pv2_voltage':   Decimal('125')  + randint(0,20)}
+    r = self.registers
+    r['timestamp']      = self.now()
+    r['daily_pv_power'] = self.number(2300 + randint(0,1000))
+    r['total_pv_power'] = self.number(2100 + randint(0,1000))
+    r['internal_temp']  = self.number('41.2') + randint(0,10)
+    r['pv1_voltage']    = self.number(213  + randint(0,30))
+    r['pv2_voltage']    = self.number(125  + randint(0,20))
 
   def close(self): pass
 
 # Factory class for the PV Inverter
 def PVInverterFactory(model, cfg):
+  inverter = _create(model, cfg)
+
+  # Record the raw frames of every read for replaying later
+  if cfg.get('record'):
+    inverter.set_recorder(PVFrameRecorder(cfg['record'], model, cfg))
+  return inverter
+
+def _create(model, cfg):
   if (model == "test"):
-    return PVInverter_Test()
+    return PVInverter_Test(cfg)
   elif (model == "sungrow-sg5ktl" and cfg['mode'] == 'rtu'):
     return PVInverter_SunGrowRTU(cfg)
   elif (model == "sungrow-sg5ktl"):
@@ -58,6 +69,14 @@ def PVInverterFactory(model, cfg):
   elif (model == "solax"):
     # Assume TCP
     return PVInverter_Solax(cfg)
+  elif (model == "replay"):
+    return PVInverter_Replay(cfg, PVInverterFactory)
+  elif (profile_path(model) is not None):
+    # Any other Modbus model described by a device profile
+    cfg = dict(cfg, profile=cfg.get('profile', model))
+    if cfg.get('mode') == 'rtu':
+      return PVInverter_SunGrowRTU(cfg)
+    return PVInverter_SunGrow(cfg)
   else:
     raise ValueError("Unable to find PVInverter for {}".format(model))
 
@@ -14,111 +14,74 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.httpbase import BaseHTTPPVInverter
 
 from datetime import datetime
-from decimal import *
-import urllib2
 import json
 
 import logging
 _logger = logging.getLogger(__name__)
 
-class PVInverter_Fronius(BasePVInverter):
+class PVInverter_Fronius(BaseHTTPPVInverter):
   def __init__(self, cfg, **kwargs):
-    self.url = "http://{}:{}/solar_api/v1/GetInverterRealtimeData.cgi?Scope=Device&DeviceID=1&DataCollection=CommonInverterData".format(cfg["host"],cfg["port"])
+    super(PVInverter_Fronius, self).__init__(cfg)
 
-  def connect(self):
-    pass
+    # The system scope reads every inverter behind the datamanager at once
+    self.scope = cfg.get('scope', 'device')
+    if self.scope == 'system':
+      self.path = "/solar_api/v1/GetInverterRealtimeData.cgi?Scope=System"
+    elif self.scope == 'device':
+      self.path = "/solar_api/v1/GetInverterRealtimeData.cgi?Scope=Device&DeviceID={}&DataCollection=CommonInverterData".format(cfg.get('device_id', 1))
+    else:
+      raise ValueError("Unknown Fronius scope {}".format(self.scope))
 
-  def close(self):
-    pass
+    self.devices = {}
 
   def read(self):
     """Reads the PV inverters status"""
 
-    # Dummy data
-    response = """
-{
-  "Body": {
-    "Data": {
-      "DAY_ENERGY": {
-        "Unit": "Wh",
-        "Value": 55550
-      },
-      "DeviceStatus": {
-        "ErrorCode": 567,
-        "LEDColor": 2,
-        "LEDState": 0,
-        "MgmtTimerRemainingTime": -1,
-        "StateToReset": true,
-        "StatusCode": 7
-      },
-      "FAC": {
-        "Unit": "Hz",
-        "Value": 50.03
-      },
-      "IAC": {
-        "Unit": "A",
-        "Value": 16.27
-      },
-      "IDC": {
-        "Unit": "A",
-        "Value": 9.74
-      },
-      "PAC": {
-        "Unit": "W",
-        "Value": 4051
-      },
-      "TOTAL_ENERGY": {
-        "Unit": "Wh",
-        "Value": 14272110
-      },
-      "UAC": {
-        "Unit": "V",
-        "Value": 245.6
-      },
-      "UDC": {
-        "Unit": "V",
-        "Value": 407.8
-      },
-      "YEAR_ENERGY": {
-        "Unit": "Wh",
-        "Value": 2512712
-      }
-    }
-  },
-  "Head": {
-    "RequestArguments": {
-      "DataCollection": "CommonInverterData",
-      "DeviceClass": "Inverter",
-      "DeviceId": "1",
-      "Scope": "Device"
-    },
-    "Status": {
-      "Code": 0,
-      "Reason": "",
-      "UserMessage": ""
-    },
-    "Timestamp": "2019-02-10T17:23:28+11:00"
-  }
-}
-"""
-
-    response = urllib2.urlopen(self.url).read()
-    data = json.loads(response)
-    d = json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '),default=str)
-    print d
-
-    self.registers = {'timestamp':     datetime.strptime(data['Head']['Timestamp'][:-6], "%Y-%m-%dT%H:%M:%S"),
-                      'daily_pv_power':Decimal(data['Body']['Data']['DAY_ENERGY']['Value']),
-                      'total_pv_power':Decimal(data['Body']['Data']['PAC']['Value']),
-                      #'internal_temp': Decimal(data['Body']['Data']['T_AMBIENT']['Value']).quantize(Decimal('.1')),
-                      'internal_temp': Decimal(0),
-                      'pv1_voltage':   Decimal(data['Body']['Data']['UDC']['Value']),
-                      'pv2_voltage':   Decimal('0')}
-
-    print self.registers
+    data = json.loads(self.fetch(self.path))
+    if self.scope == 'system':
+      self._read_system(data)
+      return
+
+    r = self.registers
+    r['timestamp']      = datetime.strptime(data['Head']['Timestamp'][:-6], "%Y-%m-%dT%H:%M:%S")
+    r['daily_pv_power'] = self.number(data['Body']['Data']['DAY_ENERGY']['Value'])
+    r['total_pv_power'] = self.number(data['Body']['Data']['PAC']['Value'])
+    #r['internal_temp'] = self.number(data['Body']['Data']['T_AMBIENT']['Value'], 1)
+    r['internal_temp']  = self.number(0)
+    r['pv1_voltage']    = self.number(data['Body']['Data']['UDC']['Value'])
+    r['pv2_voltage']    = self.number(0)
+
+  def _read_system(self, data):
+    """Splits a system scope response into a register set per device"""
+    timestamp = datetime.strptime(data['Head']['Timestamp'][:-6], "%Y-%m-%dT%H:%M:%S")
+    body      = data['Body']['Data']
+    pac       = body['PAC']['Values']
+    energy    = body.get('DAY_ENERGY', {}).get('Values', {})
+    udc       = body.get('UDC', {}).get('Values', {})
+
+    # Drop the devices which are no longer reported
+    for device in set(self.devices) - set(pac):
+      del self.devices[device]
+
+    for device in pac:
+      r = self.devices.get(device)
+      if r is None:
+        r = self.devices[device] = self.new_registers()
+      r['device_id']      = device
+      r['timestamp']      = timestamp
+      r['daily_pv_power'] = self.number(energy.get(device, 0))
+      r['total_pv_power'] = self.number(pac[device])
+      r['internal_temp']  = self.number(0)
+      r['pv1_voltage']    = self.number(udc.get(device, 0))
+      r['pv2_voltage']    = self.number(0)
+
+  def samples(self):
+    if self.scope == 'system':
+      return [self.devices[d] for d in sorted(self.devices)]
+    return [self.registers]
 
 
 #-----------------
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Copyright 2019 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pvstats.pvinverter.base import BasePVInverter
+from pvstats.timing import profiler
+
+import httplib
+import socket
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+class PVHTTPTransport(object):
+  """A keep-alive HTTP connection to an inverter's web server"""
+
+  def __init__(self, host, port=80, connect_timeout=3, read_timeout=10, max_response=1<<20):
+    self.host            = host
+    self.port            = port
+    self.connect_timeout = connect_timeout
+    self.read_timeout    = read_timeout
+    self.max_response    = max_response
+
+    self.conn     = None
+    self._reused  = False
+    self.recorder = None
+
+    self.requests      = 0
+    self.failures      = 0
+    self.connects      = 0
+    self.latency_last  = 0.0
+    self.latency_max   = 0.0
+    self.latency_total = 0.0
+    self._stage        = "http.{}:{}".format(host, port)
+
+  def _connect(self):
+    self.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+    self.conn.connect()
+    self.conn.sock.settimeout(self.read_timeout)
+    self.connects += 1
+    self._reused   = False
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
+
+  def get(self, path):
+    """Fetches path, returning the response body"""
+    tstart = time.time()
+    try:
+      body = self._get(path)
+      if self.recorder is not None:
+        self.recorder.http(path, body)
+      return body
+    except Exception as err:
+      self.failures += 1
+      self.close()
+      if self.recorder is not None:
+        self.recorder.error(err)
+      raise
+    finally:
+      self.requests      += 1
+      self.latency_last   = time.time() - tstart
+      self.latency_max    = max(self.latency_max, self.latency_last)
+      self.latency_total += self.latency_last
+      profiler.record(self._stage, self.latency_last)
+
+  def _get(self, path):
+    while True:
+      if self.conn is None:
+        self._connect()
+
+      try:
+        self.conn.request('GET', path, headers={'Connection': 'keep-alive'})
+        response = self.conn.getresponse()
+        break
+      except (httplib.HTTPException, socket.error):
+        # The server may have closed an idle keep-alive connection, in which
+        # case try again on a fresh one
+        if not self._reused:
+          raise
+        _logger.debug("Reconnecting to {}:{}".format(self.host, self.port))
+        self.close()
+
+    length = response.getheader('content-length')
+    if length is not None and int(length) > self.max_response:
+      raise IOError("Response of {} bytes is too large".format(length))
+
+    body = response.read(self.max_response + 1)
+    if len(body) > self.max_response:
+      raise IOError("Response is larger than {} bytes".format(self.max_response))
+
+    if response.status != 200:
+      raise IOError("HTTP {} {} from {}".format(response.status, response.reason, path))
+
+    if response.will_close:
+      self.close()
+    else:
+      self._reused = True
+
+    return body
+
+  def stats(self):
+    return {'requests':     self.requests,
+            'failures':     self.failures,
+            'http_connects':self.connects,
+            'latency_last': self.latency_last,
+            'latency_max':  self.latency_max,
+            'latency_avg':  self.latency_total / max(self.requests, 1)}
+
+class BaseHTTPPVInverter(BasePVInverter):
+  """Base for the inverters read through their built in web server
+
+  A new connection is opened for every read unless "persistent" is turned
+  on, which keeps it alive between reads and only reopens it after a failure.
+  """
+
+  def __init__(self, cfg):
+    super(BaseHTTPPVInverter, self).__init__(cfg)
+
+    self.transport = PVHTTPTransport(cfg['host'], cfg.get('port', 80),
+                                     connect_timeout = float(cfg.get('connect_timeout', 3)),
+                                     read_timeout    = float(cfg.get('read_timeout', 10)),
+                                     max_response    = int(cfg.get('max_response', 1<<20)))
+
+  def connect(self):
+    pass
+
+  def close(self):
+    self.transport.close()
+
+  def set_recorder(self, recorder):
+    super(BaseHTTPPVInverter, self).set_recorder(recorder)
+    self.transport.recorder = recorder
+
+  def fetch(self, path):
+    return self.transport.get(path)
+
+  def stats(self):
+    stats = super(BaseHTTPPVInverter, self).stats()
+    stats.update(self.transport.stats())
+    return stats
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVHTTPTransport", "BaseHTTPPVInverter"
+]
+
+# vim: set expandtab ts=2 sw=2:
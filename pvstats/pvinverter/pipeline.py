@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pipelined Modbus TCP register reads
+
+Every Modbus TCP request carries a transaction id in its MBAP header, which
+the device echoes in its response, so several requests can be outstanding
+on one connection and matched up as the responses arrive. A cycle of reads
+then takes about one round trip rather than one per read.
+
+Not every device copes with more than one outstanding request, so at most
+max_inflight are sent on each connection, and the reads can be spread over
+a small pool of connections instead, for the devices which serve each
+connection in turn.
+"""
+
+import select
+import socket
+import struct
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# The transaction id, protocol id, length and unit id
+_MBAP = struct.Struct('>HHHB')
+
+# The function, start address and count of a read request
+_READ = struct.Struct('>BHH')
+
+FUNCTIONS = {
+  'holding': 3,
+  'input':   4,
+}
+
+class _Connection(object):
+  __slots__ = ('sock', 'buf', 'inflight')
+
+  def __init__(self, sock):
+    self.sock     = sock
+    self.buf      = ''
+    self.inflight = {}
+
+class PVModbusPipeline(object):
+  """Reads register blocks with many requests in flight at once"""
+
+  def __init__(self, host, port=502, unit=1, timeout=3, max_inflight=4, connections=1):
+    self.host         = host
+    self.port         = port
+    self.unit         = unit
+    self.timeout      = float(timeout)
+    self.max_inflight = max(1, int(max_inflight))
+    self.size         = max(1, int(connections))
+
+    self.conns = []
+    self._tid  = 0
+
+    self.requests     = 0
+    self.timeouts     = 0
+    self.cycles       = 0
+    self.cycle_last   = 0.0
+    self.inflight_max = 0
+
+  @property
+  def socket(self):
+    # Matches pymodbus, which drops the socket once the connection is lost
+    return self.conns[0].sock if self.conns else None
+
+  def connect(self):
+    if self.conns:
+      return True
+    try:
+      for idx in range(self.size):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conns.append(_Connection(sock))
+    except socket.error as err:
+      _logger.error("Unable to connect to {}:{}: {}".format(self.host, self.port, err))
+      self.close()
+      return False
+    return True
+
+  def close(self):
+    for conn in self.conns:
+      conn.sock.close()
+    self.conns = []
+
+  def _request(self, conn, idx, func, start, count):
+    self._tid = (self._tid + 1) & 0xffff
+    conn.inflight[self._tid] = (idx, func, count)
+    conn.sock.sendall(_MBAP.pack(self._tid, 0, _READ.size + 1, self.unit) +
+                      _READ.pack(FUNCTIONS[func], start, count))
+    self.requests += 1
+
+  def _responses(self, conn):
+    """Parses the complete responses in the connection's buffer"""
+    while len(conn.buf) >= _MBAP.size:
+      tid, pid, length, unit = _MBAP.unpack_from(conn.buf)
+      end = _MBAP.size - 1 + length
+      if len(conn.buf) < end:
+        break
+      pdu, conn.buf = conn.buf[_MBAP.size:end], conn.buf[end:]
+
+      request = conn.inflight.pop(tid, None)
+      if request is None:
+        # A late response to a request which already timed out
+        _logger.debug("Ignoring the response to transaction {}".format(tid))
+        continue
+
+      idx, func, count = request
+      code = ord(pdu[0])
+      if code == FUNCTIONS[func] | 0x80:
+        raise IOError("Modbus exception {} reading {} registers".format(ord(pdu[1]), func))
+      if code != FUNCTIONS[func] or ord(pdu[1]) != count * 2:
+        raise IOError("Unexpected response to transaction {}".format(tid))
+      yield idx, struct.unpack_from('>{}H'.format(count), pdu, 2)
+
+  def read(self, reads):
+    """Reads every (func, start, count) block, returning their registers in
+    the same order
+    """
+    if not self.conns and not self.connect():
+      raise IOError("Unable to connect to the inverter")
+
+    tstart  = time.time()
+    pending = list(enumerate(reads))[::-1]
+    results = [None] * len(reads)
+    done    = 0
+    try:
+      while done < len(reads):
+        # Top up the connections to their limit, least busy first
+        while pending:
+          conn = min(self.conns, key=lambda c: len(c.inflight))
+          if len(conn.inflight) >= self.max_inflight:
+            break
+          idx, (func, start, count) = pending.pop()
+          self._request(conn, idx, func, start, count)
+        self.inflight_max = max(self.inflight_max, sum(len(c.inflight) for c in self.conns))
+
+        waiting = [c.sock for c in self.conns if c.inflight]
+        ready   = select.select(waiting, [], [], self.timeout)[0]
+        if not ready:
+          self.timeouts += 1
+          raise IOError("Timed out waiting on {} Modbus responses".format(
+                        sum(len(c.inflight) for c in self.conns)))
+
+        for conn in self.conns:
+          if conn.sock not in ready:
+            continue
+          data = conn.sock.recv(4096)
+          if not data:
+            raise IOError("The inverter closed the connection")
+          conn.buf += data
+          for idx, registers in self._responses(conn):
+            results[idx] = registers
+            done += 1
+    except (IOError, socket.error):
+      # Responses may still be on the way, start afresh on the next cycle
+      self.close()
+      raise
+
+    self.cycles    += 1
+    self.cycle_last = time.time() - tstart
+    return results
+
+  def stats(self):
+    return {'modbus_requests':     self.requests,
+            'modbus_timeouts':     self.timeouts,
+            'modbus_inflight_max': self.inflight_max,
+            'modbus_cycle_last':   self.cycle_last}
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVModbusPipeline", "FUNCTIONS"
+]
+
+# vim: set expandtab ts=2 sw=2:
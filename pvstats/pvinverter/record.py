@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+_MISSING = object()
+
+class PVSchema(object):
+  """The register names of a PVRecord, shared by every record of an inverter"""
+
+  def __init__(self, names=()):
+    self.names = []
+    self.index = {}
+    for name in names:
+      self.add(name)
+
+  def add(self, name):
+    if name not in self.index:
+      self.index[name] = len(self.names)
+      self.names.append(name)
+    return self.index[name]
+
+class PVRecord(collections.MutableMapping):
+  """A register set stored as a list of values indexed through a schema
+
+  The record behaves as a dict, but the register names are only held once
+  in the schema, and the record is updated in place every cycle rather than
+  building a new dict.
+  """
+
+  def __init__(self, schema=None):
+    self.schema = schema if schema is not None else PVSchema()
+    self.values = [_MISSING] * len(self.schema.names)
+
+  def __getitem__(self, name):
+    idx = self.schema.index[name]
+    if idx >= len(self.values) or self.values[idx] is _MISSING:
+      raise KeyError(name)
+    return self.values[idx]
+
+  def __setitem__(self, name, value):
+    idx = self.schema.index.get(name)
+    if idx is None:
+      idx = self.schema.add(name)
+    if idx >= len(self.values):
+      self.values.extend([_MISSING] * (idx + 1 - len(self.values)))
+    self.values[idx] = value
+
+  def __delitem__(self, name):
+    self[name]
+    self.values[self.schema.index[name]] = _MISSING
+
+  def __iter__(self):
+    for name, value in zip(self.schema.names, self.values):
+      if value is not _MISSING:
+        yield name
+
+  def __len__(self):
+    return sum(1 for v in self.values if v is not _MISSING)
+
+  def copy(self):
+    record = PVRecord(self.schema)
+    record.values = list(self.values)
+    return record
+
+  def __repr__(self):
+    return "PVRecord({!r})".format(dict(self))
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVRecord", "PVSchema"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Replaying a frame file recorded from an inverter
+
+The recorded model's own decoder is built as usual, but with its Modbus
+client or HTTP transport replaced by one serving the recorded frames, so the
+samples go through exactly the code a live inverter's would. Each read
+replays one recorded cycle, paced by the recorded times divided by the
+speed, and the decoder's clock is the time the cycle was recorded.
+"""
+
+from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.capture import PVFrameReader, CYCLE, MODBUS, HTTP, ERROR
+
+from datetime import datetime
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# The options of the replay itself, the others override the recorded ones
+_OPTIONS = ('model', 'replay_model', 'file', 'speed', 'loop', 'record')
+
+class _Response(object):
+  __slots__ = ('registers',)
+
+  def __init__(self, registers):
+    self.registers = registers
+
+class _ReplayModbusClient(object):
+  """Serves register reads from the recorded cycle"""
+
+  socket = True
+
+  def __init__(self, replay):
+    self.replay = replay
+
+  def connect(self):
+    return True
+
+  def close(self):
+    pass
+
+  def read_input_registers(self, start, count, unit=1):
+    return _Response(self.replay.registers_of('input', start, count))
+
+  def read_holding_registers(self, start, count, unit=1):
+    return _Response(self.replay.registers_of('holding', start, count))
+
+class _ReplayTransport(object):
+  """Serves web requests from the recorded cycle"""
+
+  def __init__(self, replay):
+    self.replay = replay
+
+  def get(self, path):
+    return self.replay.body_of(path)
+
+  def close(self):
+    pass
+
+  def stats(self):
+    return {}
+
+class PVInverter_Replay(BasePVInverter):
+  """Replays a frame file through the decoder of the recorded model
+
+  build(model, cfg) creates the decoder, normally the PVInverterFactory.
+  """
+
+  def __init__(self, cfg, build):
+    super(PVInverter_Replay, self).__init__(cfg)
+    self.path  = cfg['file']
+    self.speed = float(cfg.get('speed', 1))
+    self.loop  = bool(cfg.get('loop', False))
+
+    self.reader = PVFrameReader(self.path)
+    model       = cfg.get('replay_model', self.reader.model)
+
+    # Decoders never open their connections here, but the placeholders keep
+    # their constructors happy
+    dcfg = dict(self.reader.cfg)
+    dcfg.update((k, v) for k, v in cfg.iteritems() if k not in _OPTIONS)
+    dcfg.setdefault('host', 'replay')
+    dcfg.setdefault('port', 0)
+    if dcfg.get('mode') == 'rtu':
+      dcfg['mode'] = 'tcp'
+    dcfg.pop('pipeline', None)
+    self.decoder = build(model, dcfg)
+
+    if hasattr(self.decoder, 'transport'):
+      self.decoder.transport = _ReplayTransport(self)
+    elif hasattr(self.decoder, 'client'):
+      self.decoder.client = _ReplayModbusClient(self)
+    else:
+      raise ValueError("Unable to replay the {} model".format(model))
+    self.decoder.now = self._now
+
+    # A decoder tracking the inverter clock keeps it against the recorded time
+    if getattr(self.decoder, 'clock', None) is not None:
+      self.decoder.clock.source = self._time
+
+    self.cycles   = 0
+    self.frames   = 0
+    self._cycle   = None
+    self._reset()
+
+  def _reset(self):
+    # The wall clock time the first recorded cycle is replayed at
+    first          = self.reader.peek()
+    self._origin   = first[0] if first is not None else 0
+    self._start_at = None
+
+  def _time(self):
+    return self._cycle['time']
+
+  def _now(self):
+    return datetime.fromtimestamp(self._time())
+
+  def next_due(self):
+    frame = self.reader.peek()
+    if frame is None or self._start_at is None or self.speed <= 0:
+      return time.time()
+    return self._start_at + (frame[0] - self._origin) / self.speed
+
+  def _next_cycle(self):
+    """Reads the frames of the next cycle"""
+    frame = self.reader.peek()
+    if frame is None and self.loop:
+      self.reader.close()
+      self.reader = PVFrameReader(self.path)
+      self._reset()
+      frame = self.reader.peek()
+    if frame is None:
+      raise EOFError("End of {}".format(self.path))
+    if self._start_at is None:
+      self._start_at = time.time()
+
+    # Frames recorded before the first cycle mark make a cycle of their own
+    when, kind, value = self.reader.next()
+    cycle = {'time': when, 'input': {}, 'holding': {}, 'http': {}, 'error': None}
+    while True:
+      if kind == MODBUS:
+        func, start, registers = value
+        cycle[func].update(zip(range(start, start + len(registers)), registers))
+      elif kind == HTTP:
+        cycle['http'][value[0]] = value[1]
+      elif kind == ERROR:
+        cycle['error'] = value
+      if kind != CYCLE:
+        self.frames += 1
+
+      frame = self.reader.peek()
+      if frame is None or frame[1] == CYCLE:
+        break
+      when, kind, value = self.reader.next()
+    return cycle
+
+  def _missing(self, what):
+    # A read which failed when it was recorded fails again
+    if self._cycle['error'] is not None:
+      raise IOError(self._cycle['error'])
+    raise IOError("{} was not recorded".format(what))
+
+  def registers_of(self, func, start, count):
+    image = self._cycle[func]
+    try:
+      return [image[addr] for addr in xrange(start, start + count)]
+    except KeyError:
+      self._missing("{} registers {}-{}".format(func, start, start + count - 1))
+
+  def body_of(self, path):
+    body = self._cycle['http'].get(path)
+    if body is None:
+      self._missing(path)
+    return body
+
+  def read(self):
+    self._cycle  = self._next_cycle()
+    self.cycles += 1
+    self.decoder.read()
+
+  def samples(self):
+    return self.decoder.samples()
+
+  def stats(self):
+    stats = super(PVInverter_Replay, self).stats()
+    stats.update({'replay_cycles': self.cycles, 'replay_frames': self.frames})
+    return stats
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVInverter_Replay"
+]
+
+# vim: set expandtab ts=2 sw=2:
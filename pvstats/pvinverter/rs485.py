@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sharing one RS485 bus between several Modbus RTU inverters
+
+Every inverter on the same serial device gets the same PVRS485Bus, which
+owns the port and runs one transaction at a time. Transactions are served
+in the order they were requested, so inverters polled in the same sample
+period take turns span by span rather than one holding the bus for its
+whole read. Consecutive frames are separated by the Modbus silent interval
+of 3.5 characters at the configured baud rate, or 1.75ms above 19200 baud,
+and no longer.
+"""
+
+from pymodbus.client.sync import ModbusSerialClient
+
+import threading
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+_buses      = {}
+_buses_lock = threading.Lock()
+
+def frame_gap(baudrate, bytesize=8, parity='N', stopbits=1):
+  """The Modbus RTU silent interval between frames in seconds"""
+  if baudrate > 19200:
+    return 0.00175
+  bits = 1 + bytesize + (0 if parity == 'N' else 1) + stopbits
+  return 3.5 * bits / float(baudrate)
+
+class PVRS485Bus(object):
+  """A serial port running one Modbus transaction at a time"""
+
+  def __init__(self, dev, baudrate=9600, bytesize=8, parity='N', stopbits=1, timeout=0.5):
+    self.dev      = dev
+    self.settings = (baudrate, bytesize, parity, stopbits)
+    self.gap      = frame_gap(baudrate, bytesize, parity, stopbits)
+    self.client   = ModbusSerialClient(method='rtu', port=dev, timeout=timeout,
+                                       stopbits=stopbits, bytesize=bytesize,
+                                       parity=parity,     baudrate=baudrate)
+
+    self.users = 0
+    self.open  = False
+
+    # A ticket lock, so the transactions are served first come first served
+    self._cond    = threading.Condition()
+    self._ticket  = 0
+    self._serving = 0
+    self._idle_at = 0
+
+    self.transactions = 0
+    self.timeouts     = 0
+    self.busy         = 0.0
+    self.waited       = 0.0
+    self.since        = time.time()
+
+  def connect(self):
+    """Opens the port for an inverter, unless another inverter already has"""
+    with self._cond:
+      if not self.open:
+        if not self.client.connect():
+          raise IOError("Unable to open {}".format(self.dev))
+        self.open = True
+      self.users += 1
+
+  def close(self):
+    """Closes the port once no inverter is using it"""
+    with self._cond:
+      self.users = max(self.users - 1, 0)
+      if self.users == 0 and self.open:
+        self.client.close()
+        self.open = False
+
+  def transaction(self):
+    return _Transaction(self)
+
+  def _acquire(self):
+    tstart = time.time()
+    with self._cond:
+      ticket        = self._ticket
+      self._ticket += 1
+      while ticket != self._serving:
+        self._cond.wait()
+    self.waited += time.time() - tstart
+
+    # Leave the silent interval after the previous frame
+    delay = self._idle_at + self.gap - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def _release(self, tstart, failed):
+    now = time.time()
+    self.transactions += 1
+    self.busy         += now - tstart
+    if failed:
+      self.timeouts += 1
+    self._idle_at = now
+
+    with self._cond:
+      self._serving += 1
+      self._cond.notify_all()
+
+  def stats(self):
+    elapsed = max(time.time() - self.since, 1e-9)
+    return {'bus_transactions': self.transactions,
+            'bus_timeouts':     self.timeouts,
+            'bus_utilization':  self.busy / elapsed,
+            'bus_wait_avg':     self.waited / max(self.transactions, 1)}
+
+class _Transaction(object):
+  __slots__ = ('bus', 'start')
+
+  def __init__(self, bus):
+    self.bus = bus
+
+  def __enter__(self):
+    self.bus._acquire()
+    self.start = time.time()
+    return self.bus.client
+
+  def __exit__(self, exc_type, exc, tb):
+    self.bus._release(self.start, exc_type is not None)
+    return False
+
+def open_bus(dev, baudrate=9600, bytesize=8, parity='N', stopbits=1, timeout=0.5):
+  """Returns the bus of the serial device, shared by every inverter on it"""
+  with _buses_lock:
+    bus = _buses.get(dev)
+    if bus is None:
+      bus = _buses[dev] = PVRS485Bus(dev, baudrate, bytesize, parity, stopbits, timeout)
+    elif bus.settings != (baudrate, bytesize, parity, stopbits):
+      raise ValueError("{} is already in use with different serial settings".format(dev))
+    return bus
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVRS485Bus", "open_bus", "frame_gap"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -14,10 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pvstats.pvinverter.base import BasePVInverter
-from datetime import datetime
+from pvstats.pvinverter.httpbase import BaseHTTPPVInverter
 from decimal import *
-import urllib2
 import json
 
 getcontext().prec = 9
@@ -26,30 +24,25 @@ import logging
 _logger = logging.getLogger(__name__)
 
 
-class PVInverter_Solax(BasePVInverter):
+class PVInverter_Solax(BaseHTTPPVInverter):
   def __init__(self, cfg, **kwargs):
-    self.url = "http://{}:{}/api/realTimeData.htm".format(cfg["host"],cfg["port"])
-
-    
-  def connect(self):
-    pass
-
-  def close(self):
-    pass
+    super(PVInverter_Solax, self).__init__(cfg)
+    self.path = "/api/realTimeData.htm"
 
   def read(self):
     """Reads the PV inverters status"""
 
-    response = urllib2.urlopen(self.url).read().decode("utf-8").replace(",,",",0,").replace(",,",",0,")
+    response = self.fetch(self.path).decode("utf-8").replace(",,",",0,").replace(",,",",0,")
     data = json.loads(response)
     #print json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '),default=str)
 
-    self.registers = {'timestamp':     datetime.now(),
-                      'daily_pv_power':Decimal(data['Data'][8]*1000),
-                      'total_pv_power':Decimal(data['Data'][6]),
-                      'internal_temp': Decimal(data['Data'][7]),
-                      'pv1_voltage':   Decimal(data['Data'][2]).quantize(Decimal('.1')),
-                      'pv2_voltage':   Decimal(data['Data'][3]).quantize(Decimal('.1'))}
+    r = self.registers
+    r['timestamp']      = self.now()
+    r['daily_pv_power'] = self.number(data['Data'][8]*1000)
+    r['total_pv_power'] = self.number(data['Data'][6])
+    r['internal_temp']  = self.number(data['Data'][7])
+    r['pv1_voltage']    = self.number(data['Data'][2], 1)
+    r['pv2_voltage']    = self.number(data['Data'][3], 1)
 
 
 #-----------------
@@ -15,6 +15,12 @@
 # limitations under the License.
 
 from pvstats.pvinverter.base import BasePVInverter
+from pvstats.pvinverter.rs485 import open_bus
+from pvstats.pvinverter.pipeline import PVModbusPipeline
+from pvstats.pvinverter.clock import PVInverterClock
+from pvstats.pvinverter.device_profile import load_profile, register_map, plan_reads
+from pvstats.pvinverter.device_profile import MODBUS_MAX_COUNT
+from pvstats.timing import profiler
 
 from pymodbus.constants import Defaults
 from pymodbus.client.sync import ModbusTcpClient
@@ -29,107 +35,211 @@ import serial.rs485
 from decimal import *
 getcontext().prec = 9
 
+import time
+
 import logging
 _logger = logging.getLogger(__name__)
 
-_register_map = {
-  'input': {
-    '5003':  {'name': 'daily_pv_power',    'scale': Decimal(100),   'units': 'W'},
-    '5004':  {'name': 'lifetime_pv_power', 'scale': Decimal(1),     'units': 'kW'},
-    '5008':  {'name': 'internal_temp',     'scale': Decimal('0.1'), 'units': 'C'},
-    '5011':  {'name': 'pv1_voltage',       'scale': Decimal('0.1'), 'units': 'V'},
-    '5012':  {'name': 'pv1_current',       'scale': Decimal('0.1'), 'units': 'A'},
-    '5013':  {'name': 'pv2_voltage',       'scale': Decimal('0.1'), 'units': 'V'},
-    '5014':  {'name': 'pv2_current',       'scale': Decimal('0.1'), 'units': 'A'},
-    '5017':  {'name': 'total_pv_power',    'scale': Decimal(1),     'units': 'W'},
-    '5019':  {'name': 'grid_voltage',      'scale': Decimal('0.1'), 'units': 'V'},
-    '5022':  {'name': 'inverter_current',  'scale': Decimal('0.1'), 'units': 'A'},
-    '5036':  {'name': 'grid_frequency',    'scale': Decimal('0.1'), 'units': 'Hz'},
-  },
-
-  'holding': {
-    '5000':  {'name': 'date_year',         'scale': 1,              'units': 'year'},
-    '5001':  {'name': 'date_month',        'scale': 1,              'units': 'month'},
-    '5002':  {'name': 'date_day',          'scale': 1,              'units': 'day'},
-    '5003':  {'name': 'date_hour',         'scale': 1,              'units': 'hour'},
-    '5004':  {'name': 'date_minute',       'scale': 1,              'units': 'minute'},
-    '5005':  {'name': 'date_second',       'scale': 1,              'units': 'second'},
-  }
-}
+# The register map of the default profile, keyed by the 1 based address
+_profile      = load_profile('sungrow-sg5ktl')
+_register_map = register_map(_profile)
+
+# The registers of the inverter's clock
+DATE_FIELDS = ('date_year', 'date_month', 'date_day', 'date_hour', 'date_minute', 'date_second')
+
+def register_units():
+  """The units of each register by name, including the calculated ones"""
+  units = dict((reg['name'], reg['units'])
+               for regs in _register_map.values() for reg in regs.values())
+  units['pv1_power'] = 'W'
+  units['pv2_power'] = 'W'
+  return units
 
 class PVInverter_SunGrow(BasePVInverter):
   def __init__(self, cfg, **kwargs):
-    super(PVInverter_SunGrow, self).__init__()
-    self.client = ModbusTcpClient(cfg['host'],               port=cfg['port'],
-                                  framer=ModbusSocketFramer, timeout=3,
-                                  RetryOnEmpty=True,         retries=3)
+    super(PVInverter_SunGrow, self).__init__(cfg)
+    self.unit = int(cfg.get('unit', 1))
+
+    # The pipeline sends every read of a cycle without waiting on the
+    # responses, as many at once as the inverter tolerates
+    self.pipeline = cfg.get('pipeline')
+    if self.pipeline:
+      opts = self.pipeline if isinstance(self.pipeline, dict) else {}
+      self.client = PVModbusPipeline(cfg['host'], cfg['port'], self.unit,
+                                     timeout      = float(opts.get('timeout', 3)),
+                                     max_inflight = int(opts.get('max_inflight', 4)),
+                                     connections  = int(opts.get('connections', 1)))
+    else:
+      self.client = ModbusTcpClient(cfg['host'],               port=cfg['port'],
+                                    framer=ModbusSocketFramer, timeout=3,
+                                    RetryOnEmpty=True,         retries=3)
+    self._plan_reads(cfg)
+
+  def _plan_reads(self, cfg):
+    # Another model's registers may be read by naming its profile
+    profile = _profile
+    if 'profile' in cfg:
+      profile = load_profile(cfg['profile'])
+    regmap = register_map(profile)
+
+    # In clock sync mode the clock registers are only read now and then,
+    # with their own plan, and the samples are stamped from the clock offset
+    self.clock      = None
+    self.clock_plan = []
+    sync = cfg.get('clock_sync')
+    if sync:
+      opts     = sync if isinstance(sync, dict) else {}
+      clockmap = {}
+      for func, regs in regmap.iteritems():
+        for addr, reg in regs.items():
+          if reg['name'] in DATE_FIELDS:
+            clockmap.setdefault(func, {})[addr] = regs.pop(addr)
+      if sum(len(regs) for regs in clockmap.values()) != len(DATE_FIELDS):
+        raise ValueError("The profile has no clock registers to sync with")
+
+      self.clock = PVInverterClock(interval     = float(opts.get('interval', 3600)),
+                                   max_drift    = float(opts.get('max_drift', 2)),
+                                   min_interval = float(opts.get('min_interval', 60)))
+      self.clock_plan = plan_reads(clockmap, max_gap=len(DATE_FIELDS), numeric=self.numeric,
+                                   word_order=profile.get('word_order', 'big'))
+
+    self.plan = plan_reads(regmap,
+                           max_gap    = int(cfg.get('max_gap', 10)),
+                           max_count  = int(cfg.get('max_count', MODBUS_MAX_COUNT)),
+                           numeric    = self.numeric,
+                           word_order = profile.get('word_order', 'big'))
+    _logger.debug("Read plan: {}".format(self.plan))
 
   def connect(self):
-    self.client.connect()
+    if not self.client.connect():
+      raise IOError("Unable to connect to the inverter")
 
   def close(self):
     self.client.close()
 
+  def stats(self):
+    stats = super(PVInverter_SunGrow, self).stats()
+    if self.pipeline:
+      stats.update(self.client.stats())
+    if self.clock is not None:
+      stats.update(self.clock.stats())
+    return stats
+
+  def is_connected(self):
+    # pymodbus drops the socket when it detects the peer has gone away
+    return (super(PVInverter_SunGrow, self).is_connected() and
+            self.client.socket is not None)
+
   def read(self):
     """Reads the PV inverters status"""
 
-    # Read holding and input registers in groups aligned on the 100
-    for func in _register_map:
-      start = -1
-      for k in sorted(_register_map[func].keys()):
-        group  = int(k) - int(k) % 100
-        if (start < group):
-          self._load_registers(func, group, 100)
-          start = group + 100
-
-    # Manually calculate the power and the timestamps
-    self.registers['pv1_power'] = round(self.registers['pv1_current'] * self.registers['pv1_voltage'])
-    self.registers['pv2_power'] = round(self.registers['pv2_current'] * self.registers['pv2_voltage'])
-    self.registers['timestamp'] = datetime(self.registers['date_year'],   self.registers['date_month'],
-                                           self.registers['date_day'],    self.registers['date_hour'],
-                                           self.registers['date_minute'], self.registers['date_second'])
-
-  def _load_registers(self,func,start,count=100):
+    registers = self.registers
+    for span, values in zip(self.plan, self._load_plan(self.plan)):
+      for name, value in span.decode(values):
+        registers[name] = value
+
+    # Manually calculate the power and the timestamps, when the profile has
+    # the registers to
+    if 'pv1_current' in registers and 'pv1_voltage' in registers:
+      registers['pv1_power'] = round(registers['pv1_current'] * registers['pv1_voltage'])
+    if 'pv2_current' in registers and 'pv2_voltage' in registers:
+      registers['pv2_power'] = round(registers['pv2_current'] * registers['pv2_voltage'])
+    if self.clock is not None:
+      if self.clock.due():
+        self._sync_clock()
+      registers['timestamp'] = self.clock.now()
+    elif 'date_year' in registers:
+      registers['timestamp'] = datetime(registers['date_year'],   registers['date_month'],
+                                        registers['date_day'],    registers['date_hour'],
+                                        registers['date_minute'], registers['date_second'])
+    else:
+      registers['timestamp'] = self.now()
+
+  def _sync_clock(self):
+    """Reads the inverter clock, and takes it as the clock offset"""
+    sent     = self.clock.source()
+    blocks   = self._load_plan(self.clock_plan)
+    received = self.clock.source()
+
+    date = {}
+    for span, values in zip(self.clock_plan, blocks):
+      date.update(span.decode(values))
+    when = datetime(*[int(date[name]) for name in DATE_FIELDS])
+    self.clock.sync(time.mktime(when.timetuple()), sent, received)
+
+  def _load_plan(self, plan):
+    """Reads the registers of every span in a plan"""
+    if not self.pipeline:
+      return [self._load_registers(span.func, span.start, span.count) for span in plan]
+
     try:
-      if func == 'input':
-        rq = self.client.read_input_registers(start, count, unit=0x01)
-      elif func == 'holding':
-        # Holding registers need an offset
-        start = start - 1
-        rq = self.client.read_holding_registers(start, count, unit=0x01)
-      else:
-        raise Exception("Unknown register type: {}".format(type))
+      with profiler.timer("modbus.pipeline"):
+        blocks = self.client.read([(span.func, span.start, span.count) for span in plan])
+    except Exception as err:
+      if self.recorder is not None:
+        self.recorder.error(err)
+      _logger.error("Error: %s" % err)
+      raise
 
+    if self.recorder is not None:
+      for span, values in zip(plan, blocks):
+        self.recorder.modbus(span.func, span.start, values)
+    return blocks
 
-      if isinstance(rq, ModbusIOException):
-        _logger.error("Error: {}".format(rq))
-        raise Exception("ModbusIOException")
+  def _load_registers(self,func,start,count):
+    """Reads count registers from the 0 based wire address start"""
+    try:
+      with profiler.timer("modbus.{}.{}", func, start):
+        if func == 'input':
+          rq = self.client.read_input_registers(start, count, unit=self.unit)
+        elif func == 'holding':
+          rq = self.client.read_holding_registers(start, count, unit=self.unit)
+        else:
+          raise Exception("Unknown register type: {}".format(func))
 
-      for x in range(0, count):
-        key  = str(start + x + 1)
-        val  = rq.registers[x]
 
-        if key in _register_map[func]:
-          reg = _register_map[func][key]
-          self.registers[reg['name']] = val * reg['scale']
+      if isinstance(rq, ModbusIOException):
+        _logger.error("Error: {}".format(rq))
+        raise IOError("ModbusIOException")
 
+      if self.recorder is not None:
+        self.recorder.modbus(func, start, rq.registers)
+      return rq.registers
 
     except Exception as err:
+      if self.recorder is not None:
+        self.recorder.error(err)
       _logger.error("Error: %s" % err)
-      _logger.debug("{}, start: {}, count: {}".format(type, start, count))
+      _logger.debug("{}, start: {}, count: {}".format(func, start, count))
       raise
 
 class PVInverter_SunGrowRTU(PVInverter_SunGrow):
+  """A Sungrow inverter on an RS485 bus, which may be shared with others
+
+  Every inverter configured with the same "dev" shares one PVRS485Bus, and
+  is told apart by its Modbus "unit" address.
+  """
+
   def __init__(self, cfg, **kwargs):
-    super(PVInverter_SunGrow, self).__init__()
+    super(PVInverter_SunGrow, self).__init__(cfg)
+    self.unit     = int(cfg.get('unit', 1))
+    self.pipeline = None
 
     # Configure the Modbus Remote Terminal Unit settings
-    self.client = ModbusSerialClient(method='rtu', port=cfg['dev'], timeout=0.5,
-                                     stopbits = 1, bytesize =8, parity='N', baudrate=9600)
+    self.bus = open_bus(cfg['dev'], baudrate = int(cfg.get('baudrate', 9600)),
+                                    bytesize = int(cfg.get('bytesize', 8)),
+                                    parity   = cfg.get('parity', 'N'),
+                                    stopbits = int(cfg.get('stopbits', 1)),
+                                    timeout  = float(cfg.get('timeout', 0.5)))
+    self.client    = self.bus.client
+    self._bus_open = False
+    self._plan_reads(cfg)
 
   def connect(self):
-    # Connect then configure the port
-    self.client.connect()
+    # Open the port unless another inverter on the bus already has
+    if not self._bus_open:
+      self.bus.connect()
+      self._bus_open = True
 
     # Configure the RS485 port - This seems not needed
     #rs485_mode = serial.rs485.RS485Settings(delay_before_tx = 0, delay_before_rx = 0,
@@ -137,12 +247,30 @@ class PVInverter_SunGrowRTU(PVInverter_SunGrow):
     #                                        loopback=False)
     #self.client.socket.rs485_mode = rs485_mode
 
+  def close(self):
+    if self._bus_open:
+      self._bus_open = False
+      self.bus.close()
+
+  def is_connected(self):
+    return self._bus_open and super(PVInverter_SunGrowRTU, self).is_connected()
+
+  def _load_registers(self, func, start, count):
+    # One transaction at a time on the bus
+    with self.bus.transaction():
+      return super(PVInverter_SunGrowRTU, self)._load_registers(func, start, count)
+
+  def stats(self):
+    stats = super(PVInverter_SunGrowRTU, self).stats()
+    stats.update(self.bus.stats())
+    return stats
+
 
 #-----------------
 # Exported symbols
 #-----------------
 __all__ = [
-  "PVInverter_SunGrow", "PVInverter_SunGrowRTU"
+  "PVInverter_SunGrow", "PVInverter_SunGrowRTU", "plan_reads", "register_units", "DATE_FIELDS"
 ]
 
 # vim: set expandtab ts=2 sw=2:
@@ -18,12 +18,154 @@
 
 import urllib
 import httplib
+import socket
+import threading
+import time
+
+# The most statuses accepted by a single addbatchstatus request
+BATCH_STATUS_MAX = 30
+
+# The requests per hour PVOutput allows an API key by default
+REQUEST_LIMIT = 60
+
+# Request priorities, live data may use every request left while backfill
+# leaves the reserve alone
+LIVE     = 0
+BACKFILL = 1
+
+class PVOutputQuotaError(IOError):
+	"""
+	Raised instead of making a request the quota has no room for
+	"""
+	pass
+
+class PVOutputGovernor():
+	"""
+	A token bucket holding the requests left in the hourly quota of an API key
+
+	The bucket refills evenly over the hour, so requests are spread out rather
+	than spent in a burst. PVOutput reports the requests left and when they
+	reset in the X-Rate-Limit headers of each response, which cap the bucket
+	until the reset, as other systems and hosts may share the key.
+	"""
+	def __init__(self, limit=REQUEST_LIMIT, period=3600, reserve=10):
+		self.limit = float(limit)
+		self.period = float(period)
+		self.reserve = float(reserve)
+		self.tokens = self.limit
+		self.updated = time.time()
+
+		# The server's count of the requests left, until it resets
+		self.remaining = None
+		self.reset_at = None
+
+		self.requests = 0
+		self.denied = 0
+		self._lock = threading.Lock()
+
+	def _refill(self, now):
+		self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+		self.updated = now
+		if self.reset_at is not None and now >= self.reset_at:
+			self.remaining = self.reset_at = None
+		if self.remaining is not None:
+			self.tokens = min(self.tokens, self.remaining)
+
+	def acquire(self, priority=LIVE):
+		"""
+		Takes a request from the quota, returning False if there is no room
+		"""
+		need = 1 if priority == LIVE else 1 + self.reserve
+		with self._lock:
+			self._refill(time.time())
+			if self.tokens < need:
+				self.denied += 1
+				return False
+			self.tokens -= 1
+			if self.remaining is not None:
+				self.remaining -= 1
+			self.requests += 1
+			return True
+
+	def available(self, priority=LIVE):
+		"""
+		The requests which could be made now at the priority
+		"""
+		with self._lock:
+			self._refill(time.time())
+			return max(int(self.tokens - (0 if priority == LIVE else self.reserve)), 0)
+
+	def update(self, headers):
+		"""
+		Takes the quota reported in the X-Rate-Limit response headers
+		"""
+		try:
+			remaining = headers.get('x-rate-limit-remaining')
+			limit = headers.get('x-rate-limit-limit')
+			reset = headers.get('x-rate-limit-reset')
+			with self._lock:
+				if limit is not None:
+					self.limit = float(limit)
+				if remaining is not None:
+					self.remaining = float(remaining)
+					self.reset_at = float(reset) if reset is not None else time.time() + self.period
+				self._refill(time.time())
+		except ValueError:
+			pass
+
+	def exhausted(self):
+		"""
+		Empties the bucket after the server refused a request over the quota
+		"""
+		with self._lock:
+			self.remaining = 0
+			if self.reset_at is None or self.reset_at <= time.time():
+				self.reset_at = time.time() + self.period
+			self._refill(time.time())
+
+	def stats(self):
+		with self._lock:
+			self._refill(time.time())
+			return {'quota_limit': int(self.limit),
+					'quota_remaining': int(self.tokens),
+					'quota_reset': self.reset_at,
+					'quota_requests': self.requests,
+					'quota_denied': self.denied}
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+def quota_governor(api_key, limit=REQUEST_LIMIT, reserve=10):
+	"""
+	Returns the governor of an API key, shared by every client using it
+	"""
+	with _governors_lock:
+		governor = _governors.get(api_key)
+		if governor is None:
+			governor = _governors[api_key] = PVOutputGovernor(limit, reserve=reserve)
+		return governor
+
+class PVOutputResponse():
+	"""
+	A fully read response, so the connection can be reused straight away
+	"""
+	def __init__(self, status, body, headers):
+		self.status = status
+		self.body = body
+		self.headers = headers
+
+	def read(self):
+		return self.body
 
 class PVOutputClient():
-	def __init__(self, host, api_key, system_id):
+	def __init__(self, host, api_key, system_id, ssl=False, timeout=30, governor=None):
 		self.host = host
 		self.api_key = api_key
 		self.system_id = system_id
+		self.ssl = ssl
+		self.timeout = timeout
+		self.conn = None
+		self.governor = governor if governor is not None else quota_governor(api_key)
 
 	def add_output(self, date, generated, exported=None, peak_power=None, peak_time=None, condition=None,
 			min_temperature=None, max_temperature=None, comments=None, import_peak=None, import_offpeak=None, import_shoulder=None):
@@ -55,6 +197,7 @@ class PVOutputClient():
 			params['op'] = import_offpeak
 		if import_shoulder:
 			params['is'] = import_shoulder
+		params = urllib.urlencode(params)
 
 		response = self.make_request('POST', path, params)
 
@@ -63,7 +206,7 @@ class PVOutputClient():
 		if response.status != 200:
 			raise StandardError(response.read())
 
-	def add_status(self, date, time, energy_generation=None, power_generation=None, energy_consumption=None, power_consumption=None, temperature=None, voltage=None, cumulative=False):
+	def add_status(self, date, time, energy_generation=None, power_generation=None, energy_consumption=None, power_consumption=None, temperature=None, voltage=None, cumulative=False, priority=LIVE):
 		"""
 		Uploads live output data
 		"""
@@ -88,13 +231,44 @@ class PVOutputClient():
 			params['c1'] = 1
 		params = urllib.urlencode(params)
 
-		response = self.make_request('POST', path, params)
+		response = self.make_request('POST', path, params, priority)
+
+		if response.status == 400:
+			raise ValueError(response.read())
+		if response.status != 200:
+			raise StandardError(response.read())
+
+	def add_batch_status(self, statuses, cumulative=False, priority=LIVE):
+		"""
+		Uploads up to 30 live output statuses in a single request
+
+		Each status is a dict with the date and time, and optionally the
+		energy_generation, power_generation, energy_consumption,
+		power_consumption, temperature and voltage, as for add_status.
+		Returns the per status result reported by the server.
+		"""
+		if len(statuses) > BATCH_STATUS_MAX:
+			raise ValueError("At most {} statuses per batch".format(BATCH_STATUS_MAX))
+
+		path = '/service/r2/addbatchstatus.jsp'
+		fields = ('date', 'time', 'energy_generation', 'power_generation',
+				'energy_consumption', 'power_consumption', 'temperature', 'voltage')
+		data = ';'.join(','.join('' if s.get(f) is None else str(s[f]) for f in fields)
+				for s in statuses)
+		params = {'data': data}
+		if cumulative:
+			params['c1'] = 1
+		params = urllib.urlencode(params)
+
+		response = self.make_request('POST', path, params, priority)
 
 		if response.status == 400:
 			raise ValueError(response.read())
 		if response.status != 200:
 			raise StandardError(response.read())
 
+		return response.read()
+
 	def get_status(self, date=None, time=None):
 		"""
 		Retrieves status information
@@ -139,23 +313,61 @@ class PVOutputClient():
 
 		return response.read()
 
-	def make_request(self, method, path, params=None):
-		conn = httplib.HTTPConnection(self.host)
+	def connect(self):
+		if self.ssl:
+			self.conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+		else:
+			self.conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+	def make_request(self, method, path, params=None, priority=LIVE):
+		if not self.governor.acquire(priority):
+			raise PVOutputQuotaError("No requests left in the PVOutput quota")
+
 		headers = {
 				'Content-type': 'application/x-www-form-urlencoded',
 				'Accept': 'text/plain',
+				'Connection': 'keep-alive',
 				'X-Pvoutput-Apikey': self.api_key,
-				'X-Pvoutput-SystemId': self.system_id
+				'X-Pvoutput-SystemId': self.system_id,
+				'X-Rate-Limit': '1'
 				}
-		conn.request(method, path, params, headers)
 
-		return conn.getresponse()
+		# Reuse the connection between requests. If the server has since
+		# closed it, reconnect and try once more.
+		for attempt in range(2):
+			if self.conn is None:
+				self.connect()
+			try:
+				self.conn.request(method, path, params, headers)
+				response = self.conn.getresponse()
+				body = response.read()
+			except (httplib.HTTPException, socket.error):
+				self.close()
+				if attempt > 0:
+					raise
+				continue
+
+			if response.getheader('connection', '').lower() == 'close':
+				self.close()
+
+			response = PVOutputResponse(response.status, body, dict(response.getheaders()))
+			self.governor.update(response.headers)
+			if response.status == 403 and 'Exceeded' in body:
+				self.governor.exhausted()
+				raise PVOutputQuotaError(body)
+			return response
 
 #-----------------
 # Exported symbols
 #-----------------
 __all__ = [
-  "PVOutputClient"
+  "PVOutputClient", "PVOutputGovernor", "PVOutputQuotaError", "quota_governor",
+  "BATCH_STATUS_MAX", "REQUEST_LIMIT", "LIVE", "BACKFILL"
 ]
 
 # vim: set expandtab ts=2 sw=2:
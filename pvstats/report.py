@@ -17,9 +17,16 @@
 import abc
 import json
 import time
+from decimal import Decimal
 
 from influxdb import InfluxDBClient
-from pvstats.pvoutput import PVOutputClient
+from pvstats.pvoutput import PVOutputClient, BATCH_STATUS_MAX, LIVE, BACKFILL
+from pvstats.pvoutput import PVOutputQuotaError, quota_governor
+from pvstats.aggregate import PVAggregator, PVWindow, sample_time
+from pvstats.encoding import PVEncoderCache, text_value
+from pvstats.store import PVStore
+from pvstats.prometheus import PVPrometheusExporter
+from pvstats.pvinverter.sungrow_sg5ktl import register_units
 
 #import context
 import json
@@ -37,52 +44,141 @@ class BasePVOutput():
 
 class PVReport_pvoutput(BasePVOutput):
   def __init__(self, cfg):
-    self.samples     = []
     self.rate_limit  = int(cfg['rate_limit'])
-    self.last_status = time.time()
+
+    # Each inverter, and each device of a Fronius system, is averaged on its
+    # own and their windows are added up into one status for the site. The
+    # "inverter" and "device_id" options limit the report to those samples,
+    # to upload each to a PVOutput system of its own.
+    self.inverter    = cfg.get('inverter')
+    self.device_id   = cfg.get('device_id')
+    self.aggregators = {}
+    self.sites       = {}
+
+    # Statuses waiting to be sent, they are sent together once batch_size
+    # have accumulated, or after a failure once the server is reachable.
+    self.pending     = []
+    self.batch_size  = min(int(cfg.get('batch_size', 1)), BATCH_STATUS_MAX)
+    self.max_pending = int(cfg.get('max_pending', 288))
+
+    # Every report uploading with the same key shares its request quota
+    self.governor = quota_governor(cfg['key'], int(cfg.get('quota', 60)), int(cfg.get('reserve', 10)))
+    self.throttled = False
 
     self.client = PVOutputClient(cfg['host'],
                                  cfg['key'],
-                                 cfg['system_id'])
+                                 cfg['system_id'],
+                                 ssl=cfg.get('ssl', False),
+                                 governor=self.governor)
+
+  def _aggregator(self, source):
+    # Average the samples over each rate_limit period. If the samples stop
+    # for a while, start again rather than averaging across the gap.
+    aggregator = PVAggregator()
+    aggregator.add_window(PVWindow(self.rate_limit,
+                                   ['total_pv_power', 'internal_temp',
+                                    'pv1_voltage',    'pv2_voltage'],
+                                   max_gap=3*self.rate_limit),
+                          lambda window: self._add_window(source, window))
+    return aggregator
 
   def publish(self, data):
-    sample = {'date':             data['timestamp'].strftime("%Y%m%d"),
-              'time':             data['timestamp'].strftime("%H:%M"),
-              'energy_generation':data['daily_pv_power'],
-              'power_generation': data['total_pv_power'],
-              'temperature':      data['internal_temp'],
-              'voltage':         (data['pv1_voltage'] + data['pv2_voltage'])}
-
-    if (time.time() - self.last_status > 3*self.rate_limit):
-      # If the last successful sample was a long time ago, flush the samples
-      self.samples     = []
-
-
-    self.samples.append(sample)
-
-    if (time.time() - self.last_status > self.rate_limit):
-      # Last result: Date, Time & EnergyGeneration
-      # Average:     PowerGeneration, Temperature & Voltage
-      # Note: This asssumes all samples are sampled at the same sample rate
-      d = {
-        'date'             :self.samples[-1]['date'],
-        'time'             :self.samples[-1]['time'],
-        'energy_generation':self.samples[-1]['energy_generation'],
-        'power_generation' :sum(s['power_generation'] for s in self.samples) / len(self.samples),
-        'temperature'      :sum(s['temperature']      for s in self.samples) / len(self.samples),
-        'voltage'          :sum(s['voltage']          for s in self.samples) / len(self.samples)
-      }
-
-      # Clear out the old results
-      self.last_status = time.time()
-      self.samples     = []
-
-      # Send the new result to the server
-      self.client.add_status(d['date'], d['time'],
-                             energy_generation = d['energy_generation'],
-                             power_generation  = d['power_generation'],
-                             temperature       = d['temperature'],
-                             voltage           = d['voltage'])
+    if self.inverter is not None and data.get('inverter') != self.inverter:
+      return
+    if self.device_id is not None and str(data.get('device_id')) != str(self.device_id):
+      return
+
+    source     = (data.get('inverter'), data.get('device_id'))
+    aggregator = self.aggregators.get(source)
+    if aggregator is None:
+      aggregator = self.aggregators[source] = self._aggregator(source)
+    aggregator.add(data)
+
+    if len(self.pending) >= self.batch_size:
+      self.send()
+
+  def _add_window(self, source, window):
+    """Collects the windows of each source, adding a site status once every
+    source has completed the period
+    """
+    start = window['start']
+    self.sites.setdefault(start, {})[source] = window
+
+    # A source which stopped sending is left out, once a later period
+    # completes
+    complete = len(self.sites[start]) >= len(self.aggregators)
+    for s in sorted(self.sites):
+      if s > start or (s == start and not complete):
+        break
+      self._add_status(self.sites.pop(s).values())
+
+  def _add_status(self, windows):
+    # Last result: Date, Time & EnergyGeneration, added up over the sources
+    # Average:     PowerGeneration, added up over the sources
+    #              Temperature & Voltage, averaged over the sources
+    def mean(values):
+      values = [v for v in values if v is not None]
+      return sum(values) / len(values) if values else None
+
+    last = max((w['last'] for w in windows), key=lambda l: l['timestamp'])
+    d = {
+      'date'             :last['timestamp'].strftime("%Y%m%d"),
+      'time'             :last['timestamp'].strftime("%H:%M"),
+      'energy_generation':sum(int(w['last']['daily_pv_power']) for w in windows),
+      'power_generation' :sum(w['total_pv_power']['mean'] for w in windows),
+      'temperature'      :mean(w['internal_temp']['mean'] for w in windows),
+      'voltage'          :mean(w['pv1_voltage']['mean'] + w['pv2_voltage']['mean'] for w in windows)
+    }
+
+    self.pending.append(d)
+    del self.pending[:-self.max_pending]
+
+  def send(self):
+    """Sends the pending statuses to the server
+
+    The newest statuses go first as live data, then the older ones as
+    backfill, oldest first, while the quota has more than its reserve left.
+    When the quota runs out the statuses wait, and go together in a batch
+    once there is room again.
+    """
+    try:
+      priority = LIVE
+      while self.pending:
+        if priority == LIVE:
+          batch = self.pending[-BATCH_STATUS_MAX:]
+        else:
+          batch = self.pending[:BATCH_STATUS_MAX]
+
+        if len(batch) == 1:
+          d = batch[0]
+          self.client.add_status(d['date'], d['time'],
+                                 energy_generation = d['energy_generation'],
+                                 power_generation  = d['power_generation'],
+                                 temperature       = d['temperature'],
+                                 voltage           = d['voltage'],
+                                 priority          = priority)
+        else:
+          self.client.add_batch_status(batch, priority=priority)
+
+        if priority == LIVE:
+          del self.pending[-len(batch):]
+        else:
+          del self.pending[:len(batch)]
+        priority = BACKFILL
+    except PVOutputQuotaError as err:
+      if not self.throttled:
+        _log.warning("PVOutput quota reached, holding {} statuses: {}".format(len(self.pending), err))
+      self.throttled = True
+      return
+
+    if self.throttled:
+      _log.info("PVOutput quota available again, {} left".format(self.governor.available()))
+    self.throttled = False
+
+  def stats(self):
+    stats = self.governor.stats()
+    stats['pending'] = len(self.pending)
+    return stats
 
 
 class PVReport_mqtt(BasePVOutput):
@@ -102,12 +198,46 @@ class PVReport_mqtt(BasePVOutput):
     self.client.loop_start()
 
     # Save config data for later
-    self.topic = cfg['topic']
-    self.qos   = cfg['qos']
+    self.topic     = cfg['topic']
+    self.qos       = cfg['qos']
+    self.per_field = cfg.get('per_field', False)
+    self.retain    = cfg.get('retain', self.per_field)
+    self.encoders  = PVEncoderCache(cfg.get('encoding', 'json-pretty'))
+    self.topics    = {}
+    self.schemas   = set()
+
+  def _topic(self, data):
+    # The topic may include the inverter name and device id
+    if '{' not in self.topic:
+      return self.topic
+    return self.topic.format(inverter=data.get('inverter', ''), device_id=data.get('device_id', ''))
 
   def publish(self, data):
-    d = json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '),default=str)
-    self.client.publish(self.topic, d, qos=self.qos)
+    topic = self._topic(data)
+
+    if self.per_field:
+      # One retained topic per register, so subscribers only get what they need
+      topics = self.topics.get(topic)
+      if topics is None:
+        topics = self.topics[topic] = {}
+      for k, v in data.iteritems():
+        t = topics.get(k)
+        if t is None:
+          t = topics[k] = "{}/{}".format(topic, k)
+        self.client.publish(t, text_value(v), qos=self.qos, retain=self.retain)
+      return
+
+    encoder = self.encoders.get(data)
+    payload = encoder.encode(data)
+    if encoder.schema() is not None and (topic, encoder.schema_id) not in self.schemas:
+      # Describe the binary layout for the subscribers of each topic
+      self.client.publish(topic + "/schema", encoder.schema(), qos=self.qos, retain=True)
+      self.schemas.add((topic, encoder.schema_id))
+    self.client.publish(topic, payload, qos=self.qos, retain=self.retain)
+
+def _escape_tag(value):
+  """Escapes a measurement, tag key or tag value for the line protocol"""
+  return unicode(value).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
 
 class PVReport_influxdb(BasePVOutput):
   def __init__(self, cfg):
@@ -116,19 +246,123 @@ class PVReport_influxdb(BasePVOutput):
                                  cfg['db'],   ssl=cfg['ssl'],
                                  verify_ssl=cfg['verify_ssl'])
 
+    # Registers written as tags rather than fields
+    self.tag_fields     = set(cfg.get('tag_fields', ['inverter', 'device_id']))
+
+    self.batch_size     = int(cfg.get('batch_size', 100))
+    self.flush_interval = float(cfg.get('flush_interval', 60))
+    self.max_points     = int(cfg.get('max_points', 10000))
+    self.points         = []
+    self.last_flush     = time.time()
+    self.flushes        = 0
+
+    # The measurement and fixed tags are the same for every point
+    tags = cfg.get('tags', {})
+    self.prefix = _escape_tag(cfg.get('measurement', 'pvstats')) + \
+                  u''.join(u',{}={}'.format(_escape_tag(k), _escape_tag(tags[k])) for k in sorted(tags))
+
+  def _line(self, data):
+    """Formats a sample as a line protocol point"""
+    tags   = []
+    fields = []
+    for k in sorted(data):
+      v = data[k]
+      if k == 'timestamp' or v is None:
+        continue
+      elif k in self.tag_fields:
+        tags.append(u',{}={}'.format(_escape_tag(k), _escape_tag(v)))
+      elif isinstance(v, bool):
+        fields.append(u'{}={}'.format(_escape_tag(k), 'true' if v else 'false'))
+      elif isinstance(v, (int, long, float, Decimal)):
+        # Always write floats, so a value that happens to be whole does not
+        # conflict with the field type already in the database
+        fields.append(u'{}={!r}'.format(_escape_tag(k), float(v)))
+      elif isinstance(v, basestring):
+        fields.append(u'{}="{}"'.format(_escape_tag(k), v.replace('\\', '\\\\').replace('"', '\\"')))
+
+    line = self.prefix + u''.join(tags) + u' ' + u','.join(fields)
+    if 'timestamp' in data:
+      line += u' {:d}'.format(int(time.mktime(data['timestamp'].timetuple())))
+    return line
+
+  def publish(self, data):
+    self.points.append(self._line(data))
+    del self.points[:-self.max_points]
+
+    if (len(self.points) >= self.batch_size or
+        time.time() - self.last_flush >= self.flush_interval):
+      self.flush()
+
+  def flush(self):
+    """Writes the buffered points in a single request"""
+    if self.points:
+      self.client.write_points(self.points, time_precision='s', protocol='line')
+      _log.debug("Sent {} points to InfluxDB".format(len(self.points)))
+
+    self.points     = []
+    self.last_flush = time.time()
+    self.flushes   += 1
+
+class PVReport_sqlite(BasePVOutput):
+  """Keeps the samples in a local database, see pvstats.store"""
+
+  def __init__(self, cfg):
+    self.store = PVStore(cfg.get('path', '/var/lib/pvstats/pvstats.db'), cfg.get('retention'))
+
+    # The sample time is already in the timestamp
+    self.exclude = set(cfg.get('exclude', ['device_id', 'date_year', 'date_month', 'date_day',
+                                           'date_hour', 'date_minute', 'date_second']))
+
+    self.batch_size      = int(cfg.get('batch_size', 60))
+    self.flush_interval  = float(cfg.get('flush_interval', 60))
+    self.rollup_interval = float(cfg.get('rollup_interval', 300))
+    self.rows            = []
+    self.samples         = 0
+    self.last_flush      = time.time()
+    self.flushes         = 0
+    self.last_rollup     = 0
+
   def publish(self, data):
-    # TODO
-    metrics = {'measurement': 'sungrow',
-               'tags':        {'location': 'Sydney'},
-               'fields':      data}
+    ts       = int(sample_time(data))
+    inverter = data.get('inverter', '')
+    device   = data.get('device_id', 0)
+    for k, v in data.iteritems():
+      if k in self.exclude or isinstance(v, bool) or not isinstance(v, (int, long, float, Decimal)):
+        continue
+      self.rows.append((self.store.series_id(inverter, device, k), ts, float(v)))
+    self.samples += 1
+
+    if (self.samples >= self.batch_size or
+        time.time() - self.last_flush >= self.flush_interval):
+      self.flush()
+
+  def flush(self):
+    """Writes the buffered samples, rolling up and expiring now and then"""
+    self.store.insert(self.rows)
+    self.rows       = []
+    self.samples    = 0
+    self.last_flush = time.time()
+    self.flushes   += 1
+
+    if self.last_flush - self.last_rollup >= self.rollup_interval:
+      self.store.rollup()
+      self.store.expire()
+      self.last_rollup = self.last_flush
+
+class PVReport_prometheus(BasePVOutput):
+  """Serves the latest sample of each inverter to Prometheus"""
 
-    #fields  = {}
-    #metrics['measurement'] = "sungrow"
-    #metrics['tags']        = {'location': 'Sydney'}
-    #metrics['fields']      = {'test': 10}
+  def __init__(self, cfg):
+    units = register_units()
+    units.update(cfg.get('units', {}))
+    self.exporter = PVPrometheusExporter(cfg.get('host', ''), int(cfg.get('port', 9520)),
+                                         namespace = cfg.get('namespace', 'pvstats'),
+                                         units     = units,
+                                         exclude   = cfg.get('exclude', ['date_year', 'date_month', 'date_day',
+                                                                         'date_hour', 'date_minute', 'date_second']))
 
-    #target = self.client.write_points([metrics])
-    _log.debug("[INFO] Sent to InfluxDB")
+  def publish(self, data):
+    self.exporter.update(data)
 
 class PVReport_test(BasePVOutput):
   def __init__(self, cfg):
@@ -148,6 +382,10 @@ def PVReportFactory(cfg):
     return PVReport_mqtt(cfg)
   elif (cfg['type'] == "influxdb"):
     return PVReport_influxdb(cfg)
+  elif (cfg['type'] == "sqlite"):
+    return PVReport_sqlite(cfg)
+  elif (cfg['type'] == "prometheus"):
+    return PVReport_prometheus(cfg)
   else:
 #    raise ValueError("Unable to find PVReport for {}".format(cfg['type']))
     _log.debug("Unable to find PVReport for {}".format(cfg['type']))
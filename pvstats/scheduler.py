@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pvstats.timing import profiler
+from pvstats.sun import is_daylight, next_daylight
+from pvstats.pvinverter.clock import monotonic
+
+import json
+import threading
+import time
+import traceback
+
+import logging
+_log = logging.getLogger(__name__)
+
+
+NORMAL  = 'normal'
+FAST    = 'fast'
+IDLE    = 'idle'
+OFFLINE = 'offline'
+NIGHT   = 'night'
+
+class PVAdaptivePolicy(object):
+  """Chooses the period until the next read from the inverter's state
+
+  * night   - the sun is down, given a latitude and longitude, and the
+              inverter is offline or idle. Read every night_period, and
+              at the start of daylight
+  * offline - reads are failing, back off from the sample period doubling
+              up to offline_period
+  * idle    - the power is at most idle_power, read every idle_period
+  * fast    - the power changed by more than variability of itself since
+              the last read, read every fast_period for fast_hold seconds
+  * normal  - read every sample period
+
+  A successful read ends the offline backoff straight away.
+  """
+
+  def __init__(self, cfg, sample_period):
+    self.sample_period  = float(sample_period)
+    self.latitude       = cfg.get('latitude')
+    self.longitude      = cfg.get('longitude')
+    self.margin         = float(cfg.get('daylight_margin', 1800))
+    self.night_period   = float(cfg.get('night_period', 900))
+    self.offline_period = float(cfg.get('offline_period', 600))
+    self.idle_period    = float(cfg.get('idle_period', 60))
+    self.idle_power     = float(cfg.get('idle_power', 10))
+    self.fast_period    = float(cfg.get('fast_period', max(self.sample_period / 5, 1)))
+    self.variability    = float(cfg.get('variability', 0.2))
+    self.fast_hold      = float(cfg.get('fast_hold', 60))
+    self.power_field    = cfg.get('power_field', 'total_pv_power')
+
+    if (self.latitude is None) != (self.longitude is None):
+      raise ValueError("Both latitude and longitude are needed")
+
+    self.state      = NORMAL
+    self.failures   = 0
+    self.power      = None
+    self.fast_until = 0
+
+  def daylight(self, now):
+    if self.latitude is None:
+      return True
+    return is_daylight(now, self.latitude, self.longitude, self.margin)
+
+  def next_period(self, ok, power, now=None):
+    """Returns the state and seconds until the next read"""
+    now = time.time() if now is None else now
+    last_power = self.power
+    self.power = power if ok else None
+
+    if ok:
+      self.failures = 0
+    else:
+      self.failures += 1
+
+    idle = not ok or power is None or power <= self.idle_power
+    if idle and not self.daylight(now):
+      dawn   = next_daylight(now, self.latitude, self.longitude, self.margin)
+      period = self.night_period if dawn is None else min(self.night_period, max(dawn - now, 1))
+      return NIGHT, period
+
+    if not ok:
+      return OFFLINE, min(self.sample_period * 2 ** (self.failures - 1), self.offline_period)
+
+    if idle:
+      return IDLE, max(self.idle_period, self.sample_period)
+
+    if (last_power is not None and
+        abs(power - last_power) > self.variability * max(last_power, self.idle_power)):
+      self.fast_until = now + self.fast_hold
+    if now < self.fast_until:
+      return FAST, min(self.fast_period, self.sample_period)
+
+    return NORMAL, self.sample_period
+
+def format_stats(stats):
+  """Formats a stats dict as sorted name=value pairs for the log"""
+  def value(v):
+    if isinstance(v, float):
+      return "{:.4g}".format(v)
+    return str(v)
+  return " ".join("{}={}".format(k, value(stats[k])) for k in sorted(stats))
+
+class PVInverterTask(object):
+  """Polls a single inverter on its own thread with a drift free deadline"""
+
+  def __init__(self, name, inverter, sample_period, publish, policy=None):
+    self.name          = name
+    self.inverter      = inverter
+    self.sample_period = float(sample_period)
+    self.publish       = publish
+    self.policy        = policy
+    self.state         = NORMAL
+    self.period        = self.sample_period
+
+    self.cycles  = 0
+    self.errors  = 0
+    self.skipped = 0
+
+    # Stop after this many cycles, and the cProfile runner for --profile
+    self.max_cycles = None
+    self.cprofile   = None
+
+    self._stage_connect = "{}.connect".format(name)
+    self._stage_read    = "{}.read".format(name)
+    self._stage_publish = "{}.publish".format(name)
+    self._stage_cycle   = "{}.cycle".format(name)
+
+    self._stop   = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="pvstats-{}".format(name))
+    self._thread.daemon = True
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+
+  def join(self, timeout=None):
+    self._thread.join(timeout)
+
+  def is_alive(self):
+    return self._thread.is_alive()
+
+  def stats(self):
+    """The task's cycle counts and state, with the inverter's own stats"""
+    stats = {'cycles':  self.cycles,
+             'errors':  self.errors,
+             'skipped': self.skipped,
+             'state':   self.state,
+             'period':  self.period}
+    inverter_stats = getattr(self.inverter, 'stats', None)
+    if inverter_stats is not None:
+      stats.update(inverter_stats())
+    return stats
+
+  def poll(self):
+    """Runs a single connect, read, publish, close cycle
+
+    Returns True if the read succeeded, and the total power of the samples
+    for the adaptive policy.
+    """
+    failed = False
+    power  = None
+    try:
+      # Grab the data from the inverter
+      with profiler.timer(self._stage_connect):
+        self.inverter.acquire()
+      with profiler.timer(self._stage_read):
+        self.inverter.read()
+
+      for registers in self.inverter.samples():
+        # Log it, skipping the formatting unless it will be shown
+        if _log.isEnabledFor(logging.DEBUG):
+          _log.debug(json.dumps(dict(registers), sort_keys=True,
+                               indent=4, separators=(',', ': '),default=str))
+
+        # Publish it
+        with profiler.timer(self._stage_publish):
+          self.publish(self.name, registers)
+
+        if self.policy is not None:
+          value = registers.get(self.policy.power_field)
+          if value is not None:
+            power = (power or 0.0) + float(value)
+
+    except EOFError:
+      # The end of a replayed recording
+      failed = True
+      raise
+
+    except Exception as err:
+      failed = True
+      self.errors += 1
+      _log.debug(traceback.format_exc())
+      _log.debug("{}: Ignoring = {}".format(self.name, err))
+
+    finally:
+      try:
+        self.inverter.release(failed)
+      except Exception as err:
+        _log.debug("{}: Ignoring = {}".format(self.name, err))
+
+    self.cycles += 1
+    return not failed, power
+
+  def _next_period(self, ok, power):
+    if self.policy is None:
+      return self.sample_period
+
+    state, period = self.policy.next_period(ok, power)
+    if state != self.state:
+      # Only the transitions are logged, not every failed read
+      log = _log.warning if state == OFFLINE else _log.info
+      log("{}: {} -> {}, reading every {:g}s".format(self.name, self.state, state, period))
+      self.state = state
+    return period
+
+  def _run(self):
+    # The deadlines are kept on the monotonic clock so that a wall clock
+    # step, such as an NTP correction, neither bursts nor stalls the reads.
+    # Only the policy's sun position uses the wall clock.
+    deadline = monotonic()
+    while not self._stop.is_set():
+      try:
+        with profiler.timer(self._stage_cycle):
+          if self.cprofile is not None:
+            ok, power = self.cprofile.call(self.name, self.poll)
+          else:
+            ok, power = self.poll()
+      except EOFError as err:
+        _log.info("{}: {}, stopping".format(self.name, err))
+        break
+
+      if self.max_cycles is not None and self.cycles >= self.max_cycles:
+        break
+
+      # An inverter pacing its own reads, such as a replay, says when the
+      # next one is due
+      due = self.inverter.next_due()
+      if due is not None:
+        self._stop.wait(max(due - time.time(), 0))
+        continue
+
+      # Deadlines advance by a fixed period rather than from the end of the
+      # cycle, so the read time does not accumulate as drift. If a cycle
+      # overran by more than a period, skip the missed slots instead of
+      # trying to catch up with a burst of reads.
+      self.period = period = self._next_period(ok, power)
+      deadline += period
+      now = monotonic()
+      if now > deadline:
+        missed    = int((now - deadline) / period) + 1
+        deadline += missed * period
+        self.skipped += missed
+      self._stop.wait(deadline - now)
+
+
+class PVScheduler(object):
+  """Polls several inverters concurrently and fans the results out to the reports"""
+
+  def __init__(self, summary_interval=0, dump_path=None, stats_interval=0):
+    self.tasks   = []
+    self.reports = []
+
+    # While profiling, how often to log the stage timings and write them out
+    self.summary_interval = float(summary_interval)
+    self.dump_path        = dump_path
+
+    # How often to log the stats of the inverters and reports
+    self.stats_interval = float(stats_interval)
+
+  def add_inverter(self, name, inverter, sample_period, policy=None):
+    self.tasks.append(PVInverterTask(name, inverter, sample_period, self.publish, policy))
+
+  def add_report(self, report, inverters=None):
+    """Adds a report, optionally only receiving data from the named inverters
+
+    The report is published to from every inverter thread, so it must be
+    thread safe, such as a PVReportWorker.
+    """
+    self.reports.append((report, set(inverters) if inverters else None))
+
+  def publish(self, name, registers):
+    # Tag the sample with its source so reports can tell the inverters apart
+    registers['inverter'] = name
+
+    for rpt, inverters in self.reports:
+      if inverters is not None and name not in inverters:
+        continue
+
+      # A failing report must not stop the others
+      try:
+        rpt.publish(registers)
+      except Exception as err:
+        _log.debug(traceback.format_exc())
+        _log.debug("{}: Ignoring = {}".format(name, err))
+
+  def start(self):
+    for task in self.tasks:
+      task.start()
+
+  def stop(self):
+    for task in self.tasks:
+      task.stop()
+
+  def summary(self):
+    """Logs the stage timings, and writes them to the dump path"""
+    _log.info("Stage timings: {}".format(profiler.summary()))
+    if self.dump_path:
+      try:
+        profiler.write(self.dump_path)
+      except IOError as err:
+        _log.error("Unable to write {}: {}".format(self.dump_path, err))
+
+  def log_stats(self):
+    """Logs the stats of every inverter, and of every report keeping them"""
+    sources = [(task.name, task.stats) for task in self.tasks]
+    sources.extend(("report {}".format(getattr(rpt, 'name', type(rpt).__name__)), rpt.stats)
+                   for rpt, inverters in self.reports if hasattr(rpt, 'stats'))
+    for name, stats in sources:
+      try:
+        _log.info("{}: {}".format(name, format_stats(stats())))
+      except Exception as err:
+        _log.debug("{}: Unable to get the stats = {}".format(name, err))
+
+  def run(self):
+    """Runs the scheduler until interrupted"""
+    self.start()
+    last_summary = last_stats = monotonic()
+    try:
+      while any(task.is_alive() for task in self.tasks):
+        # Joining with a timeout keeps the main thread responsive to signals
+        for task in self.tasks:
+          task.join(1)
+
+        if (profiler.enabled and self.summary_interval > 0 and
+            monotonic() - last_summary >= self.summary_interval):
+          self.summary()
+          last_summary = monotonic()
+
+        if self.stats_interval > 0 and monotonic() - last_stats >= self.stats_interval:
+          self.log_stats()
+          last_stats = monotonic()
+    finally:
+      self.stop()
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVScheduler", "PVInverterTask", "PVAdaptivePolicy", "format_stats"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Append only on-disk spool of samples waiting to be published
+
+Samples are appended to numbered segment files as length and CRC prefixed
+records. The position of the last record the report acknowledged is kept in
+a separate file, so after a restart or an outage publishing resumes from
+where it left off. Segments are removed once they have been acknowledged,
+or when the spool grows beyond its size or age limits.
+"""
+
+from pvstats.codec import encode_sample, decode_sample
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+import logging
+_log = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('<II')
+
+class PVSpool(object):
+  def __init__(self, path, segment_bytes=1<<20, max_bytes=64<<20, max_age=30*86400,
+               fsync_records=32, fsync_interval=5.0):
+    self.path           = path
+    self.segment_bytes  = int(segment_bytes)
+    self.max_bytes      = int(max_bytes)
+    self.max_age        = float(max_age)
+    self.fsync_records  = int(fsync_records)
+    self.fsync_interval = float(fsync_interval)
+
+    self.appended = 0
+    self.lost     = 0
+
+    self._lock = threading.Lock()
+
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+    self.segments = sorted(int(n[:-4]) for n in os.listdir(path) if n.endswith('.seg'))
+    if not self.segments:
+      self.segments = [0]
+
+    self.position = self._load_ack()
+    if self.position[0] < self.segments[0]:
+      self.position = (self.segments[0], 0)
+
+    self._repair(self.segments[-1])
+    self._writer    = open(self._segment(self.segments[-1]), 'ab')
+    self._unsynced  = 0
+    self._last_sync = time.time()
+    self._expire()
+
+  def _segment(self, seg):
+    return os.path.join(self.path, "{:010d}.seg".format(seg))
+
+  def _load_ack(self):
+    try:
+      with open(os.path.join(self.path, 'ack')) as f:
+        seg, offset = f.read().split()
+        return (int(seg), int(offset))
+    except (IOError, ValueError):
+      return (0, 0)
+
+  def _save_ack(self):
+    # Write then rename, so a crash never leaves a half written position
+    tmp = os.path.join(self.path, 'ack.tmp')
+    with open(tmp, 'w') as f:
+      f.write("{} {}".format(*self.position))
+    os.rename(tmp, os.path.join(self.path, 'ack'))
+
+  def _repair(self, seg):
+    """Truncates a partially written record left at the end of a segment"""
+    name = self._segment(seg)
+    if not os.path.exists(name):
+      return
+
+    with open(name, 'r+b') as f:
+      good = 0
+      while True:
+        hdr = f.read(_HEADER.size)
+        if len(hdr) < _HEADER.size:
+          break
+        length, crc = _HEADER.unpack(hdr)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+          break
+        good = f.tell()
+
+      if good != os.fstat(f.fileno()).st_size:
+        _log.warning("Truncating damaged spool segment {} at {}".format(name, good))
+        f.truncate(good)
+
+  def append(self, data):
+    payload = encode_sample(data)
+    record  = _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    with self._lock:
+      self._writer.write(record)
+      self._writer.flush()
+      self.appended += 1
+
+      # Batch the fsyncs, they are expensive on SD cards
+      self._unsynced += 1
+      if (self._unsynced >= self.fsync_records or
+          time.time() - self._last_sync >= self.fsync_interval):
+        self._sync()
+
+      if self._writer.tell() >= self.segment_bytes:
+        self._rotate()
+
+  def _sync(self):
+    os.fsync(self._writer.fileno())
+    self._unsynced  = 0
+    self._last_sync = time.time()
+
+  def _rotate(self):
+    self._sync()
+    self._writer.close()
+    self.segments.append(self.segments[-1] + 1)
+    self._writer = open(self._segment(self.segments[-1]), 'ab')
+    self._expire()
+
+  def _expire(self):
+    """Drops the oldest segments while the spool is over its limits"""
+    sizes  = [os.path.getsize(self._segment(s)) for s in self.segments]
+    total  = sum(sizes)
+    cutoff = time.time() - self.max_age
+
+    while len(self.segments) > 1:
+      seg = self.segments[0]
+      if total <= self.max_bytes and os.path.getmtime(self._segment(seg)) >= cutoff:
+        break
+
+      if seg >= self.position[0]:
+        _log.warning("Spool {} is full, dropping unpublished segment {}".format(self.path, seg))
+        self.lost    += 1
+        self.position = (self.segments[1], 0)
+        self._save_ack()
+
+      os.remove(self._segment(seg))
+      total -= sizes.pop(0)
+      self.segments.pop(0)
+
+  def read(self, max_records=100, start=None):
+    """Reads unacknowledged records, from the position start if given
+
+    Returns a list of (record, position) pairs, passing a position to ack()
+    acknowledges its record and every record before it.
+    """
+    records = []
+    with self._lock:
+      # Segments before the acknowledged position may have been dropped
+      start       = self.position if start is None else max(start, self.position)
+      seg, offset = start
+
+      while len(records) < max_records:
+        with open(self._segment(seg), 'rb') as f:
+          f.seek(offset)
+          while len(records) < max_records:
+            hdr = f.read(_HEADER.size)
+            if len(hdr) < _HEADER.size:
+              break
+            length, crc = _HEADER.unpack(hdr)
+            payload = f.read(length)
+            if len(payload) < length:
+              break
+            if zlib.crc32(payload) & 0xffffffff != crc:
+              _log.warning("Skipping damaged record in {}".format(self._segment(seg)))
+              offset = os.fstat(f.fileno()).st_size
+              break
+            offset = f.tell()
+            records.append((decode_sample(payload), (seg, offset)))
+
+        # Carry on into the next segment if this one is exhausted
+        if len(records) < max_records and seg != self.segments[-1]:
+          seg, offset = self.segments[self.segments.index(seg) + 1], 0
+        else:
+          break
+
+      # Nothing to publish, but empty segments or damaged records may have
+      # been skipped over
+      if not records and start == self.position and (seg, offset) > self.position:
+        self.position = (seg, offset)
+
+    return records
+
+  def ack(self, position):
+    with self._lock:
+      if position <= self.position:
+        return
+      self.position = position
+      self._save_ack()
+
+      # Anything before the acknowledged segment has now been published
+      while self.segments[0] < position[0]:
+        os.remove(self._segment(self.segments.pop(0)))
+
+  def backlog(self):
+    """Approximate number of bytes waiting to be published"""
+    with self._lock:
+      total = 0
+      for seg in self.segments:
+        if seg >= self.position[0]:
+          total += os.path.getsize(self._segment(seg))
+      return total - self.position[1]
+
+  def close(self):
+    with self._lock:
+      self._sync()
+      self._writer.close()
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVSpool"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local time series store kept in a SQLite database
+
+Each register of each inverter is a series, and every sample is a row of
+(series, ts, value) in a table clustered on (series, ts), so a time range of
+one series is a single index range however large the database grows. The
+raw samples are rolled up into 1 minute, 15 minute and daily buckets holding
+the count, sum, min, max and last value, and each level is only kept for
+its retention period.
+
+The database runs in WAL mode with synchronous=NORMAL, so a batch of
+inserts costs one sequential write to the log rather than several random
+writes to the database, which matters on SD cards.
+"""
+
+from datetime import datetime
+import re
+import sqlite3
+import time
+
+import logging
+_log = logging.getLogger(__name__)
+
+# Rollup levels in seconds, each built from the one before
+LEVELS = (60, 900, 86400)
+
+# Days each level is kept for, 0 keeps it forever
+DEFAULT_RETENTION = {'raw': 7, '60': 90, '900': 730, '86400': 0}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+  name  TEXT PRIMARY KEY,
+  value INTEGER);
+CREATE TABLE IF NOT EXISTS series (
+  id       INTEGER PRIMARY KEY,
+  inverter TEXT NOT NULL,
+  device   INTEGER NOT NULL,
+  field    TEXT NOT NULL,
+  UNIQUE (inverter, device, field));
+CREATE TABLE IF NOT EXISTS samples (
+  series INTEGER NOT NULL,
+  ts     INTEGER NOT NULL,
+  value  REAL,
+  PRIMARY KEY (series, ts)) WITHOUT ROWID;
+"""
+
+_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_{0} (
+  series INTEGER NOT NULL,
+  ts     INTEGER NOT NULL,
+  count  INTEGER,
+  sum    REAL,
+  min    REAL,
+  max    REAL,
+  last   REAL,
+  PRIMARY KEY (series, ts)) WITHOUT ROWID;
+"""
+
+def _table(level):
+  return 'rollup_{}'.format(level) if level else 'samples'
+
+def _aggregate_sql(level, source, where):
+  """Selects the level buckets of the source level, within where"""
+  if source == 0:
+    aggregates, last = "count(*), sum(value), min(value), max(value)", "value"
+  else:
+    aggregates, last = "sum(count), sum(sum), min(min), max(max)", "last"
+
+  return ("SELECT g.series, g.bucket, {aggregates}, "
+          "(SELECT l.{last} FROM {table} l WHERE l.series = g.series AND l.ts >= g.bucket "
+          "AND l.ts < g.bucket + {level} ORDER BY l.ts DESC LIMIT 1) "
+          "FROM (SELECT *, ((ts + :offset) / {level}) * {level} - :offset AS bucket "
+          "FROM {table} WHERE {where}) g "
+          "GROUP BY g.series, g.bucket").format(aggregates=aggregates, last=last, level=level,
+                                                table=_table(source), where=where)
+
+def utc_offset():
+  """The local standard time offset, so daily buckets start at midnight"""
+  return -time.timezone
+
+def parse_time(value, now=None):
+  """Parses seconds since the epoch, a local ISO date and time, "now", or a
+  time relative to now such as "-6h" or "-7d"
+  """
+  now = time.time() if now is None else now
+  if value == 'now':
+    return int(now)
+
+  m = re.match(r'^-(\d+)([smhdw])$', value)
+  if m:
+    unit = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}[m.group(2)]
+    return int(now - int(m.group(1)) * unit)
+
+  if re.match(r'^\d+(\.\d*)?$', value):
+    return int(float(value))
+
+  for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+    try:
+      return int(time.mktime(datetime.strptime(value, fmt).timetuple()))
+    except ValueError:
+      pass
+  raise ValueError("Unable to parse time {}".format(value))
+
+class PVStore(object):
+  """The local time series database"""
+
+  def __init__(self, path, retention=None, offset=None):
+    self.path      = path
+    self.retention = dict(DEFAULT_RETENTION)
+    self.retention.update(retention or {})
+    self.offset    = utc_offset() if offset is None else int(offset)
+
+    # Only used by one thread at a time, but not always the one opening it
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.executescript(_SCHEMA + ''.join(_ROLLUP_SCHEMA.format(l) for l in LEVELS))
+
+    self._series = {}
+    for id, inverter, device, field in self.db.execute("SELECT id, inverter, device, field FROM series"):
+      self._series[(inverter, device, field)] = id
+
+    # Databases from before the range of ts was kept in the meta table have
+    # it found once
+    with self.db:
+      for level in (0,) + LEVELS:
+        self._bounds(level)
+
+    # The earliest sample inserted since the last rollup
+    self._dirty = None
+
+  def close(self):
+    self.db.close()
+
+  def series_id(self, inverter, device, field):
+    key = (inverter, device, field)
+    id  = self._series.get(key)
+    if id is None:
+      with self.db:
+        self.db.execute("INSERT OR IGNORE INTO series (inverter, device, field) VALUES (?, ?, ?)", key)
+        (id,) = self.db.execute("SELECT id FROM series WHERE inverter = ? AND device = ? AND field = ?",
+                                key).fetchone()
+      self._series[key] = id
+    return id
+
+  def series(self, inverter=None, field=None):
+    """Lists the (id, inverter, device, field) of the matching series"""
+    return sorted((id,) + key for key, id in self._series.iteritems()
+                  if (inverter is None or key[0] == inverter) and
+                     (field is None or key[2] == field))
+
+  def insert(self, rows):
+    """Writes a batch of (series, ts, value) rows in one transaction"""
+    if not rows:
+      return
+    earliest = min(r[1] for r in rows)
+    with self.db:
+      self.db.executemany("INSERT OR REPLACE INTO samples (series, ts, value) VALUES (?, ?, ?)", rows)
+      self._extend(0, earliest, max(r[1] for r in rows))
+
+    if self._dirty is None or earliest < self._dirty:
+      self._dirty = earliest
+
+  def _meta(self, name):
+    row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+  def _extend(self, level, first, latest):
+    """Widens the range of ts held in the level's table"""
+    for name, func, ts in (('first', 'min', first), ('latest', 'max', latest)):
+      name = '{}_{}'.format(name, _table(level))
+      self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES "
+                      "(?, {}(?, coalesce((SELECT value FROM meta WHERE name = ?), ?)))".format(func),
+                      (name, ts, name, ts))
+
+  def _bounds(self, level):
+    """The earliest and latest ts in the level's table
+
+    They are kept in the meta table, as finding them in a table clustered on
+    (series, ts) scans the whole table. The earliest may be from rows which
+    have since expired.
+    """
+    table  = _table(level)
+    bounds = (self._meta('first_' + table), self._meta('latest_' + table))
+    if bounds[1] is None:
+      # Empty, or from before the range was kept
+      bounds = self.db.execute("SELECT min(ts), max(ts) FROM {}".format(table)).fetchone()
+      if bounds[1] is not None:
+        self._extend(level, *bounds)
+    return bounds
+
+  def _bucket(self, ts, level):
+    return ((ts + self.offset) // level) * level - self.offset
+
+  def watermark(self, level):
+    """Buckets of the level before this time have been rolled up"""
+    return self._meta('watermark_{}'.format(level))
+
+  def rollup(self):
+    """Rolls up the complete buckets of every level
+
+    Only the buckets after each level's watermark are built, along with any
+    earlier ones which have since had samples inserted, such as when a
+    spooled backlog is replayed.
+    """
+    dirty  = self._dirty
+    source = 0
+    with self.db:
+      for level in LEVELS:
+        (first, latest) = self._bounds(source)
+        if latest is None:
+          break
+
+        start = self.watermark(level)
+        if start is None:
+          start = self._bucket(first, level)
+        if dirty is not None:
+          start = min(start, self._bucket(dirty, level))
+
+        # The bucket holding the latest sample is still filling up
+        end = self._bucket(latest, level)
+        if end > start:
+          self.db.execute("INSERT OR REPLACE INTO {} ".format(_table(level)) +
+                          _aggregate_sql(level, source, "series IN (SELECT id FROM series) "
+                                                        "AND ts >= :start AND ts < :end"),
+                          {'offset': self.offset, 'start': start, 'end': end})
+          self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                          ('watermark_{}'.format(level), end))
+          self._extend(level, start, end - level)
+
+        dirty  = start
+        source = level
+
+    self._dirty = None
+
+  def expire(self, now=None):
+    """Deletes the samples and buckets past their retention"""
+    now    = time.time() if now is None else now
+    levels = (0,) + LEVELS
+    with self.db:
+      for idx, level in enumerate(levels):
+        days = self.retention.get(str(level) if level else 'raw', 0)
+        if not days:
+          continue
+
+        # Never delete anything the next level has not been built from
+        cutoff = int(now - days * 86400)
+        if idx + 1 < len(levels):
+          cutoff = min(cutoff, self.watermark(levels[idx + 1]) or 0)
+
+        deleted = self.db.execute("DELETE FROM {} WHERE series IN (SELECT id FROM series) "
+                                  "AND ts < ?".format(_table(level)), (cutoff,)).rowcount
+        if deleted:
+          _log.debug("Expired {} rows from {}".format(deleted, _table(level)))
+
+  def choose_level(self, ids, start, end, max_points=1000, now=None):
+    """The finest level still holding the range which returns no more than
+    max_points per series
+    """
+    now = time.time() if now is None else now
+    for level in (0,) + LEVELS:
+      days = self.retention.get(str(level) if level else 'raw', 0)
+      if days and start < now - days * 86400:
+        continue
+
+      if level:
+        if (end - start) // level <= max_points:
+          return level
+      else:
+        # The sample period may differ per inverter, so count the raw rows
+        count = max([0] + [self.db.execute("SELECT count(*) FROM (SELECT 1 FROM samples WHERE series = ? "
+                                           "AND ts >= ? AND ts < ? LIMIT ?)",
+                                           (id, start, end, max_points + 1)).fetchone()[0] for id in ids])
+        if count <= max_points:
+          return 0
+    return LEVELS[-1]
+
+  def query(self, ids, start, end, level):
+    """Returns (series, ts, count, mean, min, max, last) rows of the range
+
+    The buckets after the level's watermark are aggregated from the raw
+    samples, so the range is answered right up to the latest sample.
+    """
+    where = "series IN ({}) AND ts >= :start AND ts < :end".format(','.join(str(int(i)) for i in ids))
+    args  = {'start': start, 'end': end, 'offset': self.offset}
+
+    if level == 0:
+      rows = self.db.execute("SELECT series, ts, 1, value, value, value, value FROM samples "
+                             "WHERE " + where + " ORDER BY series, ts", args).fetchall()
+      return rows
+
+    watermark = self.watermark(level) or start
+    rows      = self.db.execute("SELECT series, ts, count, sum, min, max, last FROM {} WHERE {} "
+                                "AND ts < :watermark ORDER BY series, ts".format(_table(level), where),
+                                dict(args, watermark=watermark)).fetchall()
+    if watermark < end:
+      rows += self.db.execute(_aggregate_sql(level, 0, where) + " ORDER BY g.series, g.bucket",
+                              dict(args, start=max(start, watermark))).fetchall()
+      rows.sort()
+
+    return [(s, ts, n, total / n if n else None, lo, hi, last)
+            for s, ts, n, total, lo, hi, last in rows]
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVStore", "LEVELS", "DEFAULT_RETENTION", "parse_time"
+]
+
+# vim: set expandtab ts=2 sw=2:
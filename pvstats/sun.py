@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sunrise and sunset from the latitude and longitude
+
+Uses the NOAA general solar position approximation, which is good to a
+minute or two away from the poles and needs no network access. Latitudes
+are positive north and longitudes positive east, and all times are seconds
+since the epoch.
+"""
+
+import math
+import time
+
+_DAY = 86400
+
+# The zenith of sunrise and sunset, allowing for refraction and the size of
+# the sun's disc
+ZENITH = 90.833
+
+def _solar_date(when, longitude):
+  # The UTC midnight of the date of the local solar day
+  return (int(when + longitude * 240) // _DAY) * _DAY
+
+def sun_times(when, latitude, longitude):
+  """Returns the (sunrise, sunset) of the solar day holding when
+
+  Both are None while the sun stays below the horizon all day, and while it
+  stays above they are the solar midnights at either end of the day.
+  """
+  # Using the date of the local solar day, so the times bracket local noon
+  midnight = _solar_date(when, longitude)
+  doy      = time.gmtime(midnight).tm_yday
+
+  # Fractional year, then the equation of time in minutes and declination
+  gamma = 2 * math.pi / 365 * (doy - 1)
+  eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+                     - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+  decl = (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma)
+          - 0.006758 * math.cos(2 * gamma) + 0.000907 * math.sin(2 * gamma)
+          - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+
+  lat    = math.radians(latitude)
+  cos_ha = (math.cos(math.radians(ZENITH)) / (math.cos(lat) * math.cos(decl))
+            - math.tan(lat) * math.tan(decl))
+  noon = 720 - 4 * longitude - eqtime
+  if cos_ha > 1:
+    return None, None
+  if cos_ha < -1:
+    return midnight + (noon - 720) * 60, midnight + (noon + 720) * 60
+
+  ha   = math.degrees(math.acos(cos_ha))
+  return midnight + (noon - 4 * ha) * 60, midnight + (noon + 4 * ha) * 60
+
+def is_daylight(when, latitude, longitude, margin=0):
+  """True if when lies between sunrise and sunset, widened by margin seconds"""
+  sunrise, sunset = sun_times(when, latitude, longitude)
+  if sunrise is None:
+    return False
+  return sunrise - margin <= when <= sunset + margin
+
+def next_daylight(when, latitude, longitude, margin=0):
+  """The start of the next daylight, widened by margin seconds, or when
+  itself if it is already daylight
+  """
+  for day in range(0, 366):
+    sunrise, sunset = sun_times(when + day * _DAY, latitude, longitude)
+    if sunrise is not None and sunset + margin >= when:
+      return max(when, sunrise - margin)
+  return None
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "sun_times", "is_daylight", "next_daylight"
+]
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pvstats.deadband import PVDeadbandFilter
+from pvstats.spool import PVSpool
+from pvstats.timing import profiler
+
+import Queue
+import os
+import threading
+import time
+import traceback
+
+import logging
+_log = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK       = 'block'
+
+_STOP = object()
+
+class PVReportWorker(object):
+  """Runs a report on its own thread behind a bounded queue
+
+  publish() only queues the sample, so a slow report can never hold up the
+  sampling. When the queue is full the drop policy decides whether the
+  oldest queued sample, the new sample, or the caller gives way.
+
+  With a spool configured the worker moves the queued samples on to disk,
+  and they are only removed once the report has published them, and for a
+  report buffering its writes once it has flushed them. While the report is
+  failing the worker retries with a backoff, then replays the backlog in
+  bulk once it recovers.
+
+  With report_by_exception configured, samples which have not changed
+  enough since the last one are dropped before being queued.
+  """
+
+  def __init__(self, report, cfg):
+    self.report = report
+    self.name   = cfg.get('name', cfg['type'])
+    self.policy = cfg.get('drop_policy', DROP_OLDEST)
+    if self.policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+      raise ValueError("Unknown drop_policy {}".format(self.policy))
+
+    self.queue  = Queue.Queue(int(cfg.get('queue_size', 100)))
+    self.spool  = None
+    self.filter = None
+
+    if cfg.get('report_by_exception'):
+      self.filter = PVDeadbandFilter(cfg['report_by_exception'])
+
+    spool = cfg.get('spool')
+    if spool:
+      self.spool = PVSpool(os.path.join(spool['path'], self.name),
+                           segment_bytes  = spool.get('segment_bytes', 1<<20),
+                           max_bytes      = spool.get('max_bytes', 64<<20),
+                           max_age        = spool.get('max_age', 30*86400),
+                           fsync_records  = spool.get('fsync_records', 32),
+                           fsync_interval = spool.get('fsync_interval', 5.0))
+      self.replay_rate = float(spool.get('replay_rate', 0))
+      self.retry_min   = float(spool.get('retry_min', 5))
+      self.retry_max   = float(spool.get('retry_max', 300))
+
+    self._stopping = threading.Event()
+
+    # The cProfile runner for --profile
+    self.cprofile = None
+    self._stage   = "report.{}".format(self.name)
+
+    self.published     = 0
+    self.failed        = 0
+    self.dropped       = 0
+    self.latency_last  = 0.0
+    self.latency_max   = 0.0
+    self.latency_total = 0.0
+
+    self._thread = threading.Thread(target=self._run_spool if self.spool else self._run,
+                                    name="pvstats-{}".format(self.name))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def publish(self, data):
+    if self.filter and not self.filter.accept(data):
+      return
+
+    # The inverters may reuse their register dict, so queue a snapshot
+    sample = dict(data)
+
+    if self.policy == BLOCK:
+      self.queue.put(sample)
+      return
+
+    while True:
+      try:
+        self.queue.put_nowait(sample)
+        return
+      except Queue.Full:
+        self.dropped += 1
+        if self.policy == DROP_NEWEST:
+          return
+
+      try:
+        self.queue.get_nowait()
+      except Queue.Empty:
+        pass
+
+  def depth(self):
+    """The number of samples waiting in the queue"""
+    return self.queue.qsize()
+
+  def spooled(self):
+    """The bytes of samples waiting in the spool"""
+    return self.spool.backlog() if self.spool else 0
+
+  def stats(self):
+    stats = {'depth':         self.depth(),
+             'spooled':       self.spooled(),
+             'lost':          self.spool.lost if self.spool else 0,
+             'published':     self.published,
+             'failed':        self.failed,
+             'dropped':       self.dropped,
+             'suppressed':    self.filter.suppressed if self.filter else 0,
+             'latency_last':  self.latency_last,
+             'latency_max':   self.latency_max,
+             'latency_avg':   self.latency_total / max(self.published + self.failed, 1)}
+
+    # Along with any stats of the report itself, such as the PVOutput quota
+    report_stats = getattr(self.report, 'stats', None)
+    if report_stats is not None:
+      stats.update(report_stats())
+    return stats
+
+  def stop(self, timeout=None):
+    """Publishes the queued samples then stops the worker
+
+    Returns within timeout seconds if given. When the report is stuck with
+    the queue full the queued samples are dropped, the spooled ones are kept
+    for the next run.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+      self.queue.put(_STOP, True, timeout)
+    except Queue.Full:
+      _log.warning("{}: Stopping with {} samples queued".format(self.name, self.queue.qsize()))
+      self._stopping.set()
+
+    self._thread.join(None if deadline is None else max(deadline - time.time(), 0))
+    if self._thread.is_alive():
+      _log.warning("{}: Still publishing, not waiting for it".format(self.name))
+    elif self.spool:
+      self.spool.close()
+
+  def _publish(self, data):
+    if self.cprofile is not None:
+      return self.cprofile.call(self._stage, self._timed_publish, data)
+    return self._timed_publish(data)
+
+  def _timed_publish(self, data):
+    tstart = time.time()
+    try:
+      self.report.publish(data)
+      self.published += 1
+      return True
+    except Exception as err:
+      self.failed += 1
+      _log.debug(traceback.format_exc())
+      _log.debug("{}: Ignoring = {}".format(self.name, err))
+      return False
+    finally:
+      self.latency_last   = time.time() - tstart
+      self.latency_max    = max(self.latency_max, self.latency_last)
+      self.latency_total += self.latency_last
+      profiler.record(self._stage, self.latency_last)
+
+  def _flush(self):
+    # Reports which batch their writes send what they have buffered
+    flush = getattr(self.report, 'flush', None)
+    if flush is not None:
+      try:
+        flush()
+      except Exception as err:
+        _log.debug("{}: Flush failed = {}".format(self.name, err))
+        return False
+    return True
+
+  def _run(self):
+    while not self._stopping.is_set():
+      data = self.queue.get()
+      if data is _STOP:
+        break
+      self._publish(data)
+    self._flush()
+
+  def _spool_queued(self, timeout, drain=False):
+    """Moves the queued samples on to the spool
+
+    Waits up to timeout seconds for a sample, or with drain keeps spooling
+    them for the whole timeout.
+    """
+    deadline = time.time() + timeout
+    while True:
+      try:
+        data = self.queue.get(True, max(deadline - time.time(), 0))
+      except Queue.Empty:
+        return
+      if data is _STOP:
+        self._stopping.set()
+        return
+      self.spool.append(data)
+      if not drain:
+        # Only take the samples which are already queued
+        deadline = 0
+
+  def _run_spool(self):
+    # The appends, fsyncs and segment rotation of the spool are done here
+    # rather than in publish, so they never hold up the sampling
+    retry  = 0
+    cursor = None
+
+    # A report buffering its writes counts its flushes, and the samples are
+    # only removed from the spool once a flush has written them out
+    flushes = getattr(self.report, 'flushes', None)
+
+    while not self._stopping.is_set():
+      self._spool_queued(0)
+
+      records = self.spool.read(start=cursor)
+      if not records:
+        self._spool_queued(1.0)
+        continue
+
+      published = False
+      for data, pos in records:
+        if self._stopping.is_set() or not self._publish(data):
+          break
+        cursor    = pos
+        published = True
+
+        if flushes is not None and self.report.flushes != flushes:
+          # Flushed while publishing this sample, so it is written out too
+          flushes = self.report.flushes
+          self.spool.ack(cursor)
+
+        # Replaying a backlog, optionally limit the rate
+        if self.replay_rate > 0 and len(records) > 1:
+          time.sleep(1.0 / self.replay_rate)
+
+      if published:
+        if flushes is None:
+          self.spool.ack(cursor)
+        retry = 0
+      elif not self._stopping.is_set():
+        # The report is failing, leave the samples on disk and try again later
+        retry = min(max(retry * 2, self.retry_min), self.retry_max)
+        _log.debug("{}: Retrying in {}s, {} bytes spooled".format(
+                   self.name, retry, self.spool.backlog()))
+        self._spool_queued(retry, drain=True)
+
+    # Whatever was queued when stopping is spooled for the next run, and
+    # what was published is written out
+    self._spool_queued(0)
+    if self._flush() and cursor is not None:
+      self.spool.ack(cursor)
+
+
+#-----------------
+# Exported symbols
+#-----------------
+__all__ = [
+  "PVReportWorker", "DROP_OLDEST", "DROP_NEWEST", "BLOCK"
+]
+
+# vim: set expandtab ts=2 sw=2:
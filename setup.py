@@ -24,7 +24,7 @@ to install the package from the source archive.
 from distutils.core import setup
 from setuptools import find_packages
 
-print find_packages(exclude=['test'])
+print find_packages(exclude=['test', 'benchmark', 'benchmark.*'])
 
 setup(name='pvstats',
       version='1.0',
@@ -48,7 +48,8 @@ setup(name='pvstats',
       ],
       keywords='photovoltaics,influxdb,pvoutput.org',
       # TODO: I don't really understand packages
-      packages=find_packages(exclude=['test']),
+      packages=find_packages(exclude=['test', 'benchmark', 'benchmark.*']),
+      package_data={'pvstats.pvinverter': ['profiles/*.json']},
       install_requires=[
         'pymodbus',
         'influxdb',
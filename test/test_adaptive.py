@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Adapting the read period to the sun and the inverter's state
+"""
+
+import calendar
+import unittest
+
+from pvstats.sun import sun_times, is_daylight, next_daylight
+from pvstats.scheduler import (PVAdaptivePolicy, PVInverterTask,
+                               NORMAL, FAST, IDLE, OFFLINE, NIGHT)
+from pvstats.pvinverter.factory import PVInverterFactory
+
+def utc(*args):
+  return calendar.timegm(args + (0,) * (6 - len(args)))
+
+LONDON  = (51.5074, -0.1278)
+SYDNEY  = (-33.8688, 151.2093)
+TROMSO  = (69.6492, 18.9553)
+EQUATOR = (0.0, 0.0)
+
+# The place, a time on the day, and the published sunrise and sunset in UTC
+SUN_TIMES = [
+  (LONDON,  utc(2018, 6, 21, 12),  utc(2018, 6, 21, 3, 43),  utc(2018, 6, 21, 20, 21)),
+  (LONDON,  utc(2018, 12, 21, 12), utc(2018, 12, 21, 8, 4),  utc(2018, 12, 21, 15, 54)),
+  (SYDNEY,  utc(2018, 6, 21, 2),   utc(2018, 6, 20, 21, 0),  utc(2018, 6, 21, 6, 54)),
+  (EQUATOR, utc(2018, 3, 20, 12),  utc(2018, 3, 20, 6, 4),   utc(2018, 3, 20, 18, 11)),
+]
+
+# Minutes of slack, for the approximation and the published rounding
+SLACK = 5 * 60
+
+class TestSun(unittest.TestCase):
+  def test_sun_times(self):
+    for (lat, lon), when, sunrise, sunset in SUN_TIMES:
+      rise, set_ = sun_times(when, lat, lon)
+      self.assertLess(abs(rise - sunrise), SLACK, (lat, lon, rise - sunrise))
+      self.assertLess(abs(set_ - sunset), SLACK, (lat, lon, set_ - sunset))
+
+  def test_same_solar_day(self):
+    # Any time of the local day gives the same sunrise and sunset
+    lat, lon = SYDNEY
+    times = [sun_times(utc(2018, 6, 20, 15) + hour * 3600, lat, lon) for hour in range(0, 24, 3)]
+    self.assertEqual(len(set(times)), 1)
+
+  def test_polar(self):
+    lat, lon = TROMSO
+    self.assertEqual(sun_times(utc(2018, 12, 21, 12), lat, lon), (None, None))
+    self.assertFalse(is_daylight(utc(2018, 12, 21, 12), lat, lon, 1800))
+
+    # The midnight sun stays up all day
+    for hour in (0, 6, 12, 18, 23):
+      self.assertTrue(is_daylight(utc(2018, 6, 21, hour), lat, lon))
+
+    # The next daylight after the polar night is in the new year
+    dawn = next_daylight(utc(2018, 12, 21, 12), lat, lon)
+    self.assertTrue(utc(2019, 1, 10) < dawn < utc(2019, 1, 20))
+
+  def test_is_daylight(self):
+    lat, lon = LONDON
+    self.assertTrue(is_daylight(utc(2018, 6, 21, 12), lat, lon))
+    self.assertFalse(is_daylight(utc(2018, 6, 21, 1), lat, lon))
+    self.assertFalse(is_daylight(utc(2018, 6, 21, 3, 30), lat, lon))
+    self.assertTrue(is_daylight(utc(2018, 6, 21, 3, 30), lat, lon, margin=1800))
+
+  def test_next_daylight(self):
+    lat, lon = LONDON
+    noon = utc(2018, 6, 21, 12)
+    self.assertEqual(next_daylight(noon, lat, lon), noon)
+
+    # Before dawn, and after dusk the next morning
+    sunrise, _ = sun_times(noon, lat, lon)
+    self.assertEqual(next_daylight(utc(2018, 6, 21, 1), lat, lon), sunrise)
+    self.assertEqual(next_daylight(utc(2018, 6, 21, 1), lat, lon, 1800), sunrise - 1800)
+    tomorrow, _ = sun_times(noon + 86400, lat, lon)
+    self.assertEqual(next_daylight(utc(2018, 6, 21, 22), lat, lon), tomorrow)
+
+class TestAdaptivePolicy(unittest.TestCase):
+  NOON  = utc(2018, 6, 21, 12)
+  NIGHT = utc(2018, 6, 21, 1)
+
+  def policy(self, **cfg):
+    cfg.setdefault('latitude',  LONDON[0])
+    cfg.setdefault('longitude', LONDON[1])
+    return PVAdaptivePolicy(cfg, 10)
+
+  def test_normal(self):
+    policy = self.policy()
+    self.assertEqual(policy.next_period(True, 1000, self.NOON), (NORMAL, 10))
+    self.assertEqual(policy.next_period(True, 1100, self.NOON + 10), (NORMAL, 10))
+
+  def test_idle(self):
+    policy = self.policy(idle_power=10, idle_period=60)
+    self.assertEqual(policy.next_period(True, 10, self.NOON), (IDLE, 60))
+    self.assertEqual(policy.next_period(True, None, self.NOON), (IDLE, 60))
+    self.assertEqual(policy.next_period(True, 11, self.NOON), (NORMAL, 10))
+
+    # Never slower than the sample period
+    policy = self.policy(idle_period=5)
+    self.assertEqual(policy.next_period(True, 0, self.NOON), (IDLE, 10))
+
+  def test_offline_backoff(self):
+    policy  = self.policy(offline_period=60)
+    periods = [policy.next_period(False, None, self.NOON) for _ in range(5)]
+    self.assertEqual(periods, [(OFFLINE, 10), (OFFLINE, 20), (OFFLINE, 40),
+                               (OFFLINE, 60), (OFFLINE, 60)])
+
+    # A successful read ends the backoff straight away
+    self.assertEqual(policy.next_period(True, 1000, self.NOON), (NORMAL, 10))
+    self.assertEqual(policy.next_period(False, None, self.NOON), (OFFLINE, 10))
+
+  def test_fast(self):
+    policy = self.policy(fast_period=2, fast_hold=60, variability=0.2)
+    policy.next_period(True, 1000, self.NOON)
+    self.assertEqual(policy.next_period(True, 1300, self.NOON + 10), (FAST, 2))
+
+    # Held for fast_hold after the last big change
+    self.assertEqual(policy.next_period(True, 1310, self.NOON + 40), (FAST, 2))
+    self.assertEqual(policy.next_period(True, 1320, self.NOON + 69), (FAST, 2))
+    self.assertEqual(policy.next_period(True, 1330, self.NOON + 70), (NORMAL, 10))
+
+    # A change within variability does not start it
+    self.assertEqual(policy.next_period(True, 1550, self.NOON + 80), (NORMAL, 10))
+
+  def test_night(self):
+    policy = self.policy(night_period=900, daylight_margin=1800)
+    self.assertEqual(policy.next_period(True, 0, self.NIGHT), (NIGHT, 900))
+    self.assertEqual(policy.next_period(False, None, self.NIGHT), (NIGHT, 900))
+
+    # Close to dawn the next read lands on the start of daylight
+    sunrise, _ = sun_times(self.NOON, *LONDON)
+    now = sunrise - 1800 - 300
+    state, period = policy.next_period(True, 0, now)
+    self.assertEqual((state, round(period)), (NIGHT, 300))
+
+    # Then idle through the margin until the power comes up, which is read
+    # fast as it climbs
+    self.assertEqual(policy.next_period(True, 0, sunrise - 1500), (IDLE, 60))
+    self.assertEqual(policy.next_period(True, 50, sunrise + 600), (FAST, 2))
+    self.assertEqual(policy.next_period(True, 55, sunrise + 700), (NORMAL, 10))
+
+  def test_power_at_night(self):
+    # Still producing, the location must be off, so it is read as usual
+    policy = self.policy()
+    self.assertEqual(policy.next_period(True, 1000, self.NIGHT), (NORMAL, 10))
+
+  def test_without_location(self):
+    policy = PVAdaptivePolicy({}, 10)
+    self.assertEqual(policy.next_period(True, 0, self.NIGHT), (IDLE, 60))
+    self.assertRaises(ValueError, PVAdaptivePolicy, {'latitude': 51.5}, 10)
+
+  def test_task_transitions(self):
+    task = PVInverterTask('roof', PVInverterFactory('test', {}), 10, None,
+                          PVAdaptivePolicy({'offline_period': 60}, 10))
+    self.assertEqual(task._next_period(False, None), 10)
+    self.assertEqual(task.state, OFFLINE)
+    self.assertEqual(task._next_period(False, None), 20)
+    self.assertEqual(task._next_period(True, 1000), 10)
+    self.assertEqual(task.state, NORMAL)
+    self.assertEqual(task.stats()['state'], NORMAL)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
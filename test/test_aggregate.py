@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rolling samples up into aligned time windows
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import time
+import unittest
+
+from pvstats.aggregate import RunningStats, PVWindow, PVAggregator, sample_time
+
+# A window boundary, 10:00 local time
+START = time.mktime(datetime(2018, 6, 1, 10, 0, 0).timetuple())
+
+class TestRunningStats(unittest.TestCase):
+  def test_summary(self):
+    stats = RunningStats()
+    self.assertEqual(stats.summary(), {'mean': None, 'min': None, 'max': None,
+                                       'last': None, 'count': 0})
+    for value in (3, Decimal('1.5'), 4.5):
+      stats.add(value)
+    self.assertEqual(stats.summary(), {'mean': 3.0, 'min': 1.5, 'max': 4.5,
+                                       'last': 4.5, 'count': 3})
+
+class TestWindow(unittest.TestCase):
+  def test_boundaries(self):
+    window = PVWindow(300, ['power'], energy_field='power')
+
+    # Every sample up to, but not on, the boundary is in the first window
+    for ts in range(0, 300, 10):
+      self.assertIsNone(window.add(START + ts, {'power': ts}))
+
+    # The first sample on the boundary closes it
+    result = window.add(START + 300, {'power': 300})
+    self.assertEqual(result['start'], START)
+    self.assertEqual(result['end'], START + 300)
+    self.assertEqual(result['power']['count'], 30)
+    self.assertEqual(result['power']['min'], 0)
+    self.assertEqual(result['power']['max'], 290)
+    self.assertEqual(result['power']['mean'], 145)
+    self.assertEqual(result['last'], {'power': 290})
+
+    # And starts the next
+    self.assertEqual(window.start, START + 300)
+    self.assertEqual(window.summary()['power']['count'], 1)
+
+  def test_aligned_to_period(self):
+    # Samples start mid window, which still closes on the period boundary
+    window = PVWindow(300, ['power'])
+    self.assertIsNone(window.add(START + 299, {'power': 1}))
+    self.assertEqual(window.start, START)
+    result = window.add(START + 301, {'power': 2})
+    self.assertEqual((result['start'], result['power']['count']), (START, 1))
+
+  def test_skipped_windows(self):
+    # Without a max_gap an empty window is skipped, not reported
+    window = PVWindow(300, ['power'])
+    window.add(START, {'power': 1})
+    result = window.add(START + 900, {'power': 2})
+    self.assertEqual(result['start'], START)
+    self.assertEqual(window.start, START + 900)
+
+  def test_energy(self):
+    # A steady 1200W is 100Wh each five minutes, whatever the sample times
+    window = PVWindow(300, [])
+    energies = []
+    for ts in range(0, 1201, 7):
+      result = window.add(START + ts, {'total_pv_power': 1200})
+      if result is not None:
+        energies.append(result['energy'])
+    total = sum(energies) + window.energy
+
+    # The span across a boundary is counted in the window it ends in
+    self.assertAlmostEqual(energies[0], 1200 * 294 / 3600.0)
+    self.assertAlmostEqual(total, 1200 * 1197 / 3600.0)
+
+  def test_energy_trapezoid(self):
+    window = PVWindow(3600, [])
+    window.add(START, {'total_pv_power': 0})
+    window.add(START + 1800, {'total_pv_power': 1000})
+    self.assertAlmostEqual(window.energy, 250)
+
+  def test_gap_discards_partial_window(self):
+    window = PVWindow(300, ['power'], max_gap=60)
+    window.add(START, {'power': 1})
+    window.add(START + 30, {'power': 1})
+
+    # The window is dropped rather than averaged over the gap
+    self.assertIsNone(window.add(START + 200, {'power': 5}))
+    self.assertEqual(window.summary()['power']['count'], 1)
+    self.assertEqual(window.energy, 0)
+
+    window.add(START + 250, {'power': 7})
+    result = window.add(START + 300, {'power': 9})
+    self.assertEqual(result['power']['count'], 2)
+    self.assertEqual(result['power']['mean'], 6)
+
+    # Without the power field the gaps are still found
+    self.assertIsNone(window.add(START + 400, {'power': 1}))
+    self.assertEqual(window.summary()['power']['count'], 1)
+
+  def test_gap_resets_energy(self):
+    window = PVWindow(300, [], max_gap=60)
+    window.add(START, {'total_pv_power': 1000})
+    window.add(START + 120, {'total_pv_power': 1000})
+    window.add(START + 180, {'total_pv_power': 1000})
+    self.assertAlmostEqual(window.energy, 1000 * 60 / 3600.0)
+
+  def test_missing_fields(self):
+    window = PVWindow(300, ['power', 'temp'])
+    window.add(START, {'power': 1})
+    window.add(START + 10, {'temp': 30})
+    result = window.summary()
+    self.assertEqual(result['power']['count'], 1)
+    self.assertEqual(result['temp']['count'], 1)
+
+class TestAggregator(unittest.TestCase):
+  def test_windows(self):
+    fives, hours = [], []
+    aggregator = PVAggregator()
+    aggregator.add_window(PVWindow(300,  ['total_pv_power']), fives.append)
+    aggregator.add_window(PVWindow(3600, ['total_pv_power']), hours.append)
+
+    first = datetime(2018, 6, 1, 10, 0, 0)
+    for step in range(0, 2 * 360 + 1):
+      aggregator.add({'timestamp': first + timedelta(seconds=step * 10),
+                      'total_pv_power': 600})
+
+    self.assertEqual(len(fives), 24)
+    self.assertEqual(len(hours), 2)
+    self.assertEqual([w['start'] for w in hours], [START, START + 3600])
+    self.assertEqual(fives[12]['start'], START + 3600)
+    self.assertAlmostEqual(sum(w['energy'] for w in fives), sum(w['energy'] for w in hours))
+    self.assertAlmostEqual(hours[1]['energy'], 600)
+
+  def test_sample_time(self):
+    self.assertEqual(sample_time({'timestamp': datetime(2018, 6, 1, 10, 0, 0)}), START)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Report by exception deadbands, with Decimal and float registers
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import unittest
+
+import pvstats.deadband as deadband
+from pvstats.deadband import PVDeadbandFilter
+
+from test.test_reconnect import _Clock
+
+CFG = {'deadbands': {'total_pv_power': {'abs': 20}, 'internal_temp': {'pct': 2}},
+       'heartbeat': 300}
+
+class _DeadbandTests(object):
+  """Run with the registers as each numeric type"""
+
+  number = None
+
+  def setUp(self):
+    self.clock  = _Clock()
+    self._time  = deadband.time
+    deadband.time = self.clock
+    self.filter = PVDeadbandFilter(CFG)
+    self.cycle  = 0
+
+  def tearDown(self):
+    deadband.time = self._time
+
+  def accept(self, power=1000, temp=40, inverter='roof'):
+    """Offers the next sample, 10 seconds after the last"""
+    self.cycle      += 1
+    self.clock.now  += 10
+    return self.filter.accept({'timestamp':      datetime(2018, 6, 1) + timedelta(seconds=10 * self.cycle),
+                               'inverter':       inverter,
+                               'total_pv_power': self.number(power),
+                               'internal_temp':  self.number(temp)})
+
+  def test_first_sample_passed(self):
+    self.assertTrue(self.accept())
+
+  def test_abs_threshold(self):
+    self.accept(power=1000)
+    self.assertFalse(self.accept(power=1020))
+    self.assertTrue(self.accept(power=1021))
+
+  def test_abs_compared_with_the_last_sample_passed(self):
+    self.accept(power=1000)
+    self.assertFalse(self.accept(power=1015))
+    self.assertFalse(self.accept(power=985))
+    self.assertTrue(self.accept(power=1025))
+
+  def test_pct_threshold(self):
+    self.accept(temp=50)
+    self.assertFalse(self.accept(temp=51))
+    self.assertTrue(self.accept(temp=51.5))
+    self.assertFalse(self.accept(temp=50.5))
+    self.assertTrue(self.accept(temp=50))
+
+  def test_heartbeat(self):
+    self.accept()
+    results = [self.accept() for _ in range(30)]
+    self.assertEqual(results, [False] * 29 + [True])
+
+  def test_duplicate_dropped(self):
+    self.accept()
+    self.cycle -= 1
+    self.clock.now += 300
+    self.assertFalse(self.accept(power=2000))
+    self.assertEqual(self.filter.suppressed, 1)
+
+  def test_sources_tracked_separately(self):
+    self.accept(inverter='roof')
+    self.cycle -= 1
+    self.assertTrue(self.accept(inverter='shed'))
+    self.assertFalse(self.accept(inverter='shed'))
+
+  def test_unlisted_registers_not_compared(self):
+    self.accept()
+    self.assertFalse(self.filter.accept({'timestamp': datetime(2018, 6, 2), 'inverter': 'roof',
+                                         'total_pv_power': self.number(1000),
+                                         'internal_temp':  self.number(40),
+                                         'pv1_voltage':    self.number(300)}))
+
+class TestDecimalDeadband(_DeadbandTests, unittest.TestCase):
+  number = staticmethod(lambda v: Decimal(str(v)))
+
+class TestFloatDeadband(_DeadbandTests, unittest.TestCase):
+  number = staticmethod(float)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Decoding the registers described by a device profile
+"""
+
+from decimal import Decimal
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pvstats.pvinverter.device_profile import (load_profile, profile_path, register_map,
+                                               plan_reads, ModbusReadSpan)
+
+# The type, word order, registers as read and the raw value they hold
+DECODE = [
+  ('U16', 'big',    [0x0000],         0),
+  ('U16', 'big',    [0xffff],         65535),
+  ('S16', 'big',    [0x0001],         1),
+  ('S16', 'big',    [0xffff],         -1),
+  ('S16', 'big',    [0x8000],         -32768),
+  ('S16', 'little', [0xff38],         -200),
+  ('U32', 'big',    [0x0001, 0x0002], 0x00010002),
+  ('U32', 'little', [0x0002, 0x0001], 0x00010002),
+  ('U32', 'big',    [0xffff, 0xffff], 0xffffffff),
+  ('U32', 'little', [0x86a0, 0x0001], 100000),
+  ('S32', 'big',    [0xffff, 0xfffe], -2),
+  ('S32', 'little', [0xfffe, 0xffff], -2),
+  ('S32', 'big',    [0x8000, 0x0000], -0x80000000),
+  ('S32', 'little', [0x0000, 0x8000], -0x80000000),
+  ('S32', 'big',    [0x0001, 0x86a0], 100000),
+]
+
+# The scale, raw register and the value in each numeric mode
+SCALE = [
+  (1,                0xfffe, 65534,             65534),
+  (Decimal('0.1'),   2406,   Decimal('240.6'),  240.6),
+  (Decimal('0.01'),  5002,   Decimal('50.02'),  50.02),
+  (Decimal('100'),   123,    Decimal('12300'),  12300.0),
+]
+
+def profile(registers, word_order='big'):
+  return {'model': 'test', 'word_order': word_order, 'registers': registers}
+
+class TestDecode(unittest.TestCase):
+  def test_types(self):
+    for rtype, word_order, registers, expected in DECODE:
+      span = ModbusReadSpan('input', 0, len(registers),
+                            ((0, 'value', 1, rtype, None),), word_order)
+      self.assertEqual(span.decode(registers), [('value', expected)],
+                       "{} {} {}".format(rtype, word_order, registers))
+
+  def test_scales(self):
+    for scale, raw, decimal, real in SCALE:
+      regmap = register_map(profile({'input': [
+        {'address': 1, 'name': 'value', 'type': 'U16', 'scale': str(scale)}]}))
+      (value,) = plan_reads(regmap, numeric='decimal')[0].decode([raw])
+      self.assertEqual(value, ('value', decimal))
+      self.assertIsInstance(value[1], Decimal)
+
+      (value,) = plan_reads(regmap, numeric='float')[0].decode([raw])
+      self.assertAlmostEqual(value[1], real)
+      self.assertIsInstance(value[1], float)
+
+  def test_signed_scaled(self):
+    regmap = register_map(profile({'input': [
+      {'address': 1, 'name': 'temp',  'type': 'S16', 'scale': '0.1'},
+      {'address': 2, 'name': 'power', 'type': 'S32', 'scale': '0.5'}]}))
+    span = plan_reads(regmap, word_order='little')[0]
+    self.assertEqual(dict(span.decode([0xfff6, 0xfffd, 0xffff])),
+                     {'temp': Decimal('-1.0'), 'power': Decimal('-1.5')})
+
+  def test_unscaled_stays_integer(self):
+    regmap = register_map(profile({'holding': [{'address': 1, 'name': 'year'}]}))
+    (value,) = plan_reads(regmap, numeric='float')[0].decode([2018])
+    self.assertEqual(value, ('year', 2018))
+    self.assertIsInstance(value[1], int)
+
+  def test_enum(self):
+    regmap = register_map(profile({'input': [
+      {'address': 1, 'name': 'state', 'type': 'U16', 'enum': {'0': 'run', '32768': 'stop'}}]}))
+    span = plan_reads(regmap)[0]
+    self.assertEqual(span.decode([0]),      [('state', 'run')])
+    self.assertEqual(span.decode([0x8000]), [('state', 'stop')])
+    # An unknown value is kept as it is
+    self.assertEqual(span.decode([7]),      [('state', 7)])
+
+  def test_gaps_skipped(self):
+    span = ModbusReadSpan('input', 10, 6,
+                          ((1, 'a', 1, 'U16', None), (3, 'b', 1, 'U32', None)))
+    self.assertEqual(span.decode([9, 1, 9, 0, 2, 9]), [('a', 1), ('b', 2)])
+
+  def test_bad_layouts(self):
+    self.assertRaises(ValueError, ModbusReadSpan, 'input', 0, 2,
+                      ((0, 'a', 1, 'U32', None), (1, 'b', 1, 'U16', None)))
+    self.assertRaises(ValueError, ModbusReadSpan, 'input', 0, 1,
+                      ((0, 'a', 1, 'U32', None),))
+    self.assertRaises(ValueError, register_map, profile({'input': [
+      {'address': 1, 'name': 'a', 'type': 'F32'}]}))
+
+class TestProfiles(unittest.TestCase):
+  def test_shipped_profile(self):
+    regmap = register_map(load_profile('sungrow-sg5ktl'))
+    self.assertEqual(regmap['input']['5017'],
+                     {'name': 'total_pv_power', 'type': 'U16', 'units': 'W', 'scale': Decimal('1')})
+    self.assertEqual(regmap['input']['5008']['type'], 'S16')
+    self.assertEqual(regmap['input']['5008']['scale'], Decimal('0.1'))
+
+  def test_profile_by_path(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmpdir, 'mine.json')
+      with open(path, 'w') as f:
+        json.dump(profile({'input': [{'address': 3, 'name': 'a'}]}), f)
+      self.assertEqual(profile_path(path), path)
+      self.assertEqual(load_profile(path)['model'], 'test')
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_unknown_profile(self):
+    self.assertIsNone(profile_path('no-such-inverter'))
+    self.assertRaises(ValueError, load_profile, 'no-such-inverter')
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
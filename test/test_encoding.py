@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Round trips through the payload encodings and the sample codec
+"""
+
+from datetime import datetime
+from decimal import Decimal
+import json
+import math
+import struct
+import unittest
+
+import pvstats.encoding as encoding
+import pvstats.report as report
+from pvstats.encoding import PVEncoderCache, text_value
+from pvstats.codec import encode_sample, decode_sample
+from pvstats.report import PVReport_mqtt
+
+def sample():
+  return {'timestamp':      datetime(2018, 6, 1, 12, 30, 15, 250000),
+          'inverter':       'roof',
+          'total_pv_power': 4012,
+          'daily_pv_power': 12345678901,
+          'pv1_voltage':    Decimal('240.6'),
+          'internal_temp':  31.25,
+          'grid_frequency': None,
+          'run_state':      u'Run \u2713',
+          'online':         True}
+
+def encode(encoding, data):
+  return PVEncoderCache(encoding).get(data).encode(data)
+
+class _Client(object):
+  """Keeps the published messages"""
+
+  def __init__(self, *args, **kwargs):
+    self.published = []
+
+  def connect(self, host, port):
+    pass
+
+  def loop_start(self):
+    pass
+
+  def publish(self, topic, payload, qos=0, retain=False):
+    self.published.append((topic, payload))
+
+class TestEncodings(unittest.TestCase):
+  def test_json_pretty(self):
+    payload = encode('json-pretty', sample())
+    self.assertEqual(payload, json.dumps(sample(), sort_keys=True, indent=2,
+                                         separators=(',', ': '), default=str))
+
+    # Decimals and datetimes come back as strings, as they always have
+    decoded = json.loads(payload)
+    self.assertEqual(decoded['pv1_voltage'], '240.6')
+    self.assertEqual(decoded['timestamp'], '2018-06-01 12:30:15.250000')
+    self.assertEqual(decoded['total_pv_power'], 4012)
+    self.assertEqual(decoded['internal_temp'], 31.25)
+
+  def test_json(self):
+    data    = sample()
+    decoded = json.loads(encode('json', data), parse_float=Decimal)
+    self.assertEqual(sorted(map(str, decoded)), sorted(data))
+    self.assertNotIn(' ', encode('json', {'a': 1, 'b': 2}))
+
+    self.assertEqual(decoded['timestamp'], data['timestamp'].isoformat())
+    self.assertEqual(decoded['pv1_voltage'], data['pv1_voltage'])
+    self.assertEqual(decoded['internal_temp'], Decimal('31.25'))
+    for name in ('inverter', 'total_pv_power', 'daily_pv_power',
+                 'grid_frequency', 'run_state', 'online'):
+      self.assertEqual(decoded[name], data[name], name)
+
+  def test_json_schema_cached(self):
+    cache = PVEncoderCache('json')
+    data  = sample()
+    self.assertIs(cache.get(data), cache.get(sample()))
+    data['extra'] = 1
+    self.assertIsNot(cache.get(data), cache.get(sample()))
+
+  def test_binary(self):
+    data    = sample()
+    encoder = PVEncoderCache('binary').get(data)
+    payload = encoder.encode(data)
+    schema  = json.loads(encoder.schema())
+
+    values = dict(zip(schema['fields'], struct.unpack(str(schema['format']), payload)))
+    self.assertEqual(values.pop('schema_id'), schema['id'])
+    # Only the numbers and datetimes of the first sample are laid out
+    self.assertEqual(sorted(values), ['daily_pv_power', 'internal_temp',
+                                      'pv1_voltage', 'timestamp', 'total_pv_power'])
+    self.assertEqual(values['total_pv_power'], 4012.0)
+    self.assertEqual(values['daily_pv_power'], 12345678901.0)
+    self.assertEqual(values['pv1_voltage'], 240.6)
+    self.assertEqual(values['internal_temp'], 31.25)
+    self.assertEqual(datetime.fromtimestamp(values['timestamp']), data['timestamp'])
+
+  def test_binary_layout_fixed(self):
+    # Later samples keep the first sample's layout, None as NaN
+    data    = sample()
+    encoder = PVEncoderCache('binary').get(data)
+    first   = encoder.encode(data)
+    data['internal_temp'] = None
+    payload = encoder.encode(data)
+    self.assertEqual(len(payload), len(first))
+
+    schema = json.loads(encoder.schema())
+    values = dict(zip(schema['fields'], struct.unpack(str(schema['format']), payload)))
+    self.assertTrue(math.isnan(values['internal_temp']))
+
+  @unittest.skipIf(encoding.msgpack is None, "msgpack is not installed")
+  def test_msgpack(self):
+    data    = sample()
+    decoded = encoding.msgpack.unpackb(encode('msgpack', data))
+    self.assertEqual(decoded['pv1_voltage'], 240.6)
+    self.assertEqual(decoded['timestamp'], data['timestamp'].isoformat())
+    self.assertEqual(decoded['total_pv_power'], 4012)
+
+  def test_unknown_encoding(self):
+    self.assertRaises(ValueError, PVEncoderCache, 'xml')
+
+  def test_text_value(self):
+    self.assertEqual(text_value(Decimal('240.6')), u'240.6')
+    self.assertEqual(text_value(0.1), u'0.1')
+    self.assertEqual(text_value(datetime(2018, 6, 1, 12)), u'2018-06-01T12:00:00')
+
+class TestMQTTEncoding(unittest.TestCase):
+  def setUp(self):
+    self._client = report.mqtt.Client
+    report.mqtt.Client = _Client
+
+  def tearDown(self):
+    report.mqtt.Client = self._client
+
+  def test_default_unchanged(self):
+    mqtt = PVReport_mqtt({'host': 'localhost', 'port': 1883, 'user': '', 'password': '',
+                          'tls': False, 'qos': 0, 'topic': 'pv'})
+    mqtt.publish(sample())
+    self.assertEqual(mqtt.client.published,
+                     [('pv', json.dumps(sample(), sort_keys=True, indent=2,
+                                        separators=(',', ': '), default=str))])
+
+class TestCodec(unittest.TestCase):
+  def test_round_trip(self):
+    data    = sample()
+    decoded = decode_sample(encode_sample(data))
+    self.assertEqual(decoded, data)
+    # Decimals and datetimes keep their types, strings come back as unicode
+    for name in data:
+      if not isinstance(data[name], basestring):
+        self.assertIs(type(decoded[name]), type(data[name]), name)
+
+  def test_offset(self):
+    buf = encode_sample({'a': 1}) + encode_sample({'b': Decimal('2.5')})
+    self.assertEqual(decode_sample(buf, len(encode_sample({'a': 1}))), {'b': Decimal('2.5')})
+
+  def test_unknown_type(self):
+    self.assertRaises(TypeError, encode_sample, {'a': object()})
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
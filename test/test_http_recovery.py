@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reading a web server inverter which went away and came back
+"""
+
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import unittest
+from decimal import Decimal
+
+import pvstats.pvinverter.base as base
+from pvstats.pvinverter.solax import PVInverter_Solax
+
+from test.test_reconnect import _Clock, poll
+
+SOLAX_BODY = ('{"method":"uploadsn","version":"Solax_SI_CH_2nd_20160912_DE02","type":"AL_SE",'
+              '"SN":"XXXXXXXXXX","Data":[2.2,2.0,240.6,138.2,,,482,32,7.5,5071.3,,,,,,,,,0.08,'
+              '1.00,,,,,,,,0],"Status":"2"}')
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.clients.add(self.connection)
+
+  def finish(self):
+    self.server.clients.discard(self.connection)
+    BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(SOLAX_BODY)))
+    self.end_headers()
+    self.wfile.write(SOLAX_BODY)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.clients = set()
+
+  def handle_error(self, request, client_address):
+    # The connections are dropped on purpose
+    pass
+
+class _Device(object):
+  """A SolaX web server on a fixed port which can be taken down"""
+
+  def __init__(self):
+    self.server = None
+    self.port   = None
+    self.up()
+
+  def up(self):
+    self.server = _Server(('127.0.0.1', self.port or 0))
+    self.port   = self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def down(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      # Drop the kept alive connections too, as a device restarting would
+      for conn in list(self.server.clients):
+        conn.shutdown(socket.SHUT_RDWR)
+      self.thread.join()
+      self.server = None
+
+class TestHTTPRecovery(unittest.TestCase):
+  period = 10
+
+  def setUp(self):
+    self.clock  = _Clock()
+    self._time  = base.time
+    base.time   = self.clock
+    self.device = _Device()
+
+  def tearDown(self):
+    base.time = self._time
+    self.device.down()
+
+  def inverter(self, **cfg):
+    cfg.update({'host': '127.0.0.1', 'port': self.device.port,
+                'connect_timeout': 1, 'read_timeout': 1})
+    return PVInverter_Solax(cfg)
+
+  def run_polls(self, inverter, count):
+    results = []
+    for _ in range(count):
+      results.append(poll(inverter))
+      self.clock.now += self.period
+    return results
+
+  def test_not_persistent_by_default(self):
+    inverter = self.inverter()
+    self.assertFalse(inverter.persistent)
+    self.assertEqual(self.run_polls(inverter, 3), [True] * 3)
+    self.assertEqual(inverter.stats()['http_connects'], 3)
+
+  def test_recovers_on_the_first_poll_after_coming_back(self):
+    inverter = self.inverter()
+    self.assertTrue(poll(inverter))
+
+    self.device.down()
+    self.assertFalse(any(self.run_polls(inverter, 20)))
+
+    self.device.up()
+    self.assertEqual(self.run_polls(inverter, 3), [True] * 3)
+    self.assertEqual(inverter.registers['pv1_voltage'], Decimal('240.6'))
+
+  def test_persistent_recovers_once_the_backoff_has_passed(self):
+    inverter = self.inverter(persistent=True, reconnect_min=1, reconnect_max=60)
+    self.assertTrue(poll(inverter))
+
+    self.device.down()
+    self.assertFalse(any(self.run_polls(inverter, 20)))
+
+    # The backoff is at most reconnect_max, so the device is back in use
+    # within that much time and the connection is then kept
+    self.device.up()
+    results = self.run_polls(inverter, 60 // self.period + 3)
+    self.assertTrue(all(results[results.index(True):]))
+    connects = inverter.stats()['http_connects']
+    self.assertEqual(self.run_polls(inverter, 3), [True] * 3)
+    self.assertEqual(inverter.stats()['http_connects'], connects)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
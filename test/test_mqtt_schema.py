@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Publishing the binary layout to every MQTT topic
+"""
+
+from datetime import datetime
+import unittest
+
+import pvstats.report as report
+from pvstats.report import PVReport_mqtt
+
+class _Client(object):
+  """Keeps the published messages"""
+
+  def __init__(self, *args, **kwargs):
+    self.published = []
+
+  def connect(self, host, port):
+    pass
+
+  def loop_start(self):
+    pass
+
+  def publish(self, topic, payload, qos=0, retain=False):
+    self.published.append(topic)
+
+def sample(inverter, power):
+  return {'timestamp': datetime(2018, 6, 1, 12, 0, 0), 'inverter': inverter,
+          'total_pv_power': power}
+
+class TestMQTTSchema(unittest.TestCase):
+  def setUp(self):
+    self._client = report.mqtt.Client
+    report.mqtt.Client = _Client
+
+  def tearDown(self):
+    report.mqtt.Client = self._client
+
+  def report(self):
+    return PVReport_mqtt({'host': 'localhost', 'port': 1883, 'user': '', 'password': '',
+                          'tls': False, 'qos': 0, 'topic': 'pv/{inverter}',
+                          'encoding': 'binary'})
+
+  def test_schema_published_to_each_topic(self):
+    mqtt = self.report()
+    for _ in range(3):
+      mqtt.publish(sample('roof', 4000))
+      mqtt.publish(sample('shed', 1000))
+
+    published = mqtt.client.published
+    self.assertEqual(published.count('pv/roof/schema'), 1)
+    self.assertEqual(published.count('pv/shed/schema'), 1)
+    self.assertEqual(published.count('pv/roof'), 3)
+    self.assertEqual(published.count('pv/shed'), 3)
+
+  def test_new_layout_published_again(self):
+    mqtt = self.report()
+    mqtt.publish(sample('roof', 4000))
+    data = sample('roof', 4000)
+    data['internal_temp'] = 30
+    mqtt.publish(data)
+
+    self.assertEqual(mqtt.client.published.count('pv/roof/schema'), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
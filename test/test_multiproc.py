@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The shared memory ring and the sharding of inverters across processes
+"""
+
+import time
+import unittest
+
+from pvstats.multiproc import PVSharedRing, PVWorkerPool, shard_entries
+from pvstats.pvinverter.factory import PVInverterFactory
+
+def entry(name, **inv):
+  return (name, inv, 1, {})
+
+def names(shards):
+  return [[e[0] for e in shard] for shard in shards]
+
+class TestShardEntries(unittest.TestCase):
+  def test_round_robin_over_tcp(self):
+    entries = [entry(n, model='test') for n in 'abcde']
+    self.assertEqual(names(shard_entries(entries, 2)), [['a', 'c', 'e'], ['b', 'd']])
+
+  def test_no_more_shards_than_inverters(self):
+    entries = [entry(n, model='test') for n in 'ab']
+    self.assertEqual(len(shard_entries(entries, 4)), 2)
+
+  def test_bus_kept_in_one_shard(self):
+    entries = [entry('east', mode='rtu', dev='/dev/ttyUSB0', unit=1),
+               entry('roof', mode='tcp'),
+               entry('west', mode='rtu', dev='/dev/ttyUSB0', unit=2),
+               entry('shed', mode='rtu', dev='/dev/ttyUSB1', unit=1),
+               entry('barn', mode='rtu', dev='/dev/ttyUSB0', unit=3)]
+    shards = names(shard_entries(entries, 3))
+    self.assertIn(['east', 'west', 'barn'], shards)
+    self.assertEqual(sorted(sum(shards, [])), sorted(e[0] for e in entries))
+    self.assertEqual(len(shards), 3)
+
+  def test_one_bus_is_one_shard(self):
+    entries = [entry(n, mode='rtu', dev='/dev/ttyUSB0', unit=u) for u, n in enumerate('abc')]
+    self.assertEqual(names(shard_entries(entries, 4)), [['a', 'b', 'c']])
+
+class TestSharedRing(unittest.TestCase):
+  def test_records_in_order(self):
+    ring = PVSharedRing(1024, 2)
+    self.assertTrue(ring.put(0, 'first'))
+    self.assertTrue(ring.put(1, 'second'))
+    self.assertEqual(ring.get(0), [(0, 'first'), (1, 'second')])
+    self.assertEqual(ring.used(), 0)
+    self.assertEqual(ring.get(0), [])
+
+  def test_wraps_around(self):
+    ring = PVSharedRing(64, 1)
+    for idx in range(20):
+      payload = 'x' * (idx % 7) + str(idx)
+      self.assertTrue(ring.put(0, payload))
+      self.assertEqual(ring.get(0), [(0, payload)])
+    self.assertEqual(ring.worker_stats(0)['samples'], 20)
+
+  def test_full_ring_drops(self):
+    ring = PVSharedRing(64, 1)
+    self.assertTrue(ring.put(0, 'x' * 40))
+    tstart = time.time()
+    self.assertFalse(ring.put(0, 'y' * 40, timeout=0.1))
+    self.assertGreaterEqual(time.time() - tstart, 0.1)
+    self.assertEqual(ring.worker_stats(0)['dropped'], 1)
+    self.assertEqual(ring.get(0), [(0, 'x' * 40)])
+    self.assertEqual(ring.peak.value, 46)
+
+  def test_sample_larger_than_the_ring(self):
+    ring = PVSharedRing(64, 1)
+    self.assertRaises(ValueError, ring.put, 0, 'x' * 64)
+
+def build(scheduler, entries):
+  for name, inv, period, adaptive in entries:
+    scheduler.add_inverter(name, PVInverterFactory(inv['model'], inv), period)
+
+class TestWorkerPool(unittest.TestCase):
+  def test_samples_published_from_every_worker(self):
+    entries = [('a', {'model': 'test'}, 0.05, {}), ('b', {'model': 'test'}, 0.05, {}),
+               ('c', {'model': 'test'}, 0.05, {})]
+    pool    = PVWorkerPool(entries, 2, build, ring_bytes=1<<16)
+    samples = []
+    publish = lambda name, data: samples.append(name)
+
+    pool.start()
+    try:
+      deadline = time.time() + 10
+      while len(set(samples)) < 3 and time.time() < deadline:
+        pool.drain(publish, timeout=0.1)
+    finally:
+      pool.stop(publish)
+
+    self.assertEqual(set(samples), set('abc'))
+    self.assertFalse(any(proc.is_alive() for proc in pool.procs))
+    self.assertEqual(pool.stats()['published'], len(samples))
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Matching pipelined Modbus TCP responses to their requests
+"""
+
+import socket
+import struct
+import unittest
+
+import pvstats.pvinverter.pipeline as pipeline
+from pvstats.pvinverter.pipeline import PVModbusPipeline, FUNCTIONS
+
+_MBAP = struct.Struct('>HHHB')
+_READ = struct.Struct('>BHH')
+
+def value(func, addr):
+  """The register held at each address of the fake device"""
+  return (addr * 7 + (1000 if func == FUNCTIONS['holding'] else 0)) & 0xffff
+
+class _Socket(object):
+  """A Modbus TCP device on the other end of a connection
+
+  The queued requests are answered together, in reverse order if reorder,
+  and recv returns at most chunk bytes so responses arrive split.
+  """
+
+  def __init__(self, reorder=False, chunk=4096, exceptions=(), silent=False):
+    self.reorder    = reorder
+    self.chunk      = chunk
+    self.exceptions = set(exceptions)
+    self.silent     = silent
+
+    self.inbuf    = ''
+    self.out      = ''
+    self.queued   = []
+    self.stale    = []
+    self.requests = 0
+    self.most     = 0
+    self.closed   = False
+
+  def setsockopt(self, *args):
+    pass
+
+  def close(self):
+    self.closed = True
+
+  def sendall(self, data):
+    self.inbuf += data
+    while len(self.inbuf) >= _MBAP.size + _READ.size:
+      self.queued.append(self.inbuf[:_MBAP.size + _READ.size])
+      self.inbuf = self.inbuf[_MBAP.size + _READ.size:]
+      self.requests += 1
+    self.most = max(self.most, len(self.queued))
+
+  def ready(self):
+    return not self.silent and bool(self.out or self.queued or self.stale)
+
+  def _response(self, request):
+    tid, pid, length, unit = _MBAP.unpack_from(request)
+    func, start, count     = _READ.unpack_from(request, _MBAP.size)
+    if start in self.exceptions:
+      pdu = struct.pack('>BB', func | 0x80, 2)
+    else:
+      pdu = struct.pack('>BB{}H'.format(count), func, count * 2,
+                        *[value(func, start + i) for i in range(count)])
+    return _MBAP.pack(tid, pid, len(pdu) + 1, unit) + pdu
+
+  def recv(self, size):
+    if not self.out:
+      queued = self.queued[::-1] if self.reorder else self.queued
+      self.out = ''.join(self.stale) + ''.join(self._response(r) for r in queued)
+      self.queued = []
+      self.stale  = []
+    data, self.out = self.out[:min(size, self.chunk)], self.out[min(size, self.chunk):]
+    return data
+
+def _select(readable, writable, errors, timeout):
+  return [s for s in readable if s.ready()], [], []
+
+class TestModbusPipeline(unittest.TestCase):
+  def setUp(self):
+    self.sockets = []
+    self.options = {}
+    self._create = pipeline.socket.create_connection
+    self._select = pipeline.select.select
+    pipeline.socket.create_connection = self._connect
+    pipeline.select.select = _select
+
+  def tearDown(self):
+    pipeline.socket.create_connection = self._create
+    pipeline.select.select = self._select
+
+  def _connect(self, address, timeout):
+    sock = _Socket(**self.options)
+    self.sockets.append(sock)
+    return sock
+
+  def expected(self, reads):
+    return [tuple(value(FUNCTIONS[func], start + i) for i in range(count))
+            for func, start, count in reads]
+
+  reads = [('input', 4999, 10), ('input', 5010, 3), ('holding', 4999, 6),
+           ('input', 5030, 1), ('holding', 5010, 2), ('input', 5040, 20)]
+
+  def test_in_order(self):
+    pipe = PVModbusPipeline('inverter')
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+    self.assertEqual(pipe.stats()['modbus_requests'], len(self.reads))
+    self.assertEqual(pipe.stats()['modbus_inflight_max'], 4)
+    self.assertEqual(self.sockets[0].most, 4)
+
+  def test_out_of_order_and_split(self):
+    # The responses arrive last first, a few bytes at a time
+    self.options = {'reorder': True, 'chunk': 5}
+    pipe = PVModbusPipeline('inverter', max_inflight=6)
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+    self.assertEqual(pipe.read(self.reads[::-1]), self.expected(self.reads[::-1]))
+    self.assertEqual(pipe.cycles, 2)
+
+  def test_sequential(self):
+    # Devices that cope with a single outstanding request are read in turn
+    self.options = {'chunk': 3}
+    pipe = PVModbusPipeline('inverter', max_inflight=1)
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+    self.assertEqual(self.sockets[0].most, 1)
+    self.assertEqual(self.sockets[0].requests, len(self.reads))
+
+  def test_connections(self):
+    self.options = {'reorder': True}
+    pipe = PVModbusPipeline('inverter', max_inflight=2, connections=3)
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+    self.assertEqual(len(self.sockets), 3)
+    self.assertEqual([s.requests for s in self.sockets], [2, 2, 2])
+
+  def test_transaction_id_wraps(self):
+    self.options = {'reorder': True}
+    pipe = PVModbusPipeline('inverter', max_inflight=6)
+    pipe._tid = 0xfffd
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+    self.assertEqual(pipe._tid, 3)
+
+  def test_late_response_ignored(self):
+    pipe = PVModbusPipeline('inverter')
+    pipe.connect()
+    # A response to a transaction which is no longer waited on
+    self.sockets[0].stale.append(_MBAP.pack(999, 0, 5, 1) + struct.pack('>BBH', 4, 2, 0xdead))
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+
+  def test_exception_response(self):
+    self.options = {'reorder': True, 'exceptions': [5030]}
+    pipe = PVModbusPipeline('inverter', max_inflight=6)
+    with self.assertRaisesRegexp(IOError, "Modbus exception 2 reading input"):
+      pipe.read(self.reads)
+
+    # Started afresh on the next cycle
+    self.assertTrue(self.sockets[0].closed)
+    self.assertIsNone(pipe.socket)
+    self.options = {}
+    self.assertEqual(pipe.read(self.reads), self.expected(self.reads))
+    self.assertEqual(len(self.sockets), 2)
+
+  def test_timeout(self):
+    self.options = {'silent': True}
+    pipe = PVModbusPipeline('inverter', timeout=0.01)
+    with self.assertRaisesRegexp(IOError, "Timed out waiting on 4 Modbus responses"):
+      pipe.read(self.reads)
+    self.assertEqual(pipe.stats()['modbus_timeouts'], 1)
+    self.assertTrue(self.sockets[0].closed)
+
+  def test_unable_to_connect(self):
+    def refuse(address, timeout):
+      raise socket.error("Connection refused")
+    pipeline.socket.create_connection = refuse
+    pipe = PVModbusPipeline('inverter')
+    self.assertFalse(pipe.connect())
+    self.assertRaises(IOError, pipe.read, self.reads)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Uploading several inverters and devices to PVOutput
+"""
+
+from datetime import datetime, timedelta
+import unittest
+
+from pvstats.report import PVReport_pvoutput
+
+class _Client(object):
+  """Keeps the uploaded statuses"""
+
+  def __init__(self):
+    self.statuses = []
+
+  def add_status(self, date, time, priority=None, **status):
+    status.update({'date': date, 'time': time})
+    self.statuses.append(status)
+
+  def add_batch_status(self, statuses, priority=None):
+    self.statuses.extend(statuses)
+
+def sample(ts, power, energy, inverter='roof', device_id=None):
+  data = {'timestamp': ts, 'inverter': inverter, 'total_pv_power': power,
+          'daily_pv_power': energy, 'internal_temp': 30,
+          'pv1_voltage': 240, 'pv2_voltage': 0}
+  if device_id is not None:
+    data['device_id'] = device_id
+  return data
+
+class TestPVOutputSites(unittest.TestCase):
+  start = datetime(2018, 6, 1, 12, 0, 0)
+
+  def report(self, **cfg):
+    cfg.update({'host': 'pvoutput.org', 'key': 'test-{}'.format(id(self)),
+                'system_id': '1', 'rate_limit': 300})
+    report = PVReport_pvoutput(cfg)
+    report.client = _Client()
+    return report
+
+  def run_cycles(self, report, sources, count=31):
+    for cycle in range(count):
+      ts = self.start + timedelta(seconds=10 * cycle)
+      for inverter, device_id, power, energy in sources:
+        report.publish(sample(ts, power, energy, inverter, device_id))
+    return report.client.statuses
+
+  def test_devices_are_added_up(self):
+    report   = self.report()
+    statuses = self.run_cycles(report, [('roof', '1', 4000, 10000),
+                                        ('roof', '2', 1000,  2000)])
+    self.assertEqual(len(statuses), 1)
+    self.assertAlmostEqual(statuses[0]['power_generation'], 5000)
+    self.assertEqual(statuses[0]['energy_generation'], 12000)
+    self.assertAlmostEqual(statuses[0]['voltage'], 240)
+    self.assertEqual(statuses[0]['time'], '12:04')
+
+  def test_inverters_are_added_up(self):
+    report   = self.report()
+    statuses = self.run_cycles(report, [('roof', None, 3000, 9000),
+                                        ('shed', None,  500,  700)])
+    self.assertEqual(len(statuses), 1)
+    self.assertAlmostEqual(statuses[0]['power_generation'], 3500)
+    self.assertEqual(statuses[0]['energy_generation'], 9700)
+
+  def test_device_filter(self):
+    report   = self.report(inverter='roof', device_id=2)
+    statuses = self.run_cycles(report, [('roof', '1', 4000, 10000),
+                                        ('roof', '2', 1000,  2000),
+                                        ('shed', '2',  500,   700)])
+    self.assertEqual(len(statuses), 1)
+    self.assertAlmostEqual(statuses[0]['power_generation'], 1000)
+    self.assertEqual(statuses[0]['energy_generation'], 2000)
+
+  def test_a_source_which_stops_is_left_out(self):
+    report = self.report()
+    self.run_cycles(report, [('roof', '1', 4000, 10000),
+                             ('roof', '2', 1000,  2000)], count=30)
+    self.start += timedelta(seconds=300)
+    statuses = self.run_cycles(report, [('roof', '1', 4000, 10000)], count=61)
+
+    # Each period waits for the stopped device until a later one completes
+    self.assertEqual(len(statuses), 2)
+    self.assertAlmostEqual(statuses[0]['power_generation'], 4000)
+    self.assertEqual(statuses[0]['time'], '12:04')
+    self.assertAlmostEqual(statuses[1]['power_generation'], 4000)
+    self.assertEqual(statuses[1]['time'], '12:09')
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
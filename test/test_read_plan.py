@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Planning the fewest Modbus reads for a register map
+"""
+
+import unittest
+
+from pvstats.pvinverter.device_profile import (load_profile, register_map, plan_reads,
+                                               MODBUS_MAX_COUNT)
+
+def regmap(func, *registers):
+  """A register map of (1 based address, type) pairs"""
+  return {func: dict((str(addr), {'name': 'r{}'.format(addr), 'type': rtype, 'scale': 1})
+                     for addr, rtype in registers)}
+
+def spans(plan):
+  return [(span.func, span.start, span.count) for span in plan]
+
+class TestPlanReads(unittest.TestCase):
+  def test_adjacent_merged(self):
+    plan = plan_reads(regmap('input', (1, 'U16'), (2, 'U16'), (3, 'U32')))
+    self.assertEqual(spans(plan), [('input', 0, 4)])
+    self.assertEqual(plan[0].names, ('r1', 'r2', 'r3'))
+
+  def test_gap_limit(self):
+    # The gap is the unused registers between the end of one and the next
+    self.assertEqual(spans(plan_reads(regmap('input', (1, 'U16'), (12, 'U16')), max_gap=10)),
+                     [('input', 0, 12)])
+    self.assertEqual(spans(plan_reads(regmap('input', (1, 'U16'), (13, 'U16')), max_gap=10)),
+                     [('input', 0, 1), ('input', 12, 1)])
+    # Measured from the end of a 32 bit register
+    self.assertEqual(spans(plan_reads(regmap('input', (1, 'U32'), (13, 'U16')), max_gap=10)),
+                     [('input', 0, 13)])
+
+  def test_no_gaps(self):
+    plan = plan_reads(regmap('input', (1, 'U16'), (2, 'U16'), (4, 'U16')), max_gap=0)
+    self.assertEqual(spans(plan), [('input', 0, 2), ('input', 3, 1)])
+
+  def test_max_count(self):
+    registers = [(addr, 'U16') for addr in range(1, 301)]
+    plan = plan_reads(regmap('input', *registers))
+    self.assertEqual(spans(plan), [('input', 0, MODBUS_MAX_COUNT),
+                                   ('input', 125, MODBUS_MAX_COUNT),
+                                   ('input', 250, 50)])
+
+    # A 32 bit register is never split across reads
+    plan = plan_reads(regmap('input', (1, 'U16'), (2, 'U16'), (3, 'U32')), max_count=3)
+    self.assertEqual(spans(plan), [('input', 0, 2), ('input', 2, 2)])
+
+  def test_functions_planned_apart(self):
+    plan = plan_reads(dict(regmap('input', (5001, 'U16')), **regmap('holding', (5001, 'U16'))))
+    self.assertEqual(spans(plan), [('holding', 5000, 1), ('input', 5000, 1)])
+
+  def test_unordered_map(self):
+    plan = plan_reads(regmap('input', (30, 'U16'), (1, 'U16'), (10, 'U16')), max_gap=9)
+    self.assertEqual(spans(plan), [('input', 0, 10), ('input', 29, 1)])
+    self.assertEqual([span.names for span in plan], [('r1', 'r10'), ('r30',)])
+
+  def test_decoded_by_offset(self):
+    plan = plan_reads(regmap('input', (101, 'U16'), (104, 'U32')))
+    self.assertEqual(plan[0].decode([7, 0, 0, 1, 2]), [('r101', 7), ('r104', 0x10002)])
+
+  def test_shipped_profile(self):
+    regs = register_map(load_profile('sungrow-sg5ktl'))
+    self.assertEqual(spans(plan_reads(regs)),
+                     [('holding', 4999, 6), ('input', 5002, 20), ('input', 5035, 1)])
+    self.assertEqual(spans(plan_reads(regs, max_gap=13)),
+                     [('holding', 4999, 6), ('input', 5002, 34)])
+    self.assertEqual(spans(plan_reads(regs, max_gap=2)),
+                     [('holding', 4999, 6), ('input', 5002, 2), ('input', 5007, 15),
+                      ('input', 5035, 1)])
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reconnecting to an inverter which went away and came back
+"""
+
+import unittest
+
+import pvstats.pvinverter.base as base
+from pvstats.pvinverter.base import BasePVInverter
+
+class _Clock(object):
+  """Stands in for the time module, moved on by hand"""
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+class _Inverter(BasePVInverter):
+  """An inverter whose device is down until told otherwise"""
+
+  def __init__(self, cfg):
+    super(_Inverter, self).__init__(cfg)
+    self.down     = True
+    self.attempts = 0
+
+  def connect(self):
+    self.attempts += 1
+    if self.down:
+      raise IOError("Connection refused")
+
+  def read(self):
+    if self.down:
+      raise IOError("Connection reset")
+
+def poll(inverter):
+  """One scheduler cycle, returning True if the read succeeded"""
+  failed = False
+  try:
+    inverter.acquire()
+    inverter.read()
+  except IOError:
+    failed = True
+  finally:
+    inverter.release(failed)
+  return not failed
+
+class TestPersistentReconnect(unittest.TestCase):
+  period = 10
+
+  def setUp(self):
+    self.clock = _Clock()
+    self._time = base.time
+    base.time  = self.clock
+
+  def tearDown(self):
+    base.time = self._time
+
+  def run_polls(self, inverter, count):
+    results = []
+    for _ in range(count):
+      results.append(poll(inverter))
+      self.clock.now += self.period
+    return results
+
+  def test_recovers_once_the_backoff_has_passed(self):
+    inverter = _Inverter({'persistent': True, 'reconnect_min': 1, 'reconnect_max': 300})
+    self.run_polls(inverter, 100)
+    inverter.down = False
+
+    # The backoff is at most reconnect_max, so the device is back in use
+    # within that much time
+    results = self.run_polls(inverter, 300 // self.period + 1)
+    self.assertTrue(results[-1])
+    self.assertTrue(all(results[results.index(True):]))
+
+  def test_waiting_does_not_grow_the_backoff(self):
+    inverter = _Inverter({'persistent': True, 'reconnect_min': 1, 'reconnect_max': 300})
+    self.run_polls(inverter, 100)
+
+    # Only the attempted connects back off, doubling up to reconnect_max
+    self.assertEqual(inverter._backoff, 300)
+    self.assertLess(inverter.attempts, 20)
+
+  def test_first_poll_after_the_retry_time_connects(self):
+    inverter = _Inverter({'persistent': True, 'reconnect_min': 25, 'reconnect_max': 300})
+    self.assertFalse(poll(inverter))
+    inverter.down = False
+
+    self.clock.now += 20
+    self.assertFalse(poll(inverter))
+    self.clock.now += 5
+    self.assertTrue(poll(inverter))
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
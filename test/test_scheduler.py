@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pacing the inverter reads
+"""
+
+import time
+import unittest
+
+import pvstats.scheduler as scheduler
+from pvstats.scheduler import PVInverterTask
+from pvstats.pvinverter.factory import PVInverterFactory
+
+class _SteppedClock(object):
+  """The wall clock, set back an hour after the first read of it"""
+
+  def __init__(self):
+    self.calls = 0
+
+  def time(self):
+    self.calls += 1
+    return time.time() - (3600 if self.calls > 1 else 0)
+
+class TestInverterTask(unittest.TestCase):
+  def setUp(self):
+    self.samples = []
+    self.task = PVInverterTask('roof', PVInverterFactory('test', {}), 0.05,
+                               lambda name, registers: self.samples.append(registers))
+
+  def tearDown(self):
+    scheduler.time = time
+    self.task.stop()
+
+  def test_reads_paced(self):
+    self.task.max_cycles = 4
+    tstart = time.time()
+    self.task.start()
+    self.task.join(5)
+    self.assertFalse(self.task.is_alive())
+    self.assertEqual(len(self.samples), 4)
+    self.assertGreaterEqual(time.time() - tstart, 0.15)
+
+  def test_wall_clock_step(self):
+    # The deadlines are kept on the monotonic clock, so setting the wall
+    # clock back does not stall the reads
+    scheduler.time = _SteppedClock()
+    self.task.max_cycles = 4
+    self.task.start()
+    self.task.join(5)
+    self.assertFalse(self.task.is_alive())
+    self.assertEqual(len(self.samples), 4)
+    self.assertEqual(self.task.skipped, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Spooling a report's samples to disk on its worker thread
+"""
+
+from datetime import datetime, timedelta
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from pvstats.worker import PVReportWorker
+
+class _Report(object):
+  """Buffers batch_size samples until flushed, failing to flush while down"""
+
+  def __init__(self, batch_size=5):
+    self.batch_size = batch_size
+    self.down       = False
+    self.buffered   = []
+    self.written    = []
+    self.flushes    = 0
+
+  def publish(self, data):
+    self.buffered.append(data['total_pv_power'])
+    if len(self.buffered) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    if self.down:
+      raise IOError("Connection refused")
+    self.written.extend(self.buffered)
+    self.buffered = []
+    self.flushes += 1
+
+def sample(idx):
+  return {'timestamp': datetime(2018, 6, 1, 12, 0, 0) + timedelta(seconds=idx),
+          'total_pv_power': idx}
+
+def wait_for(condition, timeout=5.0):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+class TestSpoolWorker(unittest.TestCase):
+  def setUp(self):
+    self.path   = tempfile.mkdtemp()
+    self.report = _Report()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def worker(self):
+    return PVReportWorker(self.report, {'type': 'test',
+                                        'spool': {'path': self.path,
+                                                  'retry_min': 0.05, 'retry_max': 0.1}})
+
+  def test_spooled_on_the_worker_thread(self):
+    worker  = self.worker()
+    threads = set()
+    append  = worker.spool.append
+    def spool_append(data):
+      threads.add(threading.current_thread().name)
+      append(data)
+    worker.spool.append = spool_append
+
+    for idx in range(10):
+      worker.publish(sample(idx))
+    self.assertTrue(wait_for(lambda: len(self.report.written) == 10))
+    worker.stop()
+    self.assertEqual(threads, set(['pvstats-test']))
+
+  def test_acked_only_once_flushed(self):
+    self.report.down = True
+    worker = self.worker()
+    for idx in range(10):
+      worker.publish(sample(idx))
+    self.assertTrue(wait_for(lambda: worker.spool.appended == 10 and worker.failed))
+    self.assertEqual(worker.spool.position[1], 0)
+
+    # Recovering writes every sample, a sample retried after a failed flush
+    # may be written twice
+    self.report.down = False
+    for idx in range(10, 20):
+      worker.publish(sample(idx))
+    self.assertTrue(wait_for(lambda: len(set(self.report.written)) == 20))
+    worker.stop()
+    self.assertEqual(sorted(set(self.report.written)), range(20))
+    self.assertEqual(worker.spool.backlog(), 0)
+
+  def test_acked_at_the_report_flushes(self):
+    self.report = _Report(batch_size=10)
+    worker = self.worker()
+    acks   = []
+    ack    = worker.spool.ack
+    def spool_ack(position):
+      acks.append(position)
+      ack(position)
+    worker.spool.ack = spool_ack
+
+    # One sample at a time, as when sampling
+    for idx in range(50):
+      worker.publish(sample(idx))
+      self.assertTrue(wait_for(lambda: worker.published == idx + 1))
+    self.assertEqual(self.report.flushes, 5)
+    self.assertEqual(len(acks), 5)
+
+    worker.publish(sample(50))
+    self.assertTrue(wait_for(lambda: worker.published == 51))
+    self.assertEqual(len(acks), 5)
+    self.assertNotEqual(worker.spool.backlog(), 0)
+
+    # Stopping flushes and acknowledges the rest
+    worker.stop()
+    self.assertEqual(self.report.written, range(51))
+    self.assertEqual(len(acks), 6)
+    self.assertEqual(worker.spool.backlog(), 0)
+
+  def test_unflushed_samples_are_kept_for_the_next_run(self):
+    self.report.down = True
+    worker = self.worker()
+    for idx in range(5):
+      worker.publish(sample(idx))
+    worker.stop()
+
+    self.report = _Report()
+    worker = self.worker()
+    self.assertTrue(wait_for(lambda: len(self.report.written) == 5))
+    worker.stop()
+    self.assertEqual(self.report.written, range(5))
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Logging the stats of the inverters and reports
+"""
+
+import logging
+import unittest
+
+import pvstats.scheduler as scheduler
+from pvstats.scheduler import PVScheduler, format_stats
+from pvstats.pvinverter.factory import PVInverterFactory
+from pvstats.worker import PVReportWorker
+
+class _Handler(logging.Handler):
+  """Keeps the logged messages"""
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+class TestStats(unittest.TestCase):
+  def setUp(self):
+    self.handler = _Handler()
+    self.level   = scheduler._log.level
+    scheduler._log.addHandler(self.handler)
+    scheduler._log.setLevel(logging.INFO)
+
+  def tearDown(self):
+    scheduler._log.removeHandler(self.handler)
+    scheduler._log.setLevel(self.level)
+
+  def test_format_stats(self):
+    self.assertEqual(format_stats({'b': 0.123456, 'a': 2, 'c': None, 'd': 'idle'}),
+                     "a=2 b=0.1235 c=None d=idle")
+
+  def test_inverter_stats_logged(self):
+    sched = PVScheduler(stats_interval=60)
+    sched.add_inverter('roof', PVInverterFactory('test', {}), 10)
+    task = sched.tasks[0]
+    task.poll()
+
+    stats = task.stats()
+    self.assertEqual(stats['cycles'], 1)
+    self.assertEqual(stats['connects'], 1)
+    self.assertEqual(stats['state'], 'normal')
+
+    sched.log_stats()
+    self.assertEqual(len(self.handler.messages), 1)
+    self.assertTrue(self.handler.messages[0].startswith("roof: "))
+    self.assertIn("connects=1", self.handler.messages[0])
+
+  def test_report_stats_logged(self):
+    worker = PVReportWorker(_Report(), {'type': 'pvoutput'})
+    sched  = PVScheduler(stats_interval=60)
+    sched.add_report(worker)
+    sched.add_report(_Report())
+    worker.publish({'total_pv_power': 1})
+    worker.stop()
+
+    sched.log_stats()
+    self.assertEqual(len(self.handler.messages), 2)
+    self.assertTrue(self.handler.messages[0].startswith("report pvoutput: "))
+    self.assertIn("published=1", self.handler.messages[0])
+    self.assertIn("quota_remaining=59", self.handler.messages[0])
+    self.assertTrue(self.handler.messages[1].startswith("report _Report: "))
+
+class _Report(object):
+  """A report keeping stats of its own, as the PVOutput report does"""
+
+  def publish(self, data):
+    pass
+
+  def stats(self):
+    return {'quota_remaining': 59}
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
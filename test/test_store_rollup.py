@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rolling up the local store from the range of ts kept in its meta table
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pvstats.store import PVStore
+
+# A day boundary in UTC, the store is opened with a zero offset
+START = 1527811200
+
+class TestStoreRollup(unittest.TestCase):
+  def setUp(self):
+    self.dir  = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'pvstats.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def store(self):
+    return PVStore(self.path, offset=0)
+
+  def insert(self, store, start, count, value=1.0):
+    id = store.series_id('roof', 1, 'total_pv_power')
+    store.insert([(id, start + 10 * i, value) for i in range(count)])
+    return id
+
+  def test_range_kept_on_insert(self):
+    store = self.store()
+    self.insert(store, START + 600, 6)
+    self.insert(store, START, 6)
+    self.assertEqual(store._bounds(0), (START, START + 650))
+
+  def test_rollup(self):
+    store = self.store()
+    id    = self.insert(store, START, 60 * 6 + 1)
+    store.rollup()
+
+    rows = store.db.execute("SELECT ts, count, sum FROM rollup_60 WHERE series = ? ORDER BY ts",
+                            (id,)).fetchall()
+    self.assertEqual(len(rows), 60)
+    self.assertEqual(rows[0], (START, 6, 6.0))
+    self.assertEqual(store.watermark(60), START + 3600)
+    self.assertEqual(store.watermark(900), START + 2700)
+    self.assertEqual(store._bounds(60), (START, START + 3540))
+
+    # A later batch is rolled up from the watermark
+    self.insert(store, START + 3610, 60 * 6)
+    store.rollup()
+    self.assertEqual(store.watermark(60), START + 7200)
+    self.assertEqual(store.db.execute("SELECT count(*) FROM rollup_60").fetchone()[0], 120)
+
+  def test_range_found_for_an_older_database(self):
+    store = self.store()
+    self.insert(store, START, 60 * 6 + 1)
+    store.db.execute("DELETE FROM meta")
+    store.db.commit()
+    store.close()
+
+    store = self.store()
+    self.assertEqual(store._bounds(0), (START, START + 3600))
+    store.rollup()
+    self.assertEqual(store.watermark(60), START + 3600)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2:
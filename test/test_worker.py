@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Copyright 2018 Paul Archer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Running a report behind its queue
+"""
+
+import threading
+import time
+import unittest
+
+from pvstats.worker import PVReportWorker, DROP_NEWEST
+
+class _Report(object):
+  """Keeps the samples, each publish waiting until released"""
+
+  def __init__(self):
+    self.samples  = []
+    self.released = threading.Event()
+    self.released.set()
+
+  def publish(self, data):
+    self.released.wait()
+    self.samples.append(data['n'])
+
+class TestReportWorker(unittest.TestCase):
+  def setUp(self):
+    self.report = _Report()
+
+  def tearDown(self):
+    self.report.released.set()
+
+  def test_stop_publishes_the_queue(self):
+    self.report.released.clear()
+    worker = PVReportWorker(self.report, {'type': 'test'})
+    for n in range(5):
+      worker.publish({'n': n})
+    self.report.released.set()
+    worker.stop(timeout=5)
+    self.assertEqual(self.report.samples, range(5))
+
+  def test_drop_policy(self):
+    self.report.released.clear()
+    worker = PVReportWorker(self.report, {'type': 'test', 'queue_size': 2,
+                                          'drop_policy': DROP_NEWEST})
+    for n in range(5):
+      worker.publish({'n': n})
+    self.assertEqual(worker.depth(), 2)
+    self.assertGreaterEqual(worker.stats()['dropped'], 2)
+    self.assertEqual(worker.stats()['spooled'], 0)
+
+  def test_stop_bounded_by_timeout(self):
+    self.report.released.clear()
+    worker = PVReportWorker(self.report, {'type': 'test', 'queue_size': 2})
+    for n in range(5):
+      worker.publish({'n': n})
+
+    # The report is stuck and the queue full
+    tstart = time.time()
+    worker.stop(timeout=0.2)
+    self.assertLess(time.time() - tstart, 1.0)
+
+    # Once released it stops after the sample in hand
+    self.report.released.set()
+    worker._thread.join(5)
+    self.assertFalse(worker._thread.is_alive())
+    self.assertLessEqual(len(self.report.samples), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set expandtab ts=2 sw=2: